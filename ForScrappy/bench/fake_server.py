@@ -0,0 +1,356 @@
+"""
+Local stand-in for the forum and Kraken, for load tests of crawler and downloader.
+Pages follow shapes of tests/fixtures/responses. Point LOCAL__BASE_URL,
+LOCAL__LOGIN_URL and KRAKEN_BASE_URL at it to run the whole pipeline offline:
+
+    python -m bench.fake_server --port 8080 --pages 50 --latency 0.05
+"""
+import asyncio
+import hashlib
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from logging import Logger
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import typer
+from aiohttp import web
+
+from logger import get_module_logger
+from utils.utils import CATEGORIES
+
+logger: Logger = get_module_logger("fake_server")
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+LISTING_TEMPLATE: str = """<body>
+<div><div><div>
+<form action="" method="post" id="">
+<table><tbody>
+{rows}
+<td class="thead"><a name="post1"></a>Dzisiaj, 08:11</td>
+</tbody></table>
+</form>
+</div></div></div>
+</body>"""
+
+LISTING_ROW_TEMPLATE: str = """<tr><td class="" title="{title}">
+<div class="smallfont"><a href="{href}"></a></div>
+</td></tr>"""
+
+THREAD_TEMPLATE: str = """<html><head>
+<meta property="og:title" content="{title}"/>
+</head>
+<body><div><table><tbody><tr><td><div><b><div align="center">
+{links}
+</div></b></div></td></tr></tbody></table></div></body></html>"""
+
+THREAD_LINK_TEMPLATE: str = (
+    """<div class=""><a href="{href}#" data-url="{data_url}"></a></div>"""
+)
+
+KRAKEN_TEMPLATE: str = """<!DOCTYPE html>
+<html class="js" lang="en-us">
+<div class="nk-app-root">
+<div class="coin-item file-title"><div class="coin-info">
+<span class="coin-name">{name}</span>
+</div></div>
+<div class="" data-file-hash="{file_hash}" data-file-server="">
+<ul class="nk-iv-wg4-overview g-2">
+<li><div class="sub-text">Upload date</div><div class="lead-text">{uploaded}</div></li>
+<li><div class="sub-text">File size</div><div class="lead-text">{size}</div></li>
+</ul>
+<form action="" id="" method="GET">
+<input id="dl-token" name="token" title="dl-token" type="hidden" value="{token}"/>
+</form>
+</div>
+</div>
+</html>"""
+
+
+@dataclass
+class FakeServerConfig:
+    categories: Tuple[str, ...] = CATEGORIES
+    pages: int = 50
+    threads_per_page: int = 20
+    links_per_thread: int = 3
+    file_size: int = 10 * 1024 * 1024
+    latency: float = 0.0  # seconds added to every response
+    jitter: float = 0.0  # random extra latency, up to given seconds
+    error_rate: float = 0.0  # fraction of requests answered with 500
+    rate_limit: float = 0.0  # requests per second, above it 429 is answered
+    bandwidth: int = 0  # bytes per second of every download, 0 = unlimited
+    seed: Optional[int] = None
+
+
+@dataclass
+class FakeServerStats:
+    requests: int = 0
+    errors: int = 0
+    throttled: int = 0
+    bytes_sent: int = 0
+    routes: Dict[str, int] = field(default_factory=dict)
+
+
+def file_hash(thread: str, index: int) -> str:
+    """Kraken hash of index-th file of given thread"""
+    return hashlib.md5(f"{thread}:{index}".encode()).hexdigest()[:16]
+
+
+def file_block(hash_: str, size: int = 64 * 1024) -> bytes:
+    """Block repeated to build deterministic content of given file"""
+    seed: bytes = hashlib.sha256(hash_.encode()).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse `bytes=start-end` header
+    :return: first and last byte (inclusive) or None if range is not satisfiable
+    """
+    match: Optional[re.Match] = re.match(r"bytes=(\d+)-(\d*)", value)
+    if not match:
+        return 0, size - 1
+    start: int = int(match.group(1))
+    end: int = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class FakeServer:
+    """
+    vBulletin-like forum with listing pages and threads, and Kraken file pages,
+    token POST and downloadable bodies with range support. Content is generated
+    from page numbers, so nothing is stored and every run serves the same data
+    """
+
+    def __init__(
+        self,
+        config: Optional[FakeServerConfig] = None,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+    ) -> None:
+        self.config: FakeServerConfig = config or FakeServerConfig()
+        self.host: str = host
+        self.port: int = port
+        self.stats: FakeServerStats = FakeServerStats()
+        self.random: random.Random = random.Random(self.config.seed)
+        self._tokens: float = self.config.rate_limit
+        self._refilled: float = time.monotonic()
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app: web.Application = web.Application(middlewares=[self.chaos])
+        self.app.router.add_post("/login.php", self.login)
+        self.app.router.add_get("/{category}/", self.listing)
+        self.app.router.add_get(r"/{category}/{page:\d+}", self.listing)
+        self.app.router.add_get("/{category}/{thread}.html", self.thread)
+        self.app.router.add_get("/krakenfiles/view/{hash}/file.html", self.kraken_page)
+        self.app.router.add_post("/download/{hash}", self.kraken_token)
+        self.app.router.add_get("/files/{hash}/{name}", self.file)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def _throttled(self) -> bool:
+        """In-process token bucket of rate_limit requests per second"""
+        if self.config.rate_limit <= 0:
+            return False
+        now: float = time.monotonic()
+        self._tokens = min(
+            self.config.rate_limit,
+            self._tokens + (now - self._refilled) * self.config.rate_limit,
+        )
+        self._refilled = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    @web.middleware
+    async def chaos(self, request: web.Request, handler: Handler) -> web.StreamResponse:
+        """Add configured latency, throttling and errors to every route"""
+        self.stats.requests += 1
+        resource: Optional[web.AbstractResource] = request.match_info.route.resource
+        route: str = resource.canonical if resource else request.path
+        self.stats.routes[route] = self.stats.routes.get(route, 0) + 1
+
+        if self.config.latency or self.config.jitter:
+            await asyncio.sleep(
+                self.config.latency + self.random.uniform(0, self.config.jitter)
+            )
+        if self._throttled():
+            self.stats.throttled += 1
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        if self.random.random() < self.config.error_rate:
+            self.stats.errors += 1
+            return web.Response(status=500, text="fake server error")
+        return await handler(request)
+
+    async def login(self, request: web.Request) -> web.Response:
+        response: web.Response = web.Response(text="<html>Logged in</html>")
+        response.set_cookie("bbsessionhash", "fake-session")
+        return response
+
+    async def listing(self, request: web.Request) -> web.Response:
+        """Forum category page with threads_per_page threads"""
+        category: str = request.match_info["category"]
+        if category not in self.config.categories:
+            raise web.HTTPNotFound()
+
+        page: int = int(request.match_info.get("page", 0))
+        origin: str = str(request.url.origin())
+        rows: List[str] = []
+        if page < self.config.pages:
+            for index in range(self.config.threads_per_page):
+                post: int = page * self.config.threads_per_page + index
+                rows.append(
+                    LISTING_ROW_TEMPLATE.format(
+                        title=post,
+                        href=f"{origin}/{category}/thread-{page}-{index}.html#post{post}",
+                    )
+                )
+        return web.Response(
+            text=LISTING_TEMPLATE.format(rows="\n".join(rows)),
+            content_type="text/html",
+        )
+
+    async def thread(self, request: web.Request) -> web.Response:
+        """Thread page with links_per_thread Kraken links"""
+        category: str = request.match_info["category"]
+        thread: str = f"{category}-{request.match_info['thread']}"
+        origin: str = str(request.url.origin())
+        links: str = "\n".join(
+            THREAD_LINK_TEMPLATE.format(
+                href=str(request.url.with_query(None)),
+                data_url=f"{origin}/krakenfiles/view/{file_hash(thread, index)}/file.html",
+            )
+            for index in range(self.config.links_per_thread)
+        )
+        return web.Response(
+            text=THREAD_TEMPLATE.format(title=f"Fake thread {thread}", links=links),
+            content_type="text/html",
+        )
+
+    async def kraken_page(self, request: web.Request) -> web.Response:
+        hash_: str = request.match_info["hash"]
+        uploaded: date = date(2023, 1, 1) + timedelta(days=int(hash_, 16) % 365)
+        return web.Response(
+            text=KRAKEN_TEMPLATE.format(
+                name=f"Fake track {hash_}.mp3",
+                file_hash=hash_,
+                uploaded=uploaded.strftime("%d.%m.%Y"),
+                size=f"{self.config.file_size / 1024 / 1024:.2f} MB",
+                token=f"token-{hash_}",
+            ),
+            content_type="text/html",
+        )
+
+    async def kraken_token(self, request: web.Request) -> web.Response:
+        """Exchange page token for direct download link"""
+        hash_: str = request.match_info["hash"]
+        if f"token-{hash_}" not in await request.text():
+            return web.json_response({"status": "error", "msg": "invalid token"})
+        origin: str = str(request.url.origin())
+        return web.json_response({"url": f"{origin}/files/{hash_}/{hash_}.mp3"})
+
+    async def file(self, request: web.Request) -> web.StreamResponse:
+        """File body of file_size bytes, with Range support and bandwidth limit"""
+        hash_: str = request.match_info["hash"]
+        size: int = self.config.file_size
+        byte_range: Optional[Tuple[int, int]] = parse_range(
+            request.headers.get("Range", ""), size
+        )
+        if byte_range is None:
+            raise web.HTTPRequestRangeNotSatisfiable(
+                headers={"Content-Range": f"bytes */{size}"}
+            )
+
+        start, end = byte_range
+        response: web.StreamResponse = web.StreamResponse(
+            status=206 if "Range" in request.headers else 200,
+            headers={
+                "Content-Disposition": f'attachment; filename="{request.match_info["name"]}"',
+                "Accept-Ranges": "bytes",
+                "Content-Type": "audio/mpeg",
+            },
+        )
+        response.content_length = end - start + 1
+        if response.status == 206:
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await response.prepare(request)
+
+        block: bytes = file_block(hash_)
+        position: int = start
+        while position <= end:
+            offset: int = position % len(block)
+            chunk: bytes = block[offset : offset + end - position + 1]
+            await response.write(chunk)
+            self.stats.bytes_sent += len(chunk)
+            position += len(chunk)
+            if self.config.bandwidth:
+                await asyncio.sleep(len(chunk) / self.config.bandwidth)
+
+        await response.write_eof()
+        return response
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        # port 0 means any free port
+        self.port = self._runner.addresses[0][1]
+        logger.info(f"Fake server listening on {self.url}")
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+        self._runner = None
+
+    async def __aenter__(self) -> "FakeServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.stop()
+
+
+def main(
+    host: str = typer.Option("127.0.0.1", help="Address to listen on"),
+    port: int = typer.Option(8080, help="Port to listen on"),
+    pages: int = typer.Option(50, help="Listing pages per category"),
+    threads: int = typer.Option(20, help="Threads per listing page"),
+    links: int = typer.Option(3, help="Kraken links per thread"),
+    file_size: int = typer.Option(10 * 1024 * 1024, help="Bytes of every file"),
+    latency: float = typer.Option(0.0, help="Seconds added to every response"),
+    jitter: float = typer.Option(0.0, help="Random extra latency in seconds"),
+    error_rate: float = typer.Option(0.0, help="Fraction of 500 responses"),
+    rate_limit: float = typer.Option(0.0, help="Requests per second before 429"),
+    bandwidth: int = typer.Option(0, help="Bytes per second of every download"),
+    seed: Optional[int] = typer.Option(None, help="Seed of latency and errors"),
+) -> None:
+    config: FakeServerConfig = FakeServerConfig(
+        pages=pages,
+        threads_per_page=threads,
+        links_per_thread=links,
+        file_size=file_size,
+        latency=latency,
+        jitter=jitter,
+        error_rate=error_rate,
+        rate_limit=rate_limit,
+        bandwidth=bandwidth,
+        seed=seed,
+    )
+
+    async def serve() -> None:
+        async with FakeServer(config, host=host, port=port):
+            await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    typer.run(main)
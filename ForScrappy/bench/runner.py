@@ -0,0 +1,319 @@
+"""
+End-to-end benchmark of crawl -> resolve -> download against FakeServer and
+a throwaway database, so runs can be compared across releases and tuning:
+
+    python cli.py bench --pages 5 --threads 20 --links 3 --json
+"""
+import asyncio
+import logging
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from logging import Logger
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence
+
+import asyncpg
+
+from bench.fake_server import FakeServer, FakeServerConfig
+from logger import get_module_logger
+from models.entities import DownloadLinksPydantic
+from repos.db_repo import DownloadLinksRepo, DownloadManifestRepo, LinkModelRepo
+from repos.request_repo import ForClubbersScrapper
+from settings import DB_CONFIG, settings
+from tasks.tasks import download_files_task, make_download_batches
+from use_case.use_case import ForClubUseCase
+from utils.login import User
+from utils.utils import DBConnectionHandler
+
+logger: Logger = get_module_logger("bench")
+
+# bench phase of code running in current task, queries are counted per phase
+_phase: ContextVar[str] = ContextVar("bench_phase", default="other")
+
+
+class QueryCounter(logging.Handler):
+    """
+    Count SQL queries logged by tortoise client, per bench phase. Only queries
+    with parameters are counted, so schema generation and pool messages are not
+    """
+
+    logger_name: str = "tortoise.db_client"
+
+    def __init__(self) -> None:
+        super().__init__(logging.DEBUG)
+        self.counts: Dict[str, int] = {}
+        self._level: int = logging.NOTSET
+        self._propagate: bool = True
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.msg != "%s: %s":
+            return
+        phase: str = _phase.get()
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Count queries of code run in this block, and tasks it starts, as name"""
+        token = _phase.set(name)
+        try:
+            yield
+        finally:
+            _phase.reset(token)
+
+    def __enter__(self) -> "QueryCounter":
+        db_logger: logging.Logger = logging.getLogger(self.logger_name)
+        self._level, self._propagate = db_logger.level, db_logger.propagate
+        # debug records of every query would flood handlers of root logger
+        db_logger.propagate = False
+        db_logger.setLevel(logging.DEBUG)
+        db_logger.addHandler(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        db_logger: logging.Logger = logging.getLogger(self.logger_name)
+        db_logger.removeHandler(self)
+        db_logger.setLevel(self._level)
+        db_logger.propagate = self._propagate
+
+
+class ServerThread:
+    """
+    FakeServer running in its own thread and event loop. The app makes
+    blocking requests from its event loop, which would stall a server sharing it
+    """
+
+    def __init__(self, config: FakeServerConfig) -> None:
+        self.server: FakeServer = FakeServer(config, port=0)
+        self.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self.thread: threading.Thread = threading.Thread(
+            target=self.loop.run_forever, name="fake-server", daemon=True
+        )
+
+    def __enter__(self) -> FakeServer:
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result()
+        return self.server
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        try:
+            asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+
+@dataclass
+class BenchResult:
+    threads: int = 0
+    links: int = 0
+    resolved: int = 0
+    downloaded: int = 0
+    failed: int = 0
+    crawl_seconds: float = 0.0
+    resolve_seconds: float = 0.0
+    download_seconds: float = 0.0
+    threads_per_second: float = 0.0
+    links_per_second: float = 0.0
+    resolve_latency_ms: Dict[str, float] = field(default_factory=dict)
+    bytes_written: int = 0
+    mb_per_second: float = 0.0
+    queries: Dict[str, int] = field(default_factory=dict)
+    queries_per_thread: float = 0.0
+    peak_rss_mb: float = 0.0
+    server: Dict[str, int] = field(default_factory=dict)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+def percentiles(
+    values: Sequence[float], points: Sequence[int] = (50, 90, 99)
+) -> Dict[str, float]:
+    """Nearest-rank percentiles and max of values"""
+    if not values:
+        return {}
+    ordered: List[float] = sorted(values)
+    result: Dict[str, float] = {
+        f"p{point}": ordered[max(round(point / 100 * len(ordered)) - 1, 0)]
+        for point in points
+    }
+    result["max"] = ordered[-1]
+    return result
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process, fake server thread included"""
+    peak: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def ratio(value: float, total: float) -> float:
+    """value per unit of total, e.g. per second"""
+    return round(value / total, 2) if total > 0 else 0.0
+
+
+@contextmanager
+def bench_settings(url: str, download_path: str) -> Iterator[None]:
+    """Point forum, Kraken and download directory settings at bench ones"""
+    overrides: List[Any] = [
+        (settings.local, "base_url", f"{url}/"),
+        (settings.local, "login_url", f"{url}/login.php"),
+        (settings.local, "base_url_pattern", f"{url}/.+/"),
+        (settings, "kraken_base_url", url),
+        (settings, "download_path", download_path),
+    ]
+    previous: List[Any] = [getattr(obj, name) for obj, name, _ in overrides]
+    for obj, name, value in overrides:
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for (obj, name, _), value in zip(overrides, previous):
+            setattr(obj, name, value)
+
+
+@asynccontextmanager
+async def throwaway_database() -> AsyncIterator[str]:
+    """
+    Create empty database next to configured one and point DB_CONFIG at it.
+    Database is dropped on exit
+    :return: name of database
+    """
+    connection: Dict[str, Any] = DB_CONFIG["connections"]["default"]
+    credentials: Dict[str, Any] = connection["credentials"]
+    name: str = f"bench_{uuid.uuid4().hex[:12]}"
+
+    admin: asyncpg.Connection = await asyncpg.connect(**credentials)
+    try:
+        await admin.execute(f'CREATE DATABASE "{name}"')
+        connection["credentials"] = {**credentials, "database": name}
+        try:
+            yield name
+        finally:
+            connection["credentials"] = credentials
+            await admin.execute(f'DROP DATABASE IF EXISTS "{name}"')
+    finally:
+        await admin.close()
+
+
+class BenchRunner:
+    """
+    Run the whole pipeline once against FakeServer: crawl of all categories,
+    resolution of direct links one by one, like download-fetched does,
+    and downloads in download_files batches, like a download worker does.
+    Requires database server and redis of the app; its data is not touched
+    """
+
+    def __init__(self, config: FakeServerConfig) -> None:
+        self.config: FakeServerConfig = config
+        self.result: BenchResult = BenchResult()
+        self.counter: QueryCounter = QueryCounter()
+
+    async def run(self) -> BenchResult:
+        with tempfile.TemporaryDirectory(prefix="bench-") as download_path:
+            with ServerThread(self.config) as server:
+                with bench_settings(server.url, download_path):
+                    async with throwaway_database() as database:
+                        logger.info(f"Bench database: {database}")
+                        await self._run_phases(server.url)
+                    self.result.bytes_written = await asyncio.to_thread(
+                        self._written, Path(download_path)
+                    )
+                self.result.server = {
+                    "requests": server.stats.requests,
+                    "errors": server.stats.errors,
+                    "throttled": server.stats.throttled,
+                }
+
+        self._summarize()
+        return self.result
+
+    async def _run_phases(self, url: str) -> None:
+        async with DBConnectionHandler():
+            with self.counter:
+                use_case: ForClubUseCase = ForClubUseCase(
+                    link_repo=LinkModelRepo,
+                    download_repo=DownloadLinksRepo,
+                    repo_scrapper=ForClubbersScrapper,
+                    session_obj=await asyncio.to_thread(User.login),
+                )
+                with self.counter.phase("crawl"):
+                    await self.crawl(use_case, url)
+                links: Optional[DownloadLinksPydantic] = await use_case.get_links()
+                self.result.links = len(links.__root__) if links else 0
+                with self.counter.phase("resolve"):
+                    jobs: List[Dict] = await self.resolve(use_case, links)
+                with self.counter.phase("download"):
+                    await self.download(jobs)
+
+    async def crawl(self, use_case: ForClubUseCase, url: str) -> None:
+        started: float = time.monotonic()
+        stats: Dict[str, Dict[str, Dict[str, Any]]] = await use_case.crawl_many(
+            {
+                category: [f"{url}/{category}/"]
+                + [f"{url}/{category}/{page}" for page in range(1, self.config.pages)]
+                for category in self.config.categories
+            },
+            enqueue=False,
+        )
+        self.result.crawl_seconds = time.monotonic() - started
+        self.result.threads = sum(
+            category["fetch"]["processed"] for category in stats.values()
+        )
+
+    async def resolve(
+        self, use_case: ForClubUseCase, links: Optional[DownloadLinksPydantic]
+    ) -> List[Dict]:
+        jobs: List[Dict] = []
+        latencies: List[float] = []
+        started: float = time.monotonic()
+        for link_obj in links.__root__ if links else []:
+            link_started: float = time.monotonic()
+            job: Optional[Dict] = await use_case.resolve_link(link_obj)
+            latencies.append((time.monotonic() - link_started) * 1000)
+            if job:
+                jobs.append(job)
+
+        self.result.resolve_seconds = time.monotonic() - started
+        self.result.resolved = len(jobs)
+        self.result.resolve_latency_ms = {
+            name: round(value, 2) for name, value in percentiles(latencies).items()
+        }
+        return jobs
+
+    async def download(self, jobs: List[Dict]) -> None:
+        started: float = time.monotonic()
+        for batch in make_download_batches(jobs, settings.celery.dispatch_chunk_size):
+            result: Dict[str, int] = await download_files_task(batch)
+            self.result.downloaded += result["success"]
+            self.result.failed += result["failed"]
+        self.result.download_seconds = time.monotonic() - started
+
+    @staticmethod
+    def _written(root: Path) -> int:
+        """Bytes of downloaded files, blobs and partial files skipped"""
+        return sum(size for _, size, _ in DownloadManifestRepo.walk(root))
+
+    def _summarize(self) -> None:
+        result: BenchResult = self.result
+        result.threads_per_second = ratio(result.threads, result.crawl_seconds)
+        result.links_per_second = ratio(result.links, result.crawl_seconds)
+        result.mb_per_second = ratio(
+            result.bytes_written / 1024 / 1024, result.download_seconds
+        )
+        result.queries = dict(self.counter.counts)
+        result.queries_per_thread = ratio(
+            result.queries.get("crawl", 0), result.threads
+        )
+        result.peak_rss_mb = round(peak_rss_mb(), 2)
+        for name in ("crawl_seconds", "resolve_seconds", "download_seconds"):
+            setattr(result, name, round(getattr(result, name), 2))
@@ -1,17 +1,32 @@
+import json
 from logging import Logger
 from time import sleep
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 import typer
 
-from models.entities import DownloadLinksPydantic
+from bench.fake_server import FakeServerConfig
+from bench.runner import BenchRunner
 from models.types import SessionObject
 from repos.request_repo import ForClubbersScrapper
 from repos.db_repo import LinkModelRepo, DownloadLinksRepo
+from repos.notify_repo import DownloadLinksListener
+from repos.redis_repo import DownloadBudget
+from use_case.daemon import CrawlDaemon
 from use_case.use_case import ForClubUseCase
 from utils.decorators import be_async
 from utils.login import User
-from utils.utils import DBConnectionHandler, LinkValidator, validate_category
+from utils.metrics import metrics_route
+from utils.profiler import Profiler
+from utils.server import HealthServer
+from settings import settings
+from utils.utils import (
+    CATEGORIES,
+    DBConnectionHandler,
+    LinkValidator,
+    get_runner_id,
+    validate_category,
+)
 
 from logger import get_module_logger
 
@@ -21,11 +36,43 @@ logger: Logger = get_module_logger("db_repo")
 app = typer.Typer()
 
 
+@app.callback()
+def main(
+    ctx: typer.Context,
+    profile: bool = typer.Option(
+        False,
+        "--profile",
+        help="Sample stacks and memory of the command, write flamegraph "
+        f"input and per stage summary to {settings.profiler.directory}/",
+    ),
+) -> None:
+    if profile:
+        profiler: Profiler = Profiler(ctx.invoked_subcommand or "cli")
+        profiler.start()
+        ctx.call_on_close(profiler.stop)
+
+
+def get_page_links(link: str, page: int) -> List[str]:
+    """Links of forum pages to fetch: numbered pages before `page` and link itself"""
+    links: List[str] = []
+
+    if page >= 2:
+        for page_no in range(1, page):
+            new_link = f"{link}{page_no}"
+            links.append(new_link)
+
+    links.append(link)
+    return links
+
+
 @app.command()
 @be_async
 async def get_forum_links(
     link: str = typer.Option(..., "-link", help="Link to forum"),
     page: int = typer.Option(0, "-p", help="Forum page number to fetch"),
+    resume: bool = typer.Option(
+        False, "--resume", help="Continue interrupted crawl from its checkpoint"
+    ),
 ) -> None:
     async with DBConnectionHandler():
         async with LinkValidator(link):
@@ -42,38 +89,136 @@ async def get_forum_links(
             session_obj=session_obj,
         )
 
-        links: List[str] = []
+        await forum_use_case.crawl(
+            category=category, links=get_page_links(link, page), resume=resume
+        )
 
-        if page >= 2:
-            for page_no in range(1, page):
-                new_link = f"{link}{page_no}"
-                links.append(new_link)
+        logger.info("Command get-forum-links finished with success")
 
-        links.append(link)
 
-        for link in links:
-            await forum_use_case.get_files_link_from_forum(category=category, link=link)
+async def get_category_links(
+    links: Optional[List[str]], page: int
+) -> Dict[str, List[str]]:
+    """
+    Validate category links and build links of their pages to fetch
+    :param links: links to forum categories, all categories if empty
+    :param page: forum page number to fetch
+    :return: links of pages per category name
+    """
+    links = links or [
+        f"{settings.local.base_url}{category}/" for category in CATEGORIES
+    ]
+
+    category_links: Dict[str, List[str]] = {}
+    for link in links:
+        async with LinkValidator(link):
+            ...
+        # many links of one category are crawled together
+        category_links.setdefault(validate_category(link=link), []).extend(
+            get_page_links(link, page)
+        )
+    return category_links
+
+
+def login_use_case() -> ForClubUseCase:
+    """Log in and build use case with logged in session"""
+    session_obj: SessionObject = User.login()
+    sleep(3)
+    return ForClubUseCase(
+        link_repo=LinkModelRepo,
+        download_repo=DownloadLinksRepo,
+        repo_scrapper=ForClubbersScrapper,
+        session_obj=session_obj,
+    )
 
-        logger.info("Command get-forum-links finished with success")
+
+@app.command(help="Crawl several forum categories concurrently with one login")
+@be_async
+async def crawl_all(
+    links: Optional[List[str]] = typer.Option(
+        None, "-link", help="Link to forum category, can be repeated. Default: all"
+    ),
+    page: int = typer.Option(0, "-p", help="Forum page number to fetch"),
+    resume: bool = typer.Option(
+        False, "--resume", help="Continue interrupted crawls from their checkpoints"
+    ),
+) -> None:
+    async with DBConnectionHandler():
+        category_links: Dict[str, List[str]] = await get_category_links(links, page)
+        forum_use_case: ForClubUseCase = login_use_case()
+
+        await forum_use_case.crawl_many(category_links, resume=resume)
+
+        logger.info("Command crawl-all finished with success")
+
+
+@app.command(help="Re-crawl forum categories on intervals. Runs until stopped")
+@be_async
+async def daemon(
+    links: Optional[List[str]] = typer.Option(
+        None, "-link", help="Link to forum category, can be repeated. Default: all"
+    ),
+    page: int = typer.Option(
+        settings.daemon.pages, "-p", help="Forum page number to fetch"
+    ),
+) -> None:
+    async with DBConnectionHandler():
+        crawl_daemon: CrawlDaemon = CrawlDaemon(
+            login=login_use_case, links=await get_category_links(links, page)
+        )
+        # backlog gauges are read from DB and redis when metrics are scraped
+        forum_use_case: ForClubUseCase = ForClubUseCase(
+            link_repo=LinkModelRepo,
+            download_repo=DownloadLinksRepo,
+            repo_scrapper=ForClubbersScrapper,
+        )
+        server: HealthServer = HealthServer(crawl_daemon.health)
+        server.add_route(
+            "/metrics", metrics_route(refresh=forum_use_case.update_backlog)
+        )
+        async with server:
+            crawl_daemon.install_signal_handlers()
+            await crawl_daemon.run()
 
 
 @app.command()
 @be_async
-async def download_fetched() -> None:
+async def download_fetched(
+    local: bool = typer.Option(
+        False, "--local", help="Resolve download links in this process"
+    ),
+) -> None:
     forum_use_case: ForClubUseCase = ForClubUseCase(
         link_repo=LinkModelRepo,
         download_repo=DownloadLinksRepo,
         repo_scrapper=ForClubbersScrapper,
     )
+    owner: str = get_runner_id()
+
     async with DBConnectionHandler():
-        res: Optional[DownloadLinksPydantic] = await forum_use_case.get_links()
-        if res and res.__root__:
-            for link_obj in res.__root__:
-                await forum_use_case.download_file(link_obj=link_obj)
+        if local:
+            await forum_use_case.download_claimed(owner=owner)
+        else:
+            await forum_use_case.enqueue_claimed(owner=owner)
 
     logger.info("Command download-fetched with success")
 
 
+@app.command(help="Download links as soon as they are saved. Runs until stopped")
+@be_async
+async def listen_new_links() -> None:
+    forum_use_case: ForClubUseCase = ForClubUseCase(
+        link_repo=LinkModelRepo,
+        download_repo=DownloadLinksRepo,
+        repo_scrapper=ForClubbersScrapper,
+    )
+    owner: str = get_runner_id()
+
+    async with DBConnectionHandler():
+        async with DownloadLinksListener() as listener:
+            await forum_use_case.download_notified(owner=owner, listener=listener)
+
+
 @app.command(help="Get links with errors. Make sure celery tasks are completed")
 @be_async
 async def files_with_errors() -> None:
@@ -83,19 +228,135 @@ async def files_with_errors() -> None:
         repo_scrapper=ForClubbersScrapper,
     )
     async with DBConnectionHandler():
-        res: Optional[
-            DownloadLinksPydantic
-        ] = await forum_use_case.get_links_with_errors()
-
-        if res:
-            logger.info("LinksModelPydantic with errors:")
-            for link in res.__root__:
-                if link is not None:
-                    logger.info(f"{link.link} - {link.error}")
-        else:
+        found: int = 0
+
+        async for link, error_message in forum_use_case.stream_links_with_errors():
+            if not found:
+                logger.info("Links with errors:")
+            found += 1
+            logger.info(f"{link} - {error_message}")
+
+        if not found:
             logger.info("No links with errors found")
 
 
+@app.command(help="Show counters of download links per category and month")
+@be_async
+async def stats(
+    as_json: bool = typer.Option(False, "--json", help="Print stats as JSON"),
+    rebuild: bool = typer.Option(
+        False, "--rebuild", help="Recalculate counters from download links table"
+    ),
+) -> None:
+    forum_use_case: ForClubUseCase = ForClubUseCase(
+        link_repo=LinkModelRepo,
+        download_repo=DownloadLinksRepo,
+        repo_scrapper=ForClubbersScrapper,
+    )
+    async with DBConnectionHandler():
+        result: Dict[str, Any] = await forum_use_case.get_stats(rebuild=rebuild)
+
+    if as_json:
+        typer.echo(json.dumps(result))
+        return
+
+    logger.info(f"Total: {result['total']}")
+    for group in ("category", "published_month"):
+        for name, counters in sorted(result[group].items()):
+            logger.info(f"{group} {name or '-'}: {counters}")
+
+
+@app.command(
+    help="Index download directory and mark links with files on disk as downloaded"
+)
+@be_async
+async def reconcile(
+    scan: bool = typer.Option(
+        True, "--scan/--no-scan", help="Scan download directory before matching"
+    ),
+    with_hash: bool = typer.Option(
+        False, "--hash", help="Calculate sha256 of new and changed files"
+    ),
+) -> None:
+    forum_use_case: ForClubUseCase = ForClubUseCase(
+        link_repo=LinkModelRepo,
+        download_repo=DownloadLinksRepo,
+        repo_scrapper=ForClubbersScrapper,
+    )
+    async with DBConnectionHandler():
+        result: Dict[str, int] = await forum_use_case.reconcile_downloads(
+            scan=scan, with_hash=with_hash
+        )
+
+    for name, value in result.items():
+        logger.info(f"{name}: {value}")
+
+
+@app.command(help="Show or change download limits shared by all celery workers")
+@be_async
+async def download_budget(
+    transfers_per_host: Optional[int] = typer.Option(
+        None, "--transfers-per-host", help="Concurrent transfers per host, 0 = no limit"
+    ),
+    bandwidth: Optional[int] = typer.Option(
+        None, "--bandwidth", help="Bytes per second for all workers, 0 = no limit"
+    ),
+    reset: bool = typer.Option(False, "--reset", help="Use limits from settings"),
+) -> None:
+    budget: DownloadBudget = DownloadBudget()
+    try:
+        if reset:
+            await budget.reset_limits()
+        limits: Dict[str, int] = await budget.set_limits(
+            transfers_per_host=transfers_per_host, bandwidth=bandwidth
+        )
+    finally:
+        await budget.close()
+
+    for name, value in limits.items():
+        logger.info(f"{name}: {value or 'no limit'}")
+
+
+@app.command(
+    help="Run crawl, resolve and download against local fake forum and Kraken "
+    "with a throwaway database, and report throughput"
+)
+@be_async
+async def bench(
+    categories: int = typer.Option(
+        1, "--categories", min=1, max=len(CATEGORIES), help="Categories to crawl"
+    ),
+    pages: int = typer.Option(5, "--pages", help="Listing pages per category"),
+    threads: int = typer.Option(20, "--threads", help="Threads per listing page"),
+    links: int = typer.Option(3, "--links", help="Kraken links per thread"),
+    file_size: int = typer.Option(
+        1024 * 1024, "--file-size", help="Bytes of every file"
+    ),
+    latency: float = typer.Option(
+        0.0, "--latency", help="Seconds added to every response"
+    ),
+    as_json: bool = typer.Option(False, "--json", help="Print results as JSON"),
+) -> None:
+    runner: BenchRunner = BenchRunner(
+        FakeServerConfig(
+            categories=CATEGORIES[:categories],
+            pages=pages,
+            threads_per_page=threads,
+            links_per_thread=links,
+            file_size=file_size,
+            latency=latency,
+        )
+    )
+    result: Dict[str, Any] = (await runner.run()).as_dict()
+
+    if as_json:
+        typer.echo(json.dumps(result))
+        return
+
+    for name, value in result.items():
+        logger.info(f"{name}: {value}")
+
+
 if __name__ == "__main__":
     # os.environ['PYTHONASYNCIODEBUG'] = '1'
     app()
@@ -25,6 +25,7 @@ class DownloadLinkPydantic(BaseModel):
     link: str
     link_model: LinkModelPydantic
     download_link: Optional[str] = None
+    download_link_expires: Optional[datetime] = None
     downloaded: bool = False
     downloaded_date: Optional[datetime] = None
     error: bool = False
@@ -33,6 +34,11 @@ class DownloadLinkPydantic(BaseModel):
     published_date: Optional[datetime] = None
     category: str
     invalid_download_link: bool = False
+    download_offset: int = 0
+    source_hash: Optional[str] = None
+    content_hash: Optional[str] = None
+    content_size: Optional[int] = None
+    stored_path: Optional[str] = None
 
 
 class DownloadLinksPydantic(BaseModel):
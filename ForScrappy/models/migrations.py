@@ -0,0 +1,126 @@
+"""
+Schema changes of tables created by earlier releases. generate_schemas creates
+missing tables only, so columns and indexes added to existing tables are
+applied here, once per database. Applied versions are kept in schema_migrations
+table. Statements are idempotent, so on a new database, where generate_schemas
+already created the columns, migrations are only recorded. Index names are
+the ones generate_schemas gives
+"""
+from logging import Logger
+from typing import List, Set, Tuple
+
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.transactions import in_transaction
+
+from logger import get_module_logger
+
+logger: Logger = get_module_logger("migrations")
+
+# version, name, SQL. Append new migrations, never change applied ones
+MIGRATIONS: Tuple[Tuple[int, str, str], ...] = (
+    (
+        1,
+        "download link claims",
+        """
+        ALTER TABLE "download_links"
+            ADD COLUMN IF NOT EXISTS "lease_owner" VARCHAR(255),
+            ADD COLUMN IF NOT EXISTS "lease_expires" TIMESTAMPTZ;
+        CREATE INDEX IF NOT EXISTS "idx_download_li_lease_e_574481"
+            ON "download_links" ("lease_expires");
+        """,
+    ),
+    (
+        2,
+        "download resume offset",
+        """
+        ALTER TABLE "download_links"
+            ADD COLUMN IF NOT EXISTS "download_offset" BIGINT NOT NULL DEFAULT 0;
+        """,
+    ),
+    (
+        3,
+        "direct download link expiry",
+        """
+        ALTER TABLE "download_links"
+            ADD COLUMN IF NOT EXISTS "download_link_expires" TIMESTAMPTZ;
+        """,
+    ),
+    (
+        4,
+        "content addressed storage",
+        """
+        ALTER TABLE "download_links"
+            ADD COLUMN IF NOT EXISTS "source_hash" VARCHAR(255),
+            ADD COLUMN IF NOT EXISTS "content_hash" VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS "content_size" BIGINT,
+            ADD COLUMN IF NOT EXISTS "stored_path" VARCHAR(2000);
+        CREATE INDEX IF NOT EXISTS "idx_download_li_source__7035a4"
+            ON "download_links" ("source_hash");
+        CREATE INDEX IF NOT EXISTS "idx_download_li_content_05e8da"
+            ON "download_links" ("content_hash");
+        """,
+    ),
+    (
+        5,
+        "seed download link counters",
+        # counters are kept up to date from this release on, rows saved by
+        # older ones have to be counted once, like `cli.py stats --rebuild` does
+        """
+        DELETE FROM "download_links_stats";
+        INSERT INTO "download_links_stats" (
+            "category", "published_month", "total", "downloaded", "error",
+            "not_exists", "updated"
+        )
+        SELECT COALESCE("category", ''),
+            COALESCE(to_char("published_date", 'YYYY-MM'), ''),
+            COUNT(*),
+            COUNT(*) FILTER (WHERE "downloaded"),
+            COUNT(*) FILTER (WHERE "error"),
+            COUNT(*) FILTER (WHERE "not_exists"),
+            CURRENT_TIMESTAMP
+        FROM "download_links" GROUP BY 1, 2;
+        """,
+    ),
+    (
+        6,
+        "stored duplicate lookup by size",
+        """
+        CREATE INDEX IF NOT EXISTS "idx_download_li_content_634a51"
+            ON "download_links" ("content_size");
+        """,
+    ),
+)
+
+CREATE_TABLE: str = """
+CREATE TABLE IF NOT EXISTS "schema_migrations" (
+    "version" INT NOT NULL PRIMARY KEY,
+    "name" VARCHAR(255) NOT NULL,
+    "applied" TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+async def apply_migrations(connection: BaseDBAsyncClient) -> List[int]:
+    """
+    Apply migrations missing in database, each in its own transaction
+    :return: versions applied now
+    """
+    await connection.execute_script(CREATE_TABLE)
+    rows: List[dict] = await connection.execute_query_dict(
+        'SELECT "version" FROM "schema_migrations"'
+    )
+    done: Set[int] = {row["version"] for row in rows}
+
+    applied: List[int] = []
+    for version, name, sql in MIGRATIONS:
+        if version in done:
+            continue
+        async with in_transaction(connection.connection_name) as transaction:
+            await transaction.execute_script(sql)
+            await transaction.execute_query(
+                'INSERT INTO "schema_migrations" ("version", "name") VALUES ($1, $2)',
+                [version, name],
+            )
+        logger.info(f"Applied migration {version}: {name}")
+        applied.append(version)
+    return applied
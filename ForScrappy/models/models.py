@@ -63,6 +63,9 @@ class DownloadLinks(BaseModel):
     download_link = fields.CharField(
         max_length=2000, null=True, blank=True, description="Direct download link"
     )
+    download_link_expires = fields.DatetimeField(
+        null=True, blank=True, description="Direct download link expiry date"
+    )
     downloaded = fields.BooleanField(
         default=False, description="State saying if file is download or not"
     )
@@ -90,6 +93,42 @@ class DownloadLinks(BaseModel):
     invalid_download_link = fields.BooleanField(
         default=False, description="If link is not valid, set to True"
     )
+    download_offset = fields.BigIntField(
+        default=0, description="Bytes of partially downloaded file"
+    )
+    lease_owner = fields.CharField(
+        max_length=255,
+        null=True,
+        blank=True,
+        description="Runner which claimed the link for processing",
+    )
+    lease_expires = fields.DatetimeField(
+        null=True, blank=True, index=True, description="Claim expiry date"
+    )
+    source_hash = fields.CharField(
+        max_length=255,
+        null=True,
+        blank=True,
+        index=True,
+        description="Upload ID of file on hosting page (Kraken data-file-hash). "
+        "Every upload of the same file gets a new one, so it isn't a content hash",
+    )
+    content_hash = fields.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        index=True,
+        description="sha256 of downloaded file",
+    )
+    content_size = fields.BigIntField(
+        null=True, blank=True, index=True, description="Size of downloaded file"
+    )
+    stored_path = fields.CharField(
+        max_length=2000,
+        null=True,
+        blank=True,
+        description="Path of downloaded file relative to download directory",
+    )
 
     created = fields.DatetimeField(auto_now_add=True)
 
@@ -103,3 +142,69 @@ class DownloadLinks(BaseModel):
     @property
     def __dict__(self):
         return {**super().__dict__, "pk": self.pk}
+
+
+class DownloadLinksStats(BaseModel):
+    category = fields.CharField(
+        max_length=20, default="", description="Category of counted links"
+    )
+    published_month = fields.CharField(
+        max_length=7,
+        default="",
+        description="Published month in YYYY-MM format, empty if unknown",
+    )
+    total = fields.IntField(default=0, description="Number of links")
+    downloaded = fields.IntField(default=0, description="Number of downloaded links")
+    error = fields.IntField(default=0, description="Number of links with errors")
+    not_exists = fields.IntField(
+        default=0, description="Number of links not existing on server"
+    )
+
+    updated = fields.DatetimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Stats: {self.category} {self.published_month}"
+
+    class Meta:
+        table = "download_links_stats"
+        abstract = False
+        unique_together = (("category", "published_month"),)
+
+
+class DownloadManifest(BaseModel):
+    path = fields.CharField(
+        max_length=2000,
+        unique=True,
+        description="Path of file relative to download directory",
+    )
+    size = fields.BigIntField(description="File size in bytes")
+    mtime = fields.FloatField(description="File modification time")
+    content_hash = fields.CharField(
+        max_length=64, null=True, blank=True, description="sha256 of file, if known"
+    )
+
+    scanned = fields.DatetimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Manifest: {self.path}"
+
+    class Meta:
+        table = "download_manifest"
+        abstract = False
+
+
+class CrawlCheckpoint(BaseModel):
+    category = fields.CharField(max_length=20, description="Crawled category")
+    kind = fields.CharField(max_length=10, description="Frontier item: page or thread")
+    url = fields.CharField(max_length=2000, description="Forum page or thread url")
+    done = fields.BooleanField(default=False, description="Item is crawled")
+
+    created = fields.DatetimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Checkpoint: {self.category} {self.kind} {self.url}"
+
+    class Meta:
+        table = "crawl_checkpoint"
+        abstract = False
+        unique_together = (("category", "kind", "url"),)
@@ -1,10 +1,28 @@
 import abc
+import asyncio
+import os
+from datetime import datetime, timedelta
 from logging import Logger
-from typing import List, Optional, Tuple, Type, TypeVar, Generic
+from pathlib import Path
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+    Generic,
+)
 
 from mypy.checkstrformat import Union
-from tortoise.exceptions import DoesNotExist
+from tortoise.exceptions import DoesNotExist, IntegrityError
+from tortoise.expressions import F, Q
 from tortoise.queryset import QuerySet
+from tortoise.transactions import in_transaction
 
 from models.entities import (
     LinkModelPydantic,
@@ -12,8 +30,16 @@ from models.entities import (
     DownloadLinkPydantic,
     LinksModelPydantic,
 )
-from models.models import LinkModel, DownloadLinks
+from models.models import (
+    CrawlCheckpoint,
+    LinkModel,
+    DownloadLinks,
+    DownloadLinksStats,
+    DownloadManifest,
+)
 from logger import get_module_logger
+from tasks.writer import hash_file
+from utils.metrics import cache_lookup, instrument_repo
 
 logger: Logger = get_module_logger("db_repo")
 
@@ -75,7 +101,48 @@ class BaseRepo(abc.ABC, Generic[PydanticTypeVar]):
         """Get all model instances from DB"""
         raise NotImplementedError
 
-
+    async def values_list(
+        self, *fields: str, batch_size: int = 1000, **kwargs
+    ) -> AsyncIterator[Tuple[Any, ...]]:
+        """
+        Stream only the given columns of filtered rows as tuples. Rows are fetched
+        in primary key ordered batches, so no model or pydantic object is built
+        :param fields: column names to select
+        :param batch_size: number of rows fetched per query
+        :param kwargs: filter arguments
+        :return: AsyncIterator of tuples with values in `fields` order
+        """
+        last_pk: int = 0
+
+        while True:
+            rows: List[Tuple[Any, ...]] = (
+                await self.model.filter(id__gt=last_pk, **kwargs)
+                .order_by("id")
+                .limit(batch_size)
+                .values_list("id", *fields)
+            )
+            for row in rows:
+                yield tuple(row[1:])
+
+            if len(rows) < batch_size:
+                return
+            last_pk = rows[-1][0]
+
+    async def values(
+        self, *fields: str, batch_size: int = 1000, **kwargs
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Stream only the given columns of filtered rows as dictionaries
+        :param fields: column names to select
+        :param batch_size: number of rows fetched per query
+        :param kwargs: filter arguments
+        :return: AsyncIterator of dictionaries with `fields` as keys
+        """
+        async for row in self.values_list(*fields, batch_size=batch_size, **kwargs):
+            yield dict(zip(fields, row))
+
+
+@instrument_repo
 class LinkModelRepo(BaseRepo):
     model = LinkModel
 
@@ -123,7 +190,9 @@ class LinkModelRepo(BaseRepo):
     async def all(self) -> PydanticTypeVar:
         """Get all model instances from DB"""
         res: List[LinkModel] = await self.model.all()
-        return LinksModelPydantic(__root__=res)  # type: ignore
+        return LinksModelPydantic(  # type: ignore
+            __root__=[LinkModelPydantic(**element.__dict__) for element in res]
+        )
 
     async def update_fields(self, obj: PydanticTypeVar, **kwargs) -> None:
 
@@ -144,20 +213,148 @@ class LinkModelRepo(BaseRepo):
         logger.info(f"Object updated: {obj.pk}")
 
 
+@instrument_repo
+class DownloadLinksStatsRepo:
+    """
+    Keeps per category and published month counters of DownloadLinks up to date.
+    DownloadLinksRepo write paths report every row state change, so reading stats
+    never needs to scan download_links table
+    """
+
+    model: Type[DownloadLinksStats] = DownloadLinksStats
+    counters: Tuple[str, ...] = ("downloaded", "error", "not_exists")
+
+    @classmethod
+    def snapshot(cls, instance: DownloadLinks) -> Dict[str, Any]:
+        """Return counted state of DownloadLinks instance"""
+        published_date: Optional[datetime] = instance.published_date
+        return {
+            "category": instance.category or "",
+            "published_month": published_date.strftime("%Y-%m")
+            if published_date
+            else "",
+            **{counter: bool(getattr(instance, counter)) for counter in cls.counters},
+        }
+
+    @classmethod
+    def _deltas(
+        cls, old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]
+    ) -> Dict[Tuple[str, str], Dict[str, int]]:
+        """Calculate counter changes per (category, published_month) bucket"""
+        deltas: Dict[Tuple[str, str], Dict[str, int]] = {}
+
+        for state, sign in ((old, -1), (new, 1)):
+            if not state:
+                continue
+            bucket: Dict[str, int] = deltas.setdefault(
+                (state["category"], state["published_month"]),
+                {"total": 0, **{counter: 0 for counter in cls.counters}},
+            )
+            bucket["total"] += sign
+            for counter in cls.counters:
+                if state[counter]:
+                    bucket[counter] += sign
+
+        return deltas
+
+    async def track(
+        self, old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]
+    ) -> None:
+        """
+        Apply a row state change to counters
+        :param old: snapshot before change, None for a new row
+        :param new: snapshot after change, None for a deleted row
+        :return: None
+        """
+        if old == new:
+            return
+
+        for (category, month), delta in self._deltas(old, new).items():
+            changed: Dict[str, int] = {k: v for k, v in delta.items() if v}
+            if not changed:
+                continue
+
+            key: Dict[str, str] = {"category": category, "published_month": month}
+            updates: Dict[str, Any] = {k: F(k) + v for k, v in changed.items()}
+
+            if await self.model.filter(**key).update(**updates):
+                continue
+            values: Dict[str, Any] = {**key, **delta}
+            try:
+                await self.model.create(**values)
+            except IntegrityError:
+                await self.model.filter(**key).update(**updates)
+
+    async def rebuild(self) -> None:
+        """Recalculate all counters from download_links table"""
+        query: str = (
+            "SELECT COALESCE(category, '') AS category, "
+            "COALESCE(to_char(published_date, 'YYYY-MM'), '') AS published_month, "
+            "COUNT(*) AS total, "
+            "COUNT(*) FILTER (WHERE downloaded) AS downloaded, "
+            "COUNT(*) FILTER (WHERE error) AS error, "
+            "COUNT(*) FILTER (WHERE not_exists) AS not_exists "
+            f'FROM "{DownloadLinks._meta.db_table}" GROUP BY 1, 2'
+        )
+        async with in_transaction() as connection:
+            rows: List[dict] = await connection.execute_query_dict(query)
+            await self.model.all().using_db(connection).delete()
+            await self.model.bulk_create(
+                [self.model(**row) for row in rows], using_db=connection
+            )
+        logger.info(f"Stats rebuilt: {len(rows)} buckets")
+
+    async def summary(self) -> Dict[str, Any]:
+        """Return totals and counters per category and published month"""
+        empty: Dict[str, int] = {"total": 0, **{c: 0 for c in self.counters}}
+        result: Dict[str, Any] = {
+            "total": dict(empty),
+            "category": {},
+            "published_month": {},
+        }
+
+        rows: List[dict] = await self.model.all().values(
+            "category", "published_month", "total", *self.counters
+        )
+        for row in rows:
+            for bucket in (
+                result["total"],
+                result["category"].setdefault(row["category"], dict(empty)),
+                result["published_month"].setdefault(
+                    row["published_month"], dict(empty)
+                ),
+            ):
+                for counter in empty:
+                    bucket[counter] += row[counter]
+
+        return result
+
+
+@instrument_repo
 class DownloadLinksRepo(BaseRepo):
     model: Type[DownloadLinks] = DownloadLinks
     link_model: Type[LinkModel] = LinkModel
+    stats_repo: DownloadLinksStatsRepo = DownloadLinksStatsRepo()
+    notify_channel: str = "download_links_created"
 
     async def update_fields(self, obj: PydanticTypeVar, **kwargs) -> None:
 
         assert isinstance(obj, DownloadLinkPydantic)
+        assert obj.pk is not None
+
+        await self.update_by_pk(obj.pk, **kwargs)
+
+    async def update_by_pk(self, pk: int, **kwargs) -> None:
+        """Update fields of DownloadLinks object with given id"""
 
         try:
-            model_instance: DownloadLinks = await self.model.get(pk=obj.pk)
+            model_instance: DownloadLinks = await self.model.get(pk=pk)
         except DoesNotExist as e:
-            logger.error(f"Object with id {obj.pk} doesn't exist")
+            logger.error(f"Object with id {pk} doesn't exist")
             raise e
 
+        old_state: Dict[str, Any] = self.stats_repo.snapshot(model_instance)
+
         for key, value in kwargs.items():
             if key != "link_model":
                 try:
@@ -166,7 +363,8 @@ class DownloadLinksRepo(BaseRepo):
                     logger.error(f"Attribute {key} doesn't exist")
 
         await model_instance.save()
-        logger.info(f"Object updated: {obj.pk}")
+        await self.stats_repo.track(old_state, self.stats_repo.snapshot(model_instance))
+        logger.info(f"Object updated: {pk}")
 
     @staticmethod
     async def get_link_model_pydantic(link_model_id: int) -> dict:
@@ -186,6 +384,7 @@ class DownloadLinksRepo(BaseRepo):
             link=obj.link
         ).first()
         if obj_instance:
+            old_state: Dict[str, Any] = self.stats_repo.snapshot(obj_instance)
             for key, val in obj.dict().items():
                 if not isinstance(
                     getattr(obj_instance, key), QuerySet
@@ -193,6 +392,9 @@ class DownloadLinksRepo(BaseRepo):
                     setattr(obj_instance, key, val)
             await obj_instance.save()
             await obj_instance.refresh_from_db()
+            await self.stats_repo.track(
+                old_state, self.stats_repo.snapshot(obj_instance)
+            )
 
         link_model_id: Optional[int] = obj_instance.__dict__.get("link_model_id")
 
@@ -243,16 +445,113 @@ class DownloadLinksRepo(BaseRepo):
 
         return return_object, created  # type: ignore
 
+    async def claim(
+        self,
+        owner: str,
+        limit: int,
+        lease_seconds: int,
+        pks: Optional[List[int]] = None,
+        after: int = 0,
+    ) -> Optional[PydanticTypeVar]:
+        """
+        Lease not downloaded links to given owner. Rows locked by concurrent claims
+        are skipped (FOR UPDATE SKIP LOCKED), rows with expired lease are claimed again
+        :param owner: unique runner identifier
+        :param limit: max number of links to claim
+        :param lease_seconds: lease duration
+        :param pks: claim only links with given ids
+        :param after: claim only links with greater id. Rows are claimed in id
+            order, so a run passes its last claimed id and doesn't get rows it
+            already handled back once their lease expires
+        :return: claimed links or None
+        """
+        now: datetime = datetime.now()
+
+        async with in_transaction() as connection:
+            query: QuerySet[DownloadLinks] = self.model.filter(
+                Q(lease_expires__isnull=True) | Q(lease_expires__lt=now),
+                downloaded=False,
+                id__gt=after,
+            )
+            if pks is not None:
+                query = query.filter(id__in=pks)
+
+            rows: List[DownloadLinks] = (
+                await query.order_by("id")
+                .limit(limit)
+                .select_for_update(skip_locked=True)
+                .using_db(connection)
+            )
+            if not rows:
+                return None
+
+            claimed: List[int] = [row.pk for row in rows]
+            await self.model.filter(id__in=claimed).using_db(connection).update(
+                lease_owner=owner,
+                lease_expires=now + timedelta(seconds=lease_seconds),
+            )
+
+        logger.info(f"{owner} claimed {len(claimed)} links")
+        return await self.filter(id__in=claimed)  # type: ignore
+
+    async def get_stored_duplicate(
+        self, file_name: str, size: int, exclude_pk: Optional[int] = None
+    ) -> Optional[str]:
+        """
+        Find downloaded link of a file with the same name and exact size, so it
+        can be linked before the body of a new download is read
+        :param file_name: name of file served by hosting
+        :param size: Content-Length of file
+        :param exclude_pk: id of link looking for duplicate
+        :return: content_hash of stored file or None
+        """
+        query: QuerySet[DownloadLinks] = self.model.filter(
+            Q(stored_path=file_name) | Q(stored_path__endswith=f"/{file_name}"),
+            content_size=size,
+            downloaded=True,
+            content_hash__isnull=False,
+        )
+        if exclude_pk is not None:
+            query = query.exclude(id=exclude_pk)
+
+        rows: List[Any] = (
+            await query.order_by("id").limit(1).values_list("content_hash", flat=True)
+        )
+        return rows[0] if rows else None
+
+    async def mark_present_downloaded(self) -> int:
+        """
+        Mark links whose file is listed in download manifest as downloaded,
+        in one query. Links saved before stored_path existed are matched on
+        date folder and name, like get_folder_name_from_date builds it.
+        Counters are rebuilt afterwards
+        :return: number of marked links
+        """
+        expected_path: str = (
+            "COALESCE(link.stored_path, "
+            "to_char(link.published_date, 'FMYYYY/FMMM/') || link.name)"
+        )
+        query: str = (
+            f'UPDATE "{self.model._meta.db_table}" AS link '
+            "SET downloaded = TRUE, downloaded_date = NOW(), download_offset = 0, "
+            "stored_path = file.path "
+            f'FROM "{DownloadManifest._meta.db_table}" AS file '
+            f"WHERE NOT link.downloaded AND file.path = {expected_path} "
+            "AND (link.content_size IS NULL OR link.content_size = file.size)"
+        )
+        marked: int
+        marked, _ = await self.model._meta.db.execute_query(query)
+        if marked:
+            await self.stats_repo.rebuild()
+        logger.info(f"{marked} links marked as downloaded from manifest")
+        return marked
+
     async def all(self) -> PydanticTypeVar:
         """Get all model instances from DB"""
         res: List[DownloadLinks] = await self.model.all()
-
-        result: List[dict] = []
-        for element in res:
-            element_dict = await element.to_dict()
-            result.append(element_dict)
-
-        return DownloadLinksPydantic(__root__=result)  # type: ignore
+        return DownloadLinksPydantic(  # type: ignore
+            __root__=await self._to_pydantic(res)
+        )
 
     async def create(self, obj: PydanticTypeVar) -> PydanticTypeVar:
         """Override create method to create link_model if it doesn't exist."""
@@ -267,6 +566,10 @@ class DownloadLinksRepo(BaseRepo):
         new_object_data: dict = {**obj.dict(), "link_model": link_model}
         new_object_data.pop("pk")
         res: DownloadLinks = await self.model.create(**new_object_data)
+        await self.stats_repo.track(None, self.stats_repo.snapshot(res))
+        await self.model._meta.db.execute_query(
+            "SELECT pg_notify($1, $2)", [self.notify_channel, str(res.pk)]
+        )
 
         logger.info(f"Object {self.model.__name__} with id {res.pk} created")
         res_dict: dict = await res.to_dict()
@@ -275,14 +578,209 @@ class DownloadLinksRepo(BaseRepo):
 
     async def filter(self, **kwargs) -> Optional[PydanticTypeVar]:  # type: ignore
         result: List[DownloadLinks] = await self.model.filter(**kwargs)
-        pydantic_list: list[DownloadLinkPydantic] = []
         if result:
-            for element in result:
-                link_object: dict = await self.get_link_model_pydantic(
-                    element.__dict__.get("link_model_id")
-                )
-                element_dict: dict = {**element.__dict__, "link_model": link_object}
-                pydantic_list.append(DownloadLinkPydantic(**element_dict))
-            if pydantic_list:
-                return DownloadLinksPydantic(__root__=pydantic_list)  # type: ignore
+            return DownloadLinksPydantic(  # type: ignore
+                __root__=await self._to_pydantic(result)
+            )
         return None
+
+    async def _to_pydantic(
+        self, instances: List[DownloadLinks]
+    ) -> List[DownloadLinkPydantic]:
+        """
+        Build pydantic objects of DownloadLinks instances. LinkModels of all
+        instances are fetched in one query
+        """
+        link_model_ids: Set[int] = {
+            instance.__dict__["link_model_id"] for instance in instances
+        }
+        link_models: Dict[int, dict] = {
+            link_model.pk: LinkModelPydantic(**link_model.__dict__).dict()
+            for link_model in await self.link_model.filter(id__in=list(link_model_ids))
+        }
+
+        pydantic_list: List[DownloadLinkPydantic] = []
+        for instance in instances:
+            link_object: Optional[dict] = link_models.get(
+                instance.__dict__["link_model_id"]
+            )
+            if not link_object:
+                raise ValueError("LinkModel with given id doesn't exist")
+            element_dict: dict = {**instance.__dict__, "link_model": link_object}
+            pydantic_list.append(DownloadLinkPydantic(**element_dict))
+        return pydantic_list
+
+
+@instrument_repo
+class DownloadManifestRepo:
+    """
+    Index of files in download directory: path, size, mtime and optional hash.
+    Links whose file is listed are not downloaded again, even if DB got out
+    of sync with disk. Scans are incremental, only new and changed files are written
+    """
+
+    model: Type[DownloadManifest] = DownloadManifest
+    skipped_directories: Tuple[str, ...] = (".blobs",)
+    skipped_suffixes: Tuple[str, ...] = (".part", ".link")
+
+    @classmethod
+    def walk(cls, root: Path) -> Iterator[Tuple[str, int, float]]:
+        """
+        Yield relative path, size and mtime of every file under root.
+        os.scandir is used, so file type and stat come with directory listing
+        """
+        directories: List[str] = [str(root)]
+
+        while directories:
+            directory: str = directories.pop()
+            try:
+                entries = os.scandir(directory)
+            except OSError as e:
+                logger.error(f"Cannot scan {directory}: {e}")
+                continue
+
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in cls.skipped_directories:
+                            directories.append(entry.path)
+                    elif entry.is_file() and not entry.name.endswith(
+                        cls.skipped_suffixes
+                    ):
+                        stat: os.stat_result = entry.stat()
+                        yield os.path.relpath(
+                            entry.path, root
+                        ), stat.st_size, stat.st_mtime
+
+    async def scan(
+        self, root: Path, with_hash: bool = False, batch_size: int = 1000
+    ) -> Dict[str, int]:
+        """
+        Bring manifest up to date with download directory
+        :param root: download directory
+        :param with_hash: calculate sha256 of new and changed files
+        :param batch_size: number of rows written per query
+        :return: number of files in total, changed and removed
+        """
+        files: Dict[str, Tuple[int, float]] = {
+            path: (size, mtime)
+            for path, size, mtime in await asyncio.to_thread(
+                lambda: list(self.walk(root))
+            )
+        }
+        indexed: Dict[str, Tuple[int, float]] = {
+            path: (size, mtime)
+            for path, size, mtime in await self.model.all().values_list(
+                "path", "size", "mtime"
+            )
+        }
+        changed: List[str] = [
+            path for path, state in files.items() if indexed.get(path) != state
+        ]
+        removed: List[str] = [path for path in indexed if path not in files]
+
+        for start in range(0, len(removed), batch_size):
+            await self.model.filter(
+                path__in=removed[start : start + batch_size]
+            ).delete()
+
+        for start in range(0, len(changed), batch_size):
+            batch: List[str] = changed[start : start + batch_size]
+            hashes: Dict[str, str] = {}
+            if with_hash:
+                for path in batch:
+                    hashes[path] = await asyncio.to_thread(hash_file, root / path)
+
+            async with in_transaction() as connection:
+                await self.model.filter(path__in=batch).using_db(connection).delete()
+                await self.model.bulk_create(
+                    [
+                        self.model(
+                            path=path,
+                            size=files[path][0],
+                            mtime=files[path][1],
+                            content_hash=hashes.get(path),
+                        )
+                        for path in batch
+                    ],
+                    using_db=connection,
+                )
+
+        logger.info(
+            f"Manifest scanned: {len(files)} files, {len(changed)} changed, "
+            f"{len(removed)} removed"
+        )
+        return {"total": len(files), "changed": len(changed), "removed": len(removed)}
+
+    async def add(
+        self, path: str, size: int, mtime: float, content_hash: Optional[str] = None
+    ) -> None:
+        """Add or update one file of manifest, e.g. right after its download"""
+        await self.model.update_or_create(
+            defaults={"size": size, "mtime": mtime, "content_hash": content_hash},
+            path=path,
+        )
+
+    async def is_present(self, path: str, size: Optional[int] = None) -> bool:
+        """
+        Check if file is listed in manifest
+        :param path: path relative to download directory
+        :param size: expected size, not checked if None
+        """
+        query: QuerySet[DownloadManifest] = self.model.filter(path=path)
+        if size is not None:
+            query = query.filter(size=size)
+        return cache_lookup("manifest", await query.exists())
+
+
+@instrument_repo
+class CrawlCheckpointRepo:
+    """
+    Crawl frontier of a category: forum pages done, threads pending and done.
+    Interrupted crawl is resumed from it
+    """
+
+    model: Type[CrawlCheckpoint] = CrawlCheckpoint
+    PAGE: str = "page"
+    THREAD: str = "thread"
+
+    async def add_threads(self, category: str, urls: List[str]) -> None:
+        """Add pending threads, threads already in frontier are left unchanged"""
+        await self.model.bulk_create(
+            [
+                self.model(category=category, kind=self.THREAD, url=url)
+                for url in set(urls)
+            ],
+            ignore_conflicts=True,
+        )
+
+    async def mark_done(self, category: str, kind: str, urls: List[str]) -> None:
+        """Mark pages or threads as crawled"""
+        await self.model.bulk_create(
+            [
+                self.model(category=category, kind=kind, url=url, done=True)
+                for url in set(urls)
+            ],
+            on_conflict=("category", "kind", "url"),
+            update_fields=("done",),
+        )
+
+    async def get_frontier(self, category: str) -> Tuple[Set[str], List[str]]:
+        """
+        :return: urls of pages done and of threads pending
+        """
+        query: QuerySet[CrawlCheckpoint] = self.model.filter(category=category)
+        rows: List[Tuple[str, str, bool]] = await query.values_list(
+            "kind", "url", "done"
+        )  # type: ignore
+        pages_done: Set[str] = {
+            url for kind, url, done in rows if kind == self.PAGE and done
+        }
+        threads_pending: List[str] = [
+            url for kind, url, done in rows if kind == self.THREAD and not done
+        ]
+        return pages_done, threads_pending
+
+    async def clear(self, category: str) -> None:
+        """Discard checkpoint of category"""
+        await self.model.filter(category=category).delete()
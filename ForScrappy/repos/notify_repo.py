@@ -0,0 +1,120 @@
+import asyncio
+from logging import Logger
+from typing import Any, AsyncIterator, List, Optional
+
+import asyncpg
+
+from logger import get_module_logger
+from repos.db_repo import DownloadLinksRepo
+from settings import settings
+from utils.utils import get_db_connections
+
+logger: Logger = get_module_logger("notify_repo")
+
+
+class DownloadLinksListener:
+    """
+    Listen for Postgres notifications sent when DownloadLinks are created.
+    Notifications arriving close to each other are grouped into one batch
+    """
+
+    def __init__(
+        self,
+        channel: str = DownloadLinksRepo.notify_channel,
+        batch_size: int = settings.download_queue.batch_size,
+        batch_window: float = settings.download_queue.notify_window,
+        health_check_interval: float = 30.0,
+        reconnect_delay: float = settings.download_queue.reconnect_delay,
+        reconnect_max_delay: float = settings.download_queue.reconnect_max_delay,
+    ) -> None:
+        self.channel: str = channel
+        self.batch_size: int = batch_size
+        self.batch_window: float = batch_window
+        self.health_check_interval: float = health_check_interval
+        self.reconnect_delay: float = reconnect_delay
+        self.reconnect_max_delay: float = reconnect_max_delay
+        self.queue: asyncio.Queue[int] = asyncio.Queue()
+        self.connection: Optional[asyncpg.Connection] = None
+
+    def _on_notification(
+        self, connection: Any, pid: int, channel: str, payload: object
+    ) -> None:
+        """asyncpg listener callback. Payload is DownloadLinks id"""
+        try:
+            self.queue.put_nowait(int(str(payload)))
+        except ValueError:
+            logger.error(f"Wrong notification payload on {channel}: {payload}")
+
+    async def _connect(self) -> None:
+        credentials: dict = get_db_connections()["connections"]["default"][
+            "credentials"
+        ]
+        connection: asyncpg.Connection = await asyncpg.connect(**credentials)
+        await connection.add_listener(self.channel, self._on_notification)
+        self.connection = connection
+
+    async def __aenter__(self) -> "DownloadLinksListener":
+        """Open dedicated connection and start listening"""
+        await self._connect()
+        logger.info(f"Listening on channel {self.channel}")
+        return self
+
+    async def reconnect(self) -> None:
+        """
+        Replace lost connection, retrying with exponential backoff until database
+        is back. Notifications sent while disconnected are lost
+        """
+        if self.connection:
+            self.connection.terminate()
+            self.connection = None
+
+        delay: float = self.reconnect_delay
+        while True:
+            try:
+                await self._connect()
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.error(f"Cannot reconnect, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max_delay)
+            else:
+                logger.info(f"Reconnected to channel {self.channel}")
+                return
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        """Stop listening and close connection"""
+        if self.connection and not self.connection.is_closed():
+            await self.connection.remove_listener(self.channel, self._on_notification)
+            await self.connection.close()
+        self.connection = None
+
+    async def _get(self, timeout: float) -> int:
+        return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+
+    async def batches(self) -> AsyncIterator[List[int]]:
+        """
+        Yield lists of created DownloadLinks ids. A batch is closed when it is full
+        or when batch_window seconds passed since its first notification
+        """
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+        while True:
+            try:
+                first: int = await self._get(self.health_check_interval)
+            except asyncio.TimeoutError:
+                if not self.connection or self.connection.is_closed():
+                    raise ConnectionError("Listener connection is closed")
+                continue
+
+            batch: List[int] = [first]
+            deadline: float = loop.time() + self.batch_window
+
+            while len(batch) < self.batch_size:
+                timeout: float = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await self._get(timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            yield batch
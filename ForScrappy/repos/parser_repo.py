@@ -45,6 +45,11 @@ class BaseParser:
     async def get_download_link(self, page_link: str) -> Optional[Dict]:
         raise NotImplementedError
 
+    @classmethod
+    def get_download_headers(cls) -> Dict[str, str]:
+        """Headers required to download file from direct download link"""
+        return dict(cls._kraken_headers)
+
     @staticmethod
     async def parse_date(tag_element: List[Tag]) -> Optional[datetime]:
         raise NotImplementedError
@@ -311,6 +316,7 @@ class KrakenParser(BaseParser):
             "headers": self._kraken_headers,
             "published_date": date,
             "name": name,
+            "source_hash": dl_hash,
         }
 
 
@@ -0,0 +1,338 @@
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+from logging import Logger
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set
+
+from redis.asyncio import Redis
+
+from logger import get_module_logger
+from settings import settings
+
+logger: Logger = get_module_logger("redis_repo")
+
+
+# Acquire and take scripts read current limit from limits hash, so a change made with
+# `python cli.py download-budget` is used by all workers on their next call.
+# Redis server time is used, so clocks of workers don't have to be in sync.
+
+ACQUIRE_SCRIPT: str = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[1]))
+local limit = tonumber(redis.call('HGET', KEYS[2], ARGV[2])) or tonumber(ARGV[3])
+if limit > 0 and redis.call('ZCARD', KEYS[1]) >= limit then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+REFRESH_SCRIPT: str = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return redis.call('ZADD', KEYS[1], 'XX', 'CH', now, ARGV[2])
+"""
+
+TAKE_SCRIPT: str = """
+local rate = tonumber(redis.call('HGET', KEYS[2], ARGV[2])) or tonumber(ARGV[3])
+if rate <= 0 then
+    return 0
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local capacity = rate * tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate) - tonumber(ARGV[1])
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+if tokens >= 0 then
+    return 0
+end
+return math.ceil(-tokens / rate * 1000)
+"""
+
+
+def get_redis() -> Redis:
+    """Redis client for celery broker database"""
+    return Redis.from_url(settings.celery.broker_url)
+
+
+async def queue_lengths(
+    names: Iterable[str], redis: Optional[Redis] = None
+) -> Dict[str, int]:
+    """Number of messages waiting in celery queues, kept as lists by redis broker"""
+    names = list(names)
+    client: Redis = redis or get_redis()
+    try:
+        async with client.pipeline(transaction=False) as pipe:
+            for name in names:
+                pipe.llen(name)
+            lengths: List[int] = await pipe.execute()
+    finally:
+        if redis is None:
+            await client.close()
+    return dict(zip(names, lengths))
+
+
+class RedisSemaphore:
+    """
+    Semaphore shared by all processes using the same Redis key.
+    Holders are kept in a sorted set scored with time of last refresh,
+    slots of crashed holders are freed after ttl seconds
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        key: str,
+        limits_key: str,
+        limit_field: str,
+        default_limit: int,
+        ttl: int = settings.download_budget.slot_ttl,
+        poll_interval: float = settings.download_budget.poll_interval,
+    ) -> None:
+        self.redis: Redis = redis
+        self.key: str = key
+        self.limits_key: str = limits_key
+        self.limit_field: str = limit_field
+        self.default_limit: int = default_limit
+        self.ttl: int = ttl
+        self.poll_interval: float = poll_interval
+        self._acquire = redis.register_script(ACQUIRE_SCRIPT)
+        self._refresh = redis.register_script(REFRESH_SCRIPT)
+
+    async def try_acquire(self) -> Optional[str]:
+        """
+        Take a slot if one is free
+        :return: token of taken slot or None
+        """
+        token: str = uuid.uuid4().hex
+        acquired: int = await self._acquire(
+            keys=[self.key, self.limits_key],
+            args=[self.ttl, self.limit_field, self.default_limit, token],
+        )
+        return token if acquired else None
+
+    async def acquire(self) -> str:
+        """Wait for a free slot and take it"""
+        while True:
+            token: Optional[str] = await self.try_acquire()
+            if token:
+                return token
+            await asyncio.sleep(self.poll_interval)
+
+    async def refresh(self, token: str) -> bool:
+        """Extend slot lifetime. Returns False if slot already expired"""
+        return bool(await self._refresh(keys=[self.key], args=[self.ttl, token]))
+
+    async def release(self, token: str) -> None:
+        await self.redis.zrem(self.key, token)
+
+    async def _keep_alive(self, token: str) -> None:
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            if not await self.refresh(token):
+                logger.warning(f"Slot of {self.key} expired before release")
+
+    @asynccontextmanager
+    async def hold(self) -> AsyncIterator[str]:
+        """Hold a slot, refreshing it in background, until block exits"""
+        token: str = await self.acquire()
+        keep_alive: asyncio.Task = asyncio.create_task(self._keep_alive(token))
+        try:
+            yield token
+        finally:
+            keep_alive.cancel()
+            await asyncio.shield(self.release(token))
+
+
+class TokenBucket:
+    """
+    Token bucket shared by all processes using the same Redis key.
+    Takes never fail; a caller going over the rate is told how long to wait
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        key: str,
+        limits_key: str,
+        rate_field: str,
+        default_rate: int,
+        burst: float = settings.download_budget.burst,
+    ) -> None:
+        self.redis: Redis = redis
+        self.key: str = key
+        self.limits_key: str = limits_key
+        self.rate_field: str = rate_field
+        self.default_rate: int = default_rate
+        self.burst: float = burst
+        self._take = redis.register_script(TAKE_SCRIPT)
+
+    async def take(self, amount: int) -> float:
+        """
+        Take amount of tokens from bucket
+        :return: seconds to wait before using them
+        """
+        wait_ms: int = await self._take(
+            keys=[self.key, self.limits_key],
+            args=[amount, self.rate_field, self.default_rate, self.burst],
+        )
+        return wait_ms / 1000
+
+    async def throttle(self, amount: int) -> None:
+        """Take amount of tokens and wait until they can be used"""
+        wait: float = await self.take(amount)
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class DownloadBudget:
+    """
+    Download limits shared by all workers: number of concurrent transfers
+    per host and total bandwidth in bytes per second
+    """
+
+    LIMIT_FIELDS: tuple = ("transfers_per_host", "bandwidth")
+
+    def __init__(
+        self,
+        redis: Optional[Redis] = None,
+        key_prefix: str = settings.download_budget.key_prefix,
+        transfers_per_host: int = settings.download_budget.transfers_per_host,
+        bandwidth: int = settings.download_budget.bandwidth,
+    ) -> None:
+        self.redis: Redis = redis or get_redis()
+        self.key_prefix: str = key_prefix
+        self.defaults: Dict[str, int] = {
+            "transfers_per_host": transfers_per_host,
+            "bandwidth": bandwidth,
+        }
+        self.limits_key: str = f"{key_prefix}:limits"
+        self.bucket: TokenBucket = TokenBucket(
+            redis=self.redis,
+            key=f"{key_prefix}:bandwidth",
+            limits_key=self.limits_key,
+            rate_field="bandwidth",
+            default_rate=bandwidth,
+        )
+        self._semaphores: Dict[str, RedisSemaphore] = {}
+
+    async def close(self) -> None:
+        await self.redis.close()
+
+    async def get_limits(self) -> Dict[str, int]:
+        """Limits in use: runtime overrides merged with defaults from settings"""
+        overrides: Dict[bytes, bytes] = await self.redis.hgetall(self.limits_key)
+        return {
+            **self.defaults,
+            **{key.decode(): int(value) for key, value in overrides.items()},
+        }
+
+    async def set_limits(self, **limits: Optional[int]) -> Dict[str, int]:
+        """
+        Override limits for all workers. None values are left unchanged
+        :return: limits in use
+        """
+        for name in limits:
+            if name not in self.LIMIT_FIELDS:
+                raise ValueError(f"Unknown download limit: {name}")
+
+        values: Dict[str, int] = {
+            name: value for name, value in limits.items() if value is not None
+        }
+        if values:
+            await self.redis.hset(self.limits_key, mapping=values)  # type: ignore
+        return await self.get_limits()
+
+    async def reset_limits(self) -> Dict[str, int]:
+        """Remove runtime overrides and go back to settings"""
+        await self.redis.delete(self.limits_key)
+        return dict(self.defaults)
+
+    def semaphore(self, host: str) -> RedisSemaphore:
+        if host not in self._semaphores:
+            self._semaphores[host] = RedisSemaphore(
+                redis=self.redis,
+                key=f"{self.key_prefix}:transfers:{host}",
+                limits_key=self.limits_key,
+                limit_field="transfers_per_host",
+                default_limit=self.defaults["transfers_per_host"],
+            )
+        return self._semaphores[host]
+
+    @asynccontextmanager
+    async def transfer(self, host: str) -> AsyncIterator[None]:
+        """Hold one of transfers_per_host slots of given host"""
+        async with self.semaphore(host).hold():
+            yield
+
+    async def throttle(self, amount: int) -> None:
+        """Wait until amount of bytes fits in bandwidth limit"""
+        await self.bucket.throttle(amount)
+
+
+class InFlightRegistry:
+    """
+    Markers of DownloadLinks objects dispatched to celery and not finished yet.
+    A marker is set at dispatch, cleared when task ends and expires after ttl
+    in case worker died
+    """
+
+    def __init__(
+        self,
+        redis: Optional[Redis] = None,
+        key_prefix: str = settings.download_queue.in_flight_prefix,
+        ttl: int = settings.download_queue.in_flight_ttl,
+    ) -> None:
+        self.redis: Redis = redis or get_redis()
+        self.key_prefix: str = key_prefix
+        self.ttl: int = ttl
+
+    async def __aenter__(self) -> "InFlightRegistry":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.redis.close()
+
+    def _key(self, pk: int) -> str:
+        return f"{self.key_prefix}:{pk}"
+
+    async def mark(self, pks: Iterable[int]) -> List[int]:
+        """
+        Mark objects as in flight
+        :param pks: ids of DownloadLinks objects
+        :return: ids which weren't in flight already, in given order
+        """
+        pks = list(pks)
+        if not pks:
+            return []
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for pk in pks:
+                pipe.set(self._key(pk), 1, nx=True, ex=self.ttl)
+            results: List[Optional[bool]] = await pipe.execute()
+
+        return [pk for pk, marked in zip(pks, results) if marked]
+
+    async def in_flight(self, pks: Iterable[int]) -> Set[int]:
+        """Return ids of given objects which are in flight"""
+        pks = list(pks)
+        if not pks:
+            return set()
+
+        values: List[Optional[bytes]] = await self.redis.mget(
+            [self._key(pk) for pk in pks]
+        )
+        return {pk for pk, value in zip(pks, values) if value is not None}
+
+    async def clear(self, pks: Iterable[int]) -> None:
+        """Remove markers of given objects"""
+        keys: List[str] = [self._key(pk) for pk in pks]
+        if keys:
+            await self.redis.delete(*keys)
@@ -1,5 +1,9 @@
+import asyncio
+import threading
 from logging import Logger
-from typing import Optional, Type, Dict
+from typing import Any, List, Optional, Type, Dict
+
+from celery import chain, group, signature
 
 from requests import Response, Session
 from requests.cookies import RequestsCookieJar
@@ -8,7 +12,10 @@ from logger import get_module_logger
 from models.entities import DownloadLinksPydantic, LinksModelPydantic
 from models.types import SessionObject
 from repos.parser_repo import ForClubbersParser, ParserType
-from tasks.tasks import download_file
+from repos.redis_repo import InFlightRegistry
+from settings import settings
+from tasks.tasks import download_file, download_files, make_download_batches
+from utils.metrics import PARSE_SECONDS, observe_session
 
 logger: Logger = get_module_logger("request_repo")
 
@@ -17,7 +24,12 @@ class ForClubbersScrapper:
     """Base repo responsible for handling requests"""
 
     def __init__(self, session_obj: Optional[SessionObject] = None) -> None:
-        self.session: Session = Session() if not session_obj else session_obj.session
+        self.session: Session = observe_session(
+            Session() if not session_obj else session_obj.session
+        )
+        # sessions of fetch threads, requests.Session isn't thread-safe
+        self._local: threading.local = threading.local()
+        self._clone_lock: threading.Lock = threading.Lock()
         self.session_headers: dict[str, str] = {}
         self.session_cookies: RequestsCookieJar = RequestsCookieJar()
 
@@ -27,6 +39,23 @@ class ForClubbersScrapper:
 
         self.forum_parser: ForClubbersParser = ForClubbersParser()
 
+    def _thread_session(self) -> Session:
+        """
+        Session of current thread with cookies and headers of logged in session.
+        Fetch threads run at once, so each one has own cookie jar and pool
+        """
+        session: Optional[Session] = getattr(self._local, "session", None)
+        if session is None:
+            session = observe_session(Session())
+            with self._clone_lock:
+                session.cookies.update(self.session.cookies)
+                session.headers.update(self.session.headers)
+            self._local.session = session
+        return session
+
+    def _get(self, url: str, **kwargs: Any) -> Response:
+        return self._thread_session().get(url, **kwargs)
+
     async def __fetch_data_get(self, url: str) -> Response:
         """
         Main method for fetching data
@@ -35,13 +64,40 @@ class ForClubbersScrapper:
         """
 
         logger.info(f"Started parsing {url}")
-        response: Response = self.session.get(
-            url=url, cookies=self.session_cookies, headers=self.session_headers
+        # blocking request runs in a thread, so concurrent fetches overlap
+        response: Response = await asyncio.to_thread(
+            self._get,
+            url=url,
+            cookies=self.session_cookies,
+            headers=self.session_headers,
         )
         response.raise_for_status()
         logger.info("Success")
         return response
 
+    async def fetch_thread(self, link: str) -> Response:
+        """
+        Fetch html of specific forum thread
+        :param link: str: url of thread
+        :return: Response
+        """
+        return await self.__fetch_data_get(link)
+
+    async def parse_thread(
+        self, response: Response, link: str, category: str
+    ) -> DownloadLinksPydantic:
+        """
+        Parse download links from fetched forum thread
+        :param response: Response: fetched thread
+        :param link: str: url of thread
+        :param category: str: category name
+        :return: DownloadLinksPydantic
+        """
+        with PARSE_SECONDS.labels(page="thread").time():
+            return await self.forum_parser.parse_download_links(
+                obj=response, url=link, category=category
+            )
+
     async def get_download_links(
         self, link: str, category: str
     ) -> DownloadLinksPydantic:
@@ -51,10 +107,8 @@ class ForClubbersScrapper:
         :param category: str: category name
         :return: DownloadLinksPydantic
         """
-        response: Response = await self.__fetch_data_get(link)
-        return await self.forum_parser.parse_download_links(
-            obj=response, url=link, category=category
-        )
+        response: Response = await self.fetch_thread(link)
+        return await self.parse_thread(response, link, category)
 
     async def get_forum_urls(self, link: str, category) -> LinksModelPydantic:
         """
@@ -64,7 +118,8 @@ class ForClubbersScrapper:
         :return: LinksModelPydantic
         """
         response = await self.__fetch_data_get(link)
-        return await self.forum_parser.parse_forum(obj=response, category=category)
+        with PARSE_SECONDS.labels(page="listing").time():
+            return await self.forum_parser.parse_forum(obj=response, category=category)
 
     @staticmethod
     async def download_file(
@@ -72,22 +127,97 @@ class ForClubbersScrapper:
         headers: Dict[str, str],
         object_id: Optional[int],
         file_path: str,
+        download_offset: Optional[int] = None,
     ) -> None:
         """
-        Download file from url as a celery task
+        Download file from url as a celery task. Objects already in flight are skipped
         :param dl_link: file download link
         :param headers: headers as dict
         :param object_id: id of DownloadLinksPydantic object
         :param file_path: path to save file
+        :param download_offset: bytes saved by previous attempt
         return: None
         """
 
         if not object_id:
             return
 
+        async with InFlightRegistry() as registry:
+            if not await registry.mark([object_id]):
+                logger.info(f"Object {object_id} is already being downloaded")
+                return
+
         download_file.delay(  # type: ignore
-            object_id=object_id, dl_link=dl_link, headers=headers, file_path=file_path
+            object_id=object_id,
+            dl_link=dl_link,
+            headers=headers,
+            file_path=file_path,
+            download_offset=download_offset,
+        )
+
+    @staticmethod
+    async def download_files(
+        jobs: List[Dict[str, Any]], chunk_size: Optional[int] = None
+    ) -> None:
+        """
+        Download files as a group of celery tasks, each carrying chunk_size jobs.
+        Objects already in flight are skipped
+        :param jobs: dicts with dl_link, headers, object_id and file_path keys
+        :param chunk_size: number of jobs in one task message
+        return: None
+        """
+
+        jobs = [job for job in jobs if job.get("object_id")]
+        if not jobs:
+            return
+
+        async with InFlightRegistry() as registry:
+            marked: List[int] = await registry.mark(job["object_id"] for job in jobs)
+        if len(marked) < len(jobs):
+            logger.info(
+                f"Skipped {len(jobs) - len(marked)} downloads already in flight"
+            )
+            jobs = [job for job in jobs if job["object_id"] in marked]
+        if not jobs:
+            return
+
+        batches: List[Dict] = make_download_batches(
+            jobs, chunk_size or settings.celery.dispatch_chunk_size
         )
+        group(download_files.s(batch) for batch in batches).apply_async()  # type: ignore
+        logger.info(f"Dispatched {len(jobs)} downloads in {len(batches)} tasks")
+
+    @staticmethod
+    async def enqueue_downloads(
+        object_ids: List[int], chunk_size: Optional[int] = None
+    ) -> None:
+        """
+        Enqueue resolve_links -> download_files celery chains, each for chunk_size
+        DownloadLinks objects. Direct links are acquired by workers, not by caller.
+        Objects already in flight are skipped
+        :param object_ids: ids of DownloadLinks objects
+        :param chunk_size: number of objects in one chain
+        return: None
+        """
+
+        async with InFlightRegistry() as registry:
+            object_ids = await registry.mark(object_ids)
+        if not object_ids:
+            return
+
+        size: int = chunk_size or settings.celery.dispatch_chunk_size
+        chunks: List[List[int]] = [
+            object_ids[start : start + size]
+            for start in range(0, len(object_ids), size)
+        ]
+        group(
+            chain(
+                signature("tasks.resolve.resolve_links", args=(chunk,)),
+                download_files.s(),  # type: ignore
+            )
+            for chunk in chunks
+        ).apply_async()
+        logger.info(f"Enqueued {len(object_ids)} links in {len(chunks)} chains")
 
     async def parse_download_link(self, url: str, parser: Type[ParserType]) -> Dict:
         """
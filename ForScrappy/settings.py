@@ -1,8 +1,9 @@
 import os
 import re
 from pathlib import Path
+from typing import Dict, List, Literal
 
-from pydantic import BaseSettings, SecretStr
+from pydantic import BaseSettings, SecretStr, validator
 
 ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
 PARENT_PATH = os.path.dirname(ROOT_PATH)
@@ -13,6 +14,21 @@ class CelerySettings(BaseSettings):
 
     broker_url: str
     result_backend: str
+    dispatch_chunk_size: int = 50
+    result_expires: int = 24 * 60 * 60
+    # seconds a late acked message may stay unacked before redis broker redelivers
+    # it to another worker, so it has to be longer than any download task
+    visibility_timeout: int = 12 * 60 * 60
+    download_time_limit: int = 10 * 60 * 60  # hard limit of download tasks
+
+    @validator("download_time_limit")
+    def shorter_than_visibility_timeout(cls, value: int, values: Dict) -> int:
+        if value >= values.get("visibility_timeout", 0):
+            raise ValueError(
+                "download_time_limit has to be shorter than visibility_timeout, "
+                "otherwise running downloads are delivered again"
+            )
+        return value
 
 
 class LocalRepoSettings(BaseSettings):
@@ -43,6 +59,96 @@ class TestDatabaseSettings(BaseSettings):
     name: str
 
 
+class DownloadQueueSettings(BaseSettings):
+    """download-fetched work queue settings"""
+
+    batch_size: int = 50
+    lease_seconds: int = 3600
+    notify_window: float = 2.0
+    reconnect_delay: float = 1.0
+    reconnect_max_delay: float = 60.0
+    in_flight_ttl: int = 6 * 60 * 60
+    in_flight_prefix: str = "forscrappy:in_flight"
+
+
+class DownloaderSettings(BaseSettings):
+    """Celery worker download engine settings"""
+
+    concurrency: int = 8
+    chunk_size: int = 1024 * 1024
+    read_timeout: int = 60
+    progress_step: int = 10
+    segments: int = 1
+    segment_threshold: int = 100 * 1024 * 1024
+
+
+class FileWriterSettings(BaseSettings):
+    """Download file writer settings"""
+
+    buffer_size: int = 8 * 1024 * 1024
+    preallocate: bool = True
+    fsync: Literal["never", "close", "interval"] = "interval"
+    fsync_interval: int = 64 * 1024 * 1024
+
+
+class DownloadBudgetSettings(BaseSettings):
+    """
+    Download limits shared by all workers. Defaults can be overridden at runtime
+    with `python cli.py download-budget`
+    """
+
+    enabled: bool = True
+    transfers_per_host: int = 4
+    bandwidth: int = 0  # bytes per second, 0 means unlimited
+    burst: float = 1.0  # bucket size in seconds of bandwidth
+    slot_ttl: int = 60
+    poll_interval: float = 0.5
+    key_prefix: str = "forscrappy:download"
+
+
+class CrawlSettings(BaseSettings):
+    """Forum crawl pipeline settings"""
+
+    queue_size: int = 100
+    listing_workers: int = 1
+    fetch_workers: int = 4
+    parse_workers: int = 2
+    persist_workers: int = 2
+    enqueue: bool = False  # dispatch downloads of new links while crawling
+    report_interval: float = 30.0  # seconds between stage stats logs, 0 disables
+
+
+class DaemonSettings(BaseSettings):
+    """Long running crawl daemon settings"""
+
+    interval: int = 60 * 60  # seconds between crawls of a category
+    intervals: Dict[str, int] = {}  # per category overrides, e.g. {"trance": 1800}
+    pages: int = 5
+    relogin_interval: int = 6 * 60 * 60
+    stop_timeout: float = 60.0  # seconds given to running crawl on shutdown
+    max_failure_ratio: float = 0.5  # failed items of a stage above which crawl fails
+    host: str = "0.0.0.0"
+    port: int = 8001
+
+
+class ProfilerSettings(BaseSettings):
+    """Sampling profiler of `cli.py --profile` and of selected celery tasks"""
+
+    directory: str = "profiles"  # relative to project directory
+    interval: float = 0.005  # seconds between stack samples
+    top: int = 10  # entries per stage in summary
+    memory_frames: int = 10  # traceback depth of allocations, 0 disables tracemalloc
+    tasks: List[str] = []  # celery task names, e.g. ["tasks.tasks.download_file"]
+
+
+class MetricsSettings(BaseSettings):
+    """Prometheus metrics of crawl daemon and celery workers"""
+
+    db_queries: bool = False  # count SQL queries per repo method, debug logs them
+    worker_port: int = 8002  # metrics of celery worker, 0 disables
+    queues: List[str] = ["metadata", "resolve", "download"]  # celery backlog
+
+
 class Settings(BaseSettings):
     """General settings for application"""
 
@@ -52,6 +158,15 @@ class Settings(BaseSettings):
     test_db: TestDatabaseSettings
     download_path: str
     kraken_base_url: str
+    kraken_link_ttl: int = 60 * 60
+    download_queue: DownloadQueueSettings = DownloadQueueSettings()
+    downloader: DownloaderSettings = DownloaderSettings()
+    writer: FileWriterSettings = FileWriterSettings()
+    download_budget: DownloadBudgetSettings = DownloadBudgetSettings()
+    crawl: CrawlSettings = CrawlSettings()
+    daemon: DaemonSettings = DaemonSettings()
+    profiler: ProfilerSettings = ProfilerSettings()
+    metrics: MetricsSettings = MetricsSettings()
 
     class Config:
         env_file = os.path.join(PARENT_PATH, ".env")
@@ -1,5 +1,7 @@
 from celery import Celery
 import settings
+from utils.metrics import track_tasks
+from utils.profiler import profile_tasks
 
 
 app = Celery(
@@ -7,10 +9,33 @@ app = Celery(
     broker=settings.CELERY_broker_url,
     backend=settings.result_backend,
     namespace="CELERY",
-    imports="tasks.tasks",
+    imports=("tasks.tasks", "tasks.resolve"),
     # timezone="Europe/Warsaw",
 )
 
+app.conf.result_expires = settings.settings.celery.result_expires
+# unacked messages, reserved or running, are redelivered after visibility timeout.
+# Download tasks are acked late and limited to shorter time, and a worker reserves
+# one message at a time, so messages waiting behind a long one aren't redelivered
+app.conf.broker_transport_options = {
+    "visibility_timeout": settings.settings.celery.visibility_timeout
+}
+app.conf.worker_prefetch_multiplier = 1
+
+# quick metadata updates, link resolution and long transfers get separate queues,
+# so every workload can have its own worker pool (see docker-compose.yml)
+app.conf.task_default_queue = "metadata"
+app.conf.task_routes = {
+    "tasks.tasks.update_thread_name": {"queue": "metadata"},
+    "tasks.resolve.resolve_links": {"queue": "resolve"},
+    "tasks.tasks.download_file": {"queue": "download"},
+    "tasks.tasks.download_files": {"queue": "download"},
+}
+
+track_tasks()
+if settings.settings.profiler.tasks:
+    profile_tasks()
+
 # app = Celery('tasks')
 # app.config_from_object(settings, namespace='CELERY')
 app.autodiscover_tasks()
@@ -0,0 +1,443 @@
+import asyncio
+import cgi
+import re
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from logging import Logger
+from pathlib import Path
+from typing import (
+    AsyncContextManager,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from urllib.parse import urlsplit
+
+import aiohttp
+from prometheus_client import Counter
+
+from logger import get_module_logger
+from repos.redis_repo import DownloadBudget
+from settings import settings
+from tasks.writer import CheckpointCallback, FileWriter, SegmentWriter, ensure_directory
+from utils.exceptions import IncompleteDownloadError
+from utils.metrics import DOWNLOADED_BYTES, http_trace_config
+
+logger: Logger = get_module_logger("downloader")
+
+
+@dataclass
+class DownloadJob:
+    object_id: int
+    dl_link: str
+    file_path: str
+    headers: Dict[str, str] = field(default_factory=dict)
+    # bytes known to be safely written by previous attempt, None if not tracked
+    offset: Optional[int] = None
+
+
+@dataclass
+class DownloadProgress:
+    object_id: int
+    file_name: str
+    total: Optional[int] = None
+    downloaded: int = 0
+    reported: int = 0
+    content_hash: Optional[str] = None
+
+    @property
+    def percent(self) -> Optional[float]:
+        if not self.total:
+            return None
+        return round(self.downloaded / self.total * 100, 1)
+
+
+ProgressCallback = Callable[[DownloadProgress], None]
+JobCheckpointCallback = Callable[[DownloadJob, int], Awaitable[None]]
+# called with job, target file path and size once response headers arrive
+ExistingFileCallback = Callable[[DownloadJob, Path, Optional[int]], Awaitable[bool]]
+
+
+def log_progress(progress: DownloadProgress) -> None:
+    """Default progress callback"""
+    logger.info(
+        f"Object {progress.object_id} {progress.file_name}: "
+        f"{progress.downloaded} / {progress.total or '?'} bytes "
+        f"({progress.percent or '?'}%)"
+    )
+
+
+class DownloadEngine:
+    """
+    Download many files concurrently with one pooled aiohttp session.
+    Socket reads run on the event loop, disk writes run in threads.
+    With a budget every transfer takes a slot of its host and all body bytes
+    are counted against bandwidth shared by all workers.
+    If is_present callback says target file is already on disk, body isn't read
+    """
+
+    def __init__(
+        self,
+        concurrency: int = settings.downloader.concurrency,
+        chunk_size: int = settings.downloader.chunk_size,
+        on_progress: ProgressCallback = log_progress,
+        segments: int = settings.downloader.segments,
+        segment_threshold: int = settings.downloader.segment_threshold,
+        budget: Optional[DownloadBudget] = None,
+        on_checkpoint: Optional[JobCheckpointCallback] = None,
+        is_present: Optional[ExistingFileCallback] = None,
+    ) -> None:
+        self.concurrency: int = concurrency
+        self.chunk_size: int = chunk_size
+        self.segments: int = max(segments, 1)
+        self.segment_threshold: int = segment_threshold
+        self.on_progress: ProgressCallback = on_progress
+        self.budget: Optional[DownloadBudget] = budget
+        self.on_checkpoint: Optional[JobCheckpointCallback] = on_checkpoint
+        self.is_present: Optional[ExistingFileCallback] = is_present
+        self.progress: Dict[int, DownloadProgress] = {}
+        self.semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "DownloadEngine":
+        """Open pooled HTTP session"""
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency * self.segments),
+            timeout=aiohttp.ClientTimeout(
+                total=None, sock_read=settings.downloader.read_timeout
+            ),
+            trace_configs=[http_trace_config()],
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        """Close HTTP session"""
+        if self._session:
+            await self._session.close()
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if not self._session:
+            raise RuntimeError("DownloadEngine has to be used as a context manager")
+        return self._session
+
+    @staticmethod
+    def get_file_name(response: aiohttp.ClientResponse) -> str:
+        """Get file name from content-disposition header or from url"""
+        _, params = cgi.parse_header(response.headers.get("content-disposition", ""))
+        return params.get("filename") or response.url.name
+
+    def _report(self, progress: DownloadProgress, done: bool = False) -> None:
+        """Call progress callback every progress_step percent of file"""
+        step: int = (
+            progress.total or 0
+        ) * settings.downloader.progress_step // 100 or self.chunk_size * 10
+        if done or progress.downloaded - progress.reported >= step:
+            progress.reported = progress.downloaded
+            self.on_progress(progress)
+
+    def _transfer(self, url: str) -> AsyncContextManager:
+        """Slot of url host in download budget"""
+        if not self.budget:
+            return nullcontext()
+        return self.budget.transfer(urlsplit(url).hostname or "")
+
+    async def _write(
+        self, writer: Union[FileWriter, SegmentWriter], buffer: bytearray
+    ) -> None:
+        """Wait for bandwidth budget and pass buffer to writer"""
+        if self.budget:
+            await self.budget.throttle(len(buffer))
+        await writer.write(buffer)
+
+    def _checkpoint(self, job: DownloadJob) -> Optional[CheckpointCallback]:
+        """Writer checkpoint callback of given job"""
+        on_checkpoint: Optional[JobCheckpointCallback] = self.on_checkpoint
+        if not on_checkpoint:
+            return None
+
+        async def _on_checkpoint(offset: int) -> None:
+            job.offset = offset
+            await on_checkpoint(job, offset)  # type: ignore
+
+        return _on_checkpoint
+
+    async def _is_present(
+        self, job: DownloadJob, part_path: Path, file_name: str, total: Optional[int]
+    ) -> bool:
+        """Check if target file of job is already on disk and drop its part file"""
+        if not self.is_present or not await self.is_present(
+            job, part_path.parent / file_name, total
+        ):
+            return False
+        logger.info(f"Object {job.object_id}: {file_name} is already downloaded")
+        await asyncio.to_thread(part_path.unlink, True)
+        return True
+
+    async def download(self, job: DownloadJob) -> Path:
+        """
+        Download file of given job
+        :param job: DownloadJob
+        :return: path of saved file
+        """
+        async with self.semaphore:
+            return await self._download(job)
+
+    async def download_many(
+        self, jobs: List[DownloadJob]
+    ) -> List[Union[Path, BaseException]]:
+        """
+        Download all jobs concurrently
+        :param jobs: list of DownloadJob
+        :return: saved file path or raised exception for every job, in jobs order
+        """
+        return await asyncio.gather(
+            *(self.download(job) for job in jobs), return_exceptions=True
+        )
+
+    @staticmethod
+    def parse_content_range(value: str) -> Tuple[int, Optional[int]]:
+        """Parse `bytes start-end/total` header into start and total"""
+        match: Optional[re.Match] = re.match(r"bytes (\d+)-\d+/(\d+|\*)", value)
+        if not match:
+            raise IncompleteDownloadError(f"Invalid Content-Range: {value}")
+        total: str = match.group(2)
+        return int(match.group(1)), None if total == "*" else int(total)
+
+    @staticmethod
+    def get_part_path(job: DownloadJob) -> Path:
+        """Path of partially downloaded file of given job"""
+        return (
+            Path(settings.custom_download_path)
+            / job.file_path
+            / f"{job.object_id}.part"
+        )
+
+    async def get_part_size(self, job: DownloadJob) -> int:
+        """Size of partially downloaded file of given job"""
+        part_path: Path = self.get_part_path(job)
+        if not await asyncio.to_thread(part_path.exists):
+            return 0
+        return (await asyncio.to_thread(part_path.stat)).st_size
+
+    async def get_offset(self, job: DownloadJob) -> int:
+        """
+        Number of bytes already downloaded for given job. If previous attempt
+        crashed, file may be preallocated past written data, so it is never
+        trusted beyond job checkpoint
+        """
+        size: int = await self.get_part_size(job)
+        if job.offset is None:
+            return size
+        return min(size, job.offset)
+
+    async def _stream_to_file(
+        self,
+        response: aiohttp.ClientResponse,
+        writer: Union[FileWriter, SegmentWriter],
+        progress: DownloadProgress,
+    ) -> None:
+        """Pass response body to writer in chunk_size blocks"""
+        buffer: bytearray = bytearray()
+        downloaded: Counter = DOWNLOADED_BYTES.labels(host=response.url.host or "")
+
+        async for chunk in response.content.iter_chunked(self.chunk_size):
+            buffer += chunk
+            progress.downloaded += len(chunk)
+            if len(buffer) >= self.chunk_size:
+                downloaded.inc(len(buffer))
+                await self._write(writer, buffer)
+                buffer.clear()
+            self._report(progress)
+
+        if buffer:
+            downloaded.inc(len(buffer))
+            await self._write(writer, buffer)
+        await writer.flush()
+
+    def _get_range(
+        self, job: DownloadJob, response: aiohttp.ClientResponse, offset: int
+    ) -> Tuple[int, Optional[int]]:
+        """
+        Return offset the response body starts at and total file size.
+        Servers without range support answer 200 with whole file
+        """
+        if response.status != 206:
+            return 0, response.content_length
+
+        start, total = self.parse_content_range(
+            response.headers.get("content-range", "")
+        )
+        if start != offset:
+            raise IncompleteDownloadError(
+                f"Object {job.object_id}: server resumed at {start}, expected {offset}"
+            )
+        return start, total
+
+    async def _download(self, job: DownloadJob) -> Path:
+        part_path: Path = self.get_part_path(job)
+        await ensure_directory(part_path.parent)
+
+        offset: int = await self.get_offset(job)
+
+        if not offset and self.segments > 1:
+            segmented_path: Optional[Path] = await self._download_segmented(
+                job, part_path
+            )
+            if segmented_path:
+                return segmented_path
+
+        return await self._download_single(job, part_path, offset)
+
+    async def _download_single(
+        self, job: DownloadJob, part_path: Path, offset: int
+    ) -> Path:
+        """Download file in one stream, resuming from offset if it's not 0"""
+        async with self._transfer(job.dl_link):
+            return await self._fetch_single(job, part_path, offset)
+
+    async def _fetch_single(
+        self, job: DownloadJob, part_path: Path, offset: int
+    ) -> Path:
+        headers: Dict[str, str] = dict(job.headers)
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        async with self.session.get(job.dl_link, headers=headers) as response:
+            if response.status == 416:
+                logger.warning(f"Object {job.object_id}: range rejected, restarting")
+                await asyncio.to_thread(part_path.unlink)
+                return await self._fetch_single(job, part_path, 0)
+
+            response.raise_for_status()
+
+            offset, total = self._get_range(job, response, offset)
+            file_name: str = self.get_file_name(response)
+            if await self._is_present(job, part_path, file_name, total):
+                return part_path.parent / file_name
+
+            progress: DownloadProgress = DownloadProgress(
+                object_id=job.object_id,
+                file_name=file_name,
+                total=total,
+                downloaded=offset,
+                reported=offset,
+            )
+            self.progress[job.object_id] = progress
+
+            async with FileWriter(
+                part_path,
+                offset=offset,
+                size=total,
+                on_checkpoint=self._checkpoint(job),
+            ) as writer:
+                await self._stream_to_file(response, writer, progress)
+
+                if total is not None and progress.downloaded != total:
+                    raise IncompleteDownloadError(
+                        f"Object {job.object_id}: got {progress.downloaded} of {total} bytes"
+                    )
+                new_file_path: Path = await writer.commit(part_path.parent / file_name)
+                progress.content_hash = writer.content_hash
+
+        self._report(progress, done=True)
+        return new_file_path
+
+    async def _download_segmented(
+        self, job: DownloadJob, part_path: Path
+    ) -> Optional[Path]:
+        """
+        Download file in `segments` concurrent byte ranges into a preallocated file.
+        :return: path of saved file or None if server doesn't support ranges
+            or file is smaller than segment_threshold
+        """
+        headers: Dict[str, str] = {**job.headers, "Range": "bytes=0-0"}
+        async with self.session.get(job.dl_link, headers=headers) as response:
+            response.raise_for_status()
+            if response.status != 206:
+                return None
+            _, total = self.parse_content_range(
+                response.headers.get("content-range", "")
+            )
+            file_name: str = self.get_file_name(response)
+
+        if await self._is_present(job, part_path, file_name, total):
+            return part_path.parent / file_name
+
+        if total is None or total < self.segment_threshold:
+            return None
+
+        segment_size: int = -(-total // self.segments)
+        ranges: List[Tuple[int, int]] = [
+            (start, min(start + segment_size, total) - 1)
+            for start in range(0, total, segment_size)
+        ]
+        progress: DownloadProgress = DownloadProgress(
+            object_id=job.object_id, file_name=file_name, total=total
+        )
+        self.progress[job.object_id] = progress
+        logger.info(
+            f"Object {job.object_id}: downloading {total} bytes in {len(ranges)} segments"
+        )
+
+        try:
+            async with FileWriter(part_path, size=total) as writer:
+                tasks: List[asyncio.Task] = [
+                    asyncio.create_task(
+                        self._download_segment(
+                            job, writer.segment(start), end, progress
+                        )
+                    )
+                    for start, end in ranges
+                ]
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    # segments still running would write to closed file
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+                if progress.downloaded != total:
+                    raise IncompleteDownloadError(
+                        f"Object {job.object_id}: got {progress.downloaded} of {total} bytes"
+                    )
+                new_file_path: Path = await writer.commit(part_path.parent / file_name)
+                progress.content_hash = writer.content_hash
+        except BaseException:
+            await asyncio.to_thread(part_path.unlink, True)
+            raise
+
+        self._report(progress, done=True)
+        return new_file_path
+
+    async def _download_segment(
+        self,
+        job: DownloadJob,
+        writer: SegmentWriter,
+        end: int,
+        progress: DownloadProgress,
+    ) -> None:
+        """Download bytes from writer position to end (inclusive) and write them in place"""
+        start: int = writer.position
+        headers: Dict[str, str] = {**job.headers, "Range": f"bytes={start}-{end}"}
+
+        async with self._transfer(job.dl_link), self.session.get(
+            job.dl_link, headers=headers
+        ) as response:
+            response.raise_for_status()
+            if response.status != 206:
+                raise IncompleteDownloadError(
+                    f"Object {job.object_id}: range {start}-{end} not supported"
+                )
+            await self._stream_to_file(response, writer, progress)
+
+        if writer.position != end + 1:
+            raise IncompleteDownloadError(
+                f"Object {job.object_id}: range {start}-{end} ended at {writer.position}"
+            )
@@ -0,0 +1,60 @@
+from logging import Logger
+from typing import Dict, List, Optional, Set
+
+from asgiref.sync import async_to_sync
+from celery import shared_task
+
+from logger import get_module_logger
+from models.entities import DownloadLinksPydantic
+from repos.db_repo import DownloadLinksRepo, LinkModelRepo
+from repos.redis_repo import InFlightRegistry
+from repos.request_repo import ForClubbersScrapper
+from tasks.tasks import make_download_batches
+from use_case.use_case import ForClubUseCase
+from utils.utils import DBConnectionHandler
+
+logger: Logger = get_module_logger("tasks")
+
+
+async def resolve_links_task(object_ids: List[int]) -> Dict:
+    """
+    Acquire direct download links of given DownloadLinks objects.
+    In-flight markers of objects which won't be downloaded are cleared
+    :param object_ids: ids of DownloadLinks objects
+    :return: download_files payload with resolved jobs
+    """
+
+    use_case: ForClubUseCase = ForClubUseCase(
+        link_repo=LinkModelRepo,
+        download_repo=DownloadLinksRepo,
+        repo_scrapper=ForClubbersScrapper,
+    )
+    jobs: List[Dict] = []
+
+    async with DBConnectionHandler():
+        links: Optional[DownloadLinksPydantic] = await DownloadLinksRepo().filter(  # type: ignore
+            id__in=object_ids, downloaded=False
+        )
+        for link_obj in links.__root__ if links else []:
+            try:
+                job: Optional[Dict] = await use_case.resolve_link(link_obj)
+            except Exception as e:
+                logger.error(f"Resolving of object {link_obj.pk} failed: {e}")
+                continue
+            if job:
+                jobs.append(job)
+
+    resolved: Set[int] = {job["object_id"] for job in jobs}
+    async with InFlightRegistry() as registry:
+        await registry.clear(pk for pk in object_ids if pk not in resolved)
+
+    batches: List[Dict] = make_download_batches(jobs, chunk_size=len(jobs) or 1)
+    return batches[0] if batches else {"headers": {}, "jobs": []}
+
+
+resolve_links_async = async_to_sync(resolve_links_task)
+
+
+@shared_task(ignore_result=True, acks_late=True)
+def resolve_links(*args, **kwargs):
+    return resolve_links_async(*args, **kwargs)
@@ -0,0 +1,71 @@
+import asyncio
+import os
+from logging import Logger
+from pathlib import Path
+from typing import Optional
+
+from logger import get_module_logger
+from settings import settings
+from tasks.writer import ensure_directory
+
+logger: Logger = get_module_logger("storage")
+
+
+class BlobStore:
+    """
+    Downloaded files stored once per content hash. Every copy in date folders
+    is a hardlink to the blob, so identical tracks posted in many threads take
+    disk space only once
+    """
+
+    def __init__(self, root: Optional[Path] = None) -> None:
+        self.root: Path = root or Path(settings.custom_download_path) / ".blobs"
+
+    def blob_path(self, content_hash: str) -> Path:
+        return self.root / content_hash[:2] / content_hash
+
+    @staticmethod
+    def _replace_with_link(source: Path, target: Path) -> None:
+        """Atomically make target a hardlink of source"""
+        if target.exists() and os.path.samefile(source, target):
+            return
+        tmp_path: Path = target.with_name(f"{target.name}.link")
+        os.link(source, tmp_path)
+        os.replace(tmp_path, target)
+
+    def _store(self, path: Path, blob: Path) -> None:
+        try:
+            os.link(path, blob)
+            return
+        except FileExistsError:
+            pass
+        self._replace_with_link(blob, path)
+
+    async def store(self, path: Path, content_hash: str) -> Path:
+        """
+        Keep downloaded file as blob of its content hash. If the blob already
+        exists, file is replaced with a link to it
+        :param path: downloaded file
+        :param content_hash: sha256 of file content
+        :return: path
+        """
+        blob: Path = self.blob_path(content_hash)
+        await ensure_directory(blob.parent)
+        try:
+            await asyncio.to_thread(self._store, path, blob)
+        except OSError as e:
+            # e.g. blob store on another device, file is kept as it is
+            logger.error(f"Cannot store {path} as blob {content_hash}: {e}")
+        return path
+
+    async def link(self, content_hash: str, target: Path) -> Optional[Path]:
+        """
+        Create target as a link to stored blob
+        :return: target or None if there is no blob of given hash
+        """
+        blob: Path = self.blob_path(content_hash)
+        if not await asyncio.to_thread(blob.exists):
+            return None
+        await ensure_directory(target.parent)
+        await asyncio.to_thread(self._replace_with_link, blob, target)
+        return target
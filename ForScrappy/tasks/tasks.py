@@ -1,19 +1,31 @@
-import cgi
+import asyncio
 import datetime
-import shutil
+import json
+import os
+from contextlib import asynccontextmanager
+from logging import Logger
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Any, AsyncIterator, Optional, Dict, List, Tuple
 
+import aiohttp
 from asgiref.sync import async_to_sync
 from celery import shared_task
-from requests import Session
 
+from logger import get_module_logger
 from models.entities import DownloadLinksPydantic, DownloadLinkPydantic
 from models.models import LinkModel
-from repos.db_repo import DownloadLinksRepo
+from repos.db_repo import DownloadLinksRepo, DownloadManifestRepo
+from repos.redis_repo import DownloadBudget, InFlightRegistry
 from settings import settings
+from tasks.downloader import DownloadEngine, DownloadJob, DownloadProgress
+from tasks.storage import BlobStore
 from utils.utils import DBConnectionHandler
 
+logger: Logger = get_module_logger("tasks")
+
+# direct download link has to be acquired again after these responses
+EXPIRED_LINK_STATUSES: Tuple[int, ...] = (403, 410)
+
 
 async def update_thread_name_task(thread_name: str, url: str) -> dict:
     """Update object name in database"""
@@ -30,59 +42,308 @@ async def update_thread_name_task(thread_name: str, url: str) -> dict:
         return {"status": "object name not updated. Name is already set"}
 
 
+async def set_downloaded(object_id: int, **fields: Any) -> dict:
+    """
+    Mark DownloadLinks object as downloaded. Requires open DB connection
+    :param object_id: id of DownloadLinks object
+    :param fields: other fields to update, e.g. stored content description
+    """
+
+    obj: Optional[DownloadLinksPydantic] = await DownloadLinksRepo().filter(  # type: ignore
+        pk=object_id
+    )
+
+    if obj and (object_pydantic := obj.__root__):
+        object_pydantic[0].downloaded = True
+        object_pydantic[0].downloaded_date = datetime.datetime.now()
+        object_pydantic[0].download_offset = 0
+        for key, value in fields.items():
+            setattr(object_pydantic[0], key, value)
+
+        object_returned: DownloadLinkPydantic = await DownloadLinksRepo().save(
+            object_pydantic[0]
+        )
+        return {"status": "success", "object pk": object_returned.pk}
+
+    return {
+        "status": "Error. No object with this id",
+        "object pk": object_id,
+        "model": "DownloadLinks",
+    }
+
+
+async def store_file(job: DownloadJob, path: Path, engine: DownloadEngine) -> dict:
+    """
+    Deduplicate downloaded file in blob store
+    :return: DownloadLinks fields describing stored content
+    """
+
+    progress: Optional[DownloadProgress] = engine.progress.get(job.object_id)
+    if not progress or not progress.content_hash:
+        return {}
+
+    await BlobStore().store(path, progress.content_hash)
+    stored_path: str = str(path.relative_to(settings.custom_download_path))
+    try:
+        stat: os.stat_result = await asyncio.to_thread(path.stat)
+        await DownloadManifestRepo().add(
+            stored_path, stat.st_size, stat.st_mtime, progress.content_hash
+        )
+    except Exception as e:
+        logger.error(f"Cannot add {stored_path} to download manifest: {e}")
+
+    return {
+        "content_hash": progress.content_hash,
+        "content_size": progress.downloaded,
+        "stored_path": stored_path,
+    }
+
+
+async def link_stored_duplicate(job: DownloadJob, path: Path, size: int) -> bool:
+    """
+    Link file of the same name and size, downloaded for another link, to target
+    path of job instead of downloading it. Requires open DB connection
+    :return: True if file was linked
+    """
+
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+    content_hash: Optional[str] = await repo.get_stored_duplicate(
+        path.name, size, exclude_pk=job.object_id
+    )
+    if not content_hash or not await BlobStore().link(content_hash, path):
+        return False
+
+    await repo.update_by_pk(job.object_id, content_hash=content_hash)
+    stat: os.stat_result = await asyncio.to_thread(path.stat)
+    await DownloadManifestRepo().add(
+        str(path.relative_to(settings.custom_download_path)),
+        stat.st_size,
+        stat.st_mtime,
+        content_hash,
+    )
+    logger.info(f"Object {job.object_id}: linked stored {path.name}")
+    return True
+
+
+async def find_on_disk(job: DownloadJob, path: Path, size: Optional[int]) -> bool:
+    """
+    Save target file of job, so reconcile can match it even if task dies after
+    writing, and check download manifest for it. File of the same name and size
+    stored for another link is linked from blob store. Requires open DB connection
+    :return: True if file is already on disk
+    """
+
+    stored_path: str = str(path.relative_to(settings.custom_download_path))
+    try:
+        await DownloadLinksRepo().update_by_pk(
+            job.object_id, stored_path=stored_path, content_size=size
+        )
+        if await DownloadManifestRepo().is_present(stored_path, size):
+            return True
+        return bool(size) and await link_stored_duplicate(job, path, size)  # type: ignore
+    except Exception as e:
+        logger.error(f"Cannot check manifest of object {job.object_id}: {e}")
+        return False
+
+
+def is_link_expired(error: BaseException) -> bool:
+    """Check if download failed because direct download link is no longer valid"""
+    return (
+        isinstance(error, aiohttp.ClientResponseError)
+        and error.status in EXPIRED_LINK_STATUSES
+    )
+
+
+async def save_failure(
+    job: DownloadJob, engine: DownloadEngine, error: BaseException
+) -> None:
+    """
+    Persist size of partially downloaded file and drop cached direct download
+    link if server rejected it. Requires open DB connection
+    """
+
+    fields: Dict[str, Any] = {}
+    if is_link_expired(error):
+        fields.update(download_link=None, download_link_expires=None)
+
+    try:
+        fields["download_offset"] = await engine.get_part_size(job)
+        await DownloadLinksRepo().update_by_pk(job.object_id, **fields)
+    except Exception as e:
+        logger.error(f"Cannot save offset of object {job.object_id}: {e}")
+
+
+async def save_checkpoint(job: DownloadJob, offset: int) -> None:
+    """Persist number of bytes synced to disk. Requires open DB connection"""
+
+    try:
+        await DownloadLinksRepo().update_by_pk(job.object_id, download_offset=offset)
+    except Exception as e:
+        logger.error(f"Cannot save checkpoint of object {job.object_id}: {e}")
+
+
+@asynccontextmanager
+async def download_engine() -> AsyncIterator[DownloadEngine]:
+    """
+    DownloadEngine limited by download budget shared by all workers, if enabled.
+    Download checkpoints are saved and download manifest is consulted in DB,
+    so it has to be used with open DB connection
+    """
+
+    budget: Optional[DownloadBudget] = (
+        DownloadBudget() if settings.download_budget.enabled else None
+    )
+    try:
+        async with DownloadEngine(
+            budget=budget, on_checkpoint=save_checkpoint, is_present=find_on_disk
+        ) as engine:
+            yield engine
+    finally:
+        if budget:
+            await budget.close()
+
+
 async def download_file_task(
     object_id: int,
     dl_link: str,
     headers: Dict[str, str],
     file_path: Path,
-    session: Session = Session(),
+    download_offset: Optional[int] = None,
+    engine: Optional[DownloadEngine] = None,
 ) -> Optional[dict]:
-    """download file and update object in database"""
+    """
+    download file and update object in database. Files listed in download manifest
+    are not transferred again. Clears in-flight marker of object
+    """
 
-    path = Path(settings.custom_download_path) / file_path
+    job: DownloadJob = DownloadJob(
+        object_id=object_id,
+        dl_link=dl_link,
+        file_path=str(file_path),
+        headers=headers,
+        offset=download_offset,
+    )
 
-    if not path.exists():
-        path.mkdir(parents=True, exist_ok=True)
+    try:
+        async with DBConnectionHandler():
+            try:
+                if engine:
+                    path: Path = await engine.download(job)
+                    stored: dict = await store_file(job, path, engine)
+                else:
+                    async with download_engine() as new_engine:
+                        path = await new_engine.download(job)
+                        stored = await store_file(job, path, new_engine)
+            except Exception as e:
+                await save_failure(job, engine or DownloadEngine(), e)
+                raise
 
-    new_file_path: Optional[Path]
+            return await set_downloaded(object_id, **stored)
+    finally:
+        # cleared once object is marked downloaded, so it isn't dispatched again
+        async with InFlightRegistry() as registry:
+            await registry.clear([object_id])
 
-    with session.get(dl_link, headers=headers, stream=True) as r:
-        _, params = cgi.parse_header(r.headers["content-disposition"])
-        file_name = params["filename"]
-        new_file_path = Path(path) / file_name
-        with open(new_file_path, "wb") as f:
-            shutil.copyfileobj(r.raw, f)
 
-    async with DBConnectionHandler():
-        obj: Optional[DownloadLinksPydantic] = await DownloadLinksRepo().filter(  # type: ignore
-            pk=object_id
+def make_download_batches(jobs: List[Dict[str, Any]], chunk_size: int) -> List[Dict]:
+    """
+    Pack download jobs into download_files payloads of at most chunk_size jobs.
+    Every distinct headers dict is stored once per payload and referenced by jobs
+    :param jobs: dicts with object_id, dl_link, headers, file_path
+        and optional download_offset keys
+    :param chunk_size: max number of jobs in one payload
+    :return: list of payloads
+    """
+    batches: List[Dict] = []
+
+    for start in range(0, len(jobs), chunk_size):
+        headers: Dict[str, Dict[str, str]] = {}
+        refs: Dict[str, str] = {}
+        batch_jobs: List[Dict[str, Any]] = []
+
+        for job in jobs[start : start + chunk_size]:
+            key: str = json.dumps(job["headers"], sort_keys=True)
+            if key not in refs:
+                refs[key] = str(len(refs))
+                headers[refs[key]] = job["headers"]
+            batch_jobs.append({**job, "headers": refs[key]})
+
+        batches.append({"headers": headers, "jobs": batch_jobs})
+
+    return batches
+
+
+async def download_files_task(
+    batch: Dict, engine: Optional[DownloadEngine] = None
+) -> dict:
+    """
+    Download all jobs of a make_download_batches payload concurrently.
+    Clears in-flight markers of all jobs
+    """
+
+    jobs: List[DownloadJob] = [
+        DownloadJob(
+            object_id=job["object_id"],
+            dl_link=job["dl_link"],
+            file_path=str(job["file_path"]),
+            headers=batch["headers"][job["headers"]],
+            offset=job.get("download_offset"),
         )
+        for job in batch["jobs"]
+    ]
+    result: Dict[str, int] = {"success": 0, "failed": 0}
+
+    async def _download(download_engine: DownloadEngine, job: DownloadJob) -> None:
+        try:
+            path: Path = await download_engine.download(job)
+            stored: dict = await store_file(job, path, download_engine)
+            response: dict = await set_downloaded(job.object_id, **stored)
+        except Exception as e:
+            logger.error(f"Download of object {job.object_id} failed: {e}")
+            await save_failure(job, download_engine, e)
+            result["failed"] += 1
+            return
 
-        if obj and (object_pydantic := obj.__root__):
-            object_pydantic[0].downloaded = True
-            object_pydantic[0].downloaded_date = datetime.datetime.now()
+        result["success" if response["status"] == "success" else "failed"] += 1
 
-            object_returned: DownloadLinkPydantic = await DownloadLinksRepo().save(
-                object_pydantic[0]
-            )
-            return {"status": "success", "object pk": object_returned.pk}
+    try:
+        async with DBConnectionHandler():
+            if engine:
+                await asyncio.gather(*(_download(engine, job) for job in jobs))
+            else:
+                async with download_engine() as new_engine:
+                    await asyncio.gather(*(_download(new_engine, job) for job in jobs))
+    finally:
+        async with InFlightRegistry() as registry:
+            await registry.clear(job.object_id for job in jobs)
 
-        return {
-            "status": "Error. No object with this id",
-            "object pk": object_id,
-            "model": "DownloadLinks",
-        }
+    return result
 
 
 download_file_async = async_to_sync(download_file_task)
+download_files_async = async_to_sync(download_files_task)
 update_thread_name_async = async_to_sync(update_thread_name_task)
 
 
-@shared_task
+@shared_task(
+    acks_late=True,
+    reject_on_worker_lost=True,
+    time_limit=settings.celery.download_time_limit,
+)
 def download_file(*args, **kwargs):
     return download_file_async(*args, **kwargs)
 
 
-@shared_task
+@shared_task(
+    ignore_result=True,
+    acks_late=True,
+    reject_on_worker_lost=True,
+    time_limit=settings.celery.download_time_limit,
+)
+def download_files(*args, **kwargs):
+    return download_files_async(*args, **kwargs)
+
+
+@shared_task(ignore_result=True)
 def update_thread_name(*args, **kwargs):
     return update_thread_name_async(*args, **kwargs)
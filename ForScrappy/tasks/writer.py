@@ -0,0 +1,223 @@
+import asyncio
+import hashlib
+import os
+from logging import Logger
+from pathlib import Path
+from typing import Awaitable, Callable, Optional, Set
+
+from logger import get_module_logger
+from settings import settings
+
+logger: Logger = get_module_logger("writer")
+
+CheckpointCallback = Callable[[int], Awaitable[None]]
+
+# directories created by this process, so every file doesn't need its own mkdir
+_created_directories: Set[Path] = set()
+
+
+async def ensure_directory(path: Path) -> None:
+    """Create directory with parents, once per process"""
+    if path in _created_directories:
+        return
+    await asyncio.to_thread(path.mkdir, parents=True, exist_ok=True)
+    _created_directories.add(path)
+
+
+def hash_file(path: Path, block_size: int = 8 * 1024 * 1024) -> str:
+    """sha256 of file content"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file:
+        while block := file.read(block_size):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _sync(fd: int) -> None:
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+class FileWriter:
+    """
+    Writer of one downloaded file. Data is collected in a large buffer and written
+    with pwrite, so blocking syscalls run in threads only once per buffer_size.
+    Space for the rest of the file is preallocated when its size is known.
+    Appended data is hashed on the way, content_hash is set on commit.
+    fsync policy:
+        never - leave flushing to the OS
+        close - sync once, when file is closed
+        interval - sync every fsync_interval bytes and report synced offset
+            to on_checkpoint, so it can be used to resume download
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        offset: int = 0,
+        size: Optional[int] = None,
+        buffer_size: int = settings.writer.buffer_size,
+        preallocate: bool = settings.writer.preallocate,
+        fsync: str = settings.writer.fsync,
+        fsync_interval: int = settings.writer.fsync_interval,
+        on_checkpoint: Optional[CheckpointCallback] = None,
+    ) -> None:
+        self.path: Path = path
+        self.offset: int = offset
+        self.size: Optional[int] = size
+        self.buffer_size: int = buffer_size
+        self.preallocate: bool = preallocate
+        self.fsync: str = fsync
+        self.fsync_interval: int = fsync_interval
+        self.on_checkpoint: Optional[CheckpointCallback] = on_checkpoint
+        self.position: int = offset
+        self.preallocated: bool = False
+        self.content_hash: Optional[str] = None
+        self._buffer: bytearray = bytearray()
+        self._unsynced: int = 0
+        self._fd: Optional[int] = None
+        self._hasher = hashlib.sha256()
+        # segments are written out of order, so their file is hashed after commit
+        self._sequential: bool = True
+
+    async def __aenter__(self) -> "FileWriter":
+        await asyncio.to_thread(self._open)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close(failed=exc_type is not None)
+
+    @property
+    def fd(self) -> int:
+        if self._fd is None:
+            raise RuntimeError("FileWriter has to be used as a context manager")
+        return self._fd
+
+    def _open(self) -> None:
+        """Open file and drop everything after offset"""
+        try:
+            fd: int = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            # directory removed after ensure_directory cached it, e.g. moved by hand
+            _created_directories.discard(self.path.parent)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            _created_directories.add(self.path.parent)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._fd = fd
+        os.ftruncate(fd, self.offset)
+
+        position: int = 0
+        while position < self.offset:
+            block: bytes = os.pread(
+                fd, min(self.buffer_size, self.offset - position), position
+            )
+            self._hasher.update(block)
+            position += len(block)
+
+        if self.preallocate and self.size and self.size > self.offset:
+            try:
+                os.posix_fallocate(fd, self.offset, self.size - self.offset)
+                self.preallocated = True
+            except (AttributeError, OSError) as e:
+                logger.debug(f"Cannot preallocate {self.path}: {e}")
+
+    async def pwrite(self, data: bytes, position: int) -> None:
+        """Write data at given position, bypassing buffer"""
+        await asyncio.to_thread(os.pwrite, self.fd, data, position)
+        self._unsynced += len(data)
+        if self.fsync == "interval" and self._unsynced >= self.fsync_interval:
+            await self.sync()
+
+    async def write(self, data: bytes) -> None:
+        """Append data to file"""
+        self._buffer += data
+        if len(self._buffer) >= self.buffer_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Hash and write buffered data to file"""
+        if not self._buffer:
+            return
+        data: bytes = bytes(self._buffer)
+        self._buffer.clear()
+        position: int = self.position
+        self.position += len(data)
+        await asyncio.to_thread(self._hasher.update, data)
+        await self.pwrite(data, position)
+
+    async def sync(self) -> None:
+        """fsync file and report durable offset"""
+        await asyncio.to_thread(_sync, self.fd)
+        self._unsynced = 0
+        if self.on_checkpoint:
+            await self.on_checkpoint(self.position)
+
+    def segment(self, start: int) -> "SegmentWriter":
+        """Buffered writer of file part starting at given position"""
+        self._sequential = False
+        return SegmentWriter(self, start)
+
+    async def close(self, failed: bool = False) -> None:
+        """
+        Flush and close file. After failure preallocated space is released,
+        so file size is still the number of written bytes
+        """
+        if self._fd is None:
+            return
+
+        try:
+            await self.flush()
+            if failed and self.preallocated:
+                await asyncio.to_thread(os.ftruncate, self.fd, self.position)
+            if self.fsync != "never":
+                await self.sync()
+        finally:
+            fd: int = self.fd
+            self._fd = None
+            await asyncio.to_thread(os.close, fd)
+
+    async def commit(self, new_path: Path) -> Path:
+        """Close file, set its content_hash and atomically rename it to new_path"""
+        await self.close()
+        if self._sequential:
+            self.content_hash = self._hasher.hexdigest()
+        else:
+            self.content_hash = await asyncio.to_thread(hash_file, self.path)
+        await asyncio.to_thread(os.replace, self.path, new_path)
+        if self.fsync != "never":
+            await asyncio.to_thread(self._sync_directory, new_path.parent)
+        return new_path
+
+    @staticmethod
+    def _sync_directory(path: Path) -> None:
+        """Make rename durable"""
+        fd: int = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class SegmentWriter:
+    """Buffered writer of one byte range of FileWriter file"""
+
+    def __init__(self, writer: FileWriter, start: int) -> None:
+        self.writer: FileWriter = writer
+        self.position: int = start
+        self._buffer: bytearray = bytearray()
+
+    async def write(self, data: bytes) -> None:
+        self._buffer += data
+        if len(self._buffer) >= self.writer.buffer_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+        data: bytes = bytes(self._buffer)
+        self._buffer.clear()
+        position: int = self.position
+        self.position += len(data)
+        await self.writer.pwrite(data, position)
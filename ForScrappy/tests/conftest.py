@@ -1,11 +1,24 @@
 import logging
 import os
 import warnings
-from typing import Optional, List, Union
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import (
+    AsyncContextManager,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Union,
+)
 from unittest.mock import MagicMock
 
 import pytest
+import redis.asyncio
 import requests
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from bs4 import Tag, BeautifulSoup, NavigableString
 from pytest_docker.plugin import Services
 from pytest_mock import MockerFixture
@@ -29,13 +42,56 @@ load_dotenv(env_path)
 root_dir: str = ROOT_PATH
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        "--run-benchmarks",
+        action="store_true",
+        default=False,
+        help="Run benchmark tests on a seeded dataset",
+    )
+    parser.addoption(
+        "--bench-rows",
+        type=int,
+        default=10_000,
+        help="Number of LinkModel and DownloadLinks rows seeded for benchmarks",
+    )
+
+
 def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: slow benchmark, runs only with --run-benchmarks"
+    )
     logging.getLogger("db_repo").setLevel(logging.CRITICAL)
     logging.getLogger("parser").setLevel(logging.CRITICAL),
     logging.getLogger("request_repo").setLevel(logging.CRITICAL),
+    logging.getLogger("notify_repo").setLevel(logging.CRITICAL)
+    logging.getLogger("downloader").setLevel(logging.CRITICAL)
+    logging.getLogger("redis_repo").setLevel(logging.CRITICAL)
+    logging.getLogger("writer").setLevel(logging.CRITICAL)
+    logging.getLogger("storage").setLevel(logging.CRITICAL)
+    logging.getLogger("migrations").setLevel(logging.CRITICAL)
+    logging.getLogger("pipeline").setLevel(logging.CRITICAL)
+    logging.getLogger("daemon").setLevel(logging.CRITICAL)
+    logging.getLogger("server").setLevel(logging.CRITICAL)
+    logging.getLogger("fake_server").setLevel(logging.CRITICAL)
+    logging.getLogger("profiler").setLevel(logging.CRITICAL)
+    logging.getLogger("bench").setLevel(logging.CRITICAL)
+    logging.getLogger("benchmark").setLevel(logging.CRITICAL)
+    logging.getLogger("metrics").setLevel(logging.CRITICAL)
     os.environ["TEST"] = "True"
 
 
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-benchmarks"):
+        return
+    skip: pytest.MarkDecorator = pytest.mark.skip(
+        reason="benchmark, use --run-benchmarks to run"
+    )
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
 @pytest.fixture(autouse=True)
 def ignore_warnings():
     warnings.filterwarnings("ignore", message='Module "__main__" has no models')
@@ -90,6 +146,14 @@ def db_connection(
     return credentials
 
 
+@pytest.fixture(scope="session")
+def redis_url(docker_services: "Services", docker_ip: str) -> str:
+    """Url of test redis database"""
+
+    port: int = docker_services.port_for("test_redis", 6379) or 6390
+    return f"redis://{docker_ip}:{port}/0"
+
+
 @pytest.fixture(autouse=True)
 def _mock_db_connection(mocker: "MockerFixture", db_connection: dict) -> bool:
     """
@@ -106,6 +170,22 @@ def _mock_db_connection(mocker: "MockerFixture", db_connection: dict) -> bool:
     return True
 
 
+@pytest.fixture(autouse=True)
+def _mock_redis_connection(mocker: "MockerFixture", redis_url: str) -> bool:
+    """
+    Point application redis clients to empty test redis database
+    :param mocker: pytest-mock plugin fixture
+    :param redis_url: test redis url
+    :return: True upon successful monkey-patching
+    """
+    redis.Redis.from_url(redis_url).flushdb()
+    mocker.patch(
+        "repos.redis_repo.get_redis",
+        side_effect=lambda: redis.asyncio.Redis.from_url(redis_url),
+    )
+    return True
+
+
 @pytest.fixture
 def link_model() -> LinkModelPydantic:
     """Returns LinkModel instance"""
@@ -152,6 +232,15 @@ def clean_database() -> None:
             query = "DELETE FROM download_links"
             await MyTortoise.get_connection("default").execute_query(query)
 
+            query = "DELETE FROM download_links_stats"
+            await MyTortoise.get_connection("default").execute_query(query)
+
+            query = "DELETE FROM download_manifest"
+            await MyTortoise.get_connection("default").execute_query(query)
+
+            query = "DELETE FROM crawl_checkpoint"
+            await MyTortoise.get_connection("default").execute_query(query)
+
     run_async(_clean_database())
 
 
@@ -284,6 +373,12 @@ def get_list_of_tags() -> List[Tag]:
     return tags
 
 
+@pytest.fixture
+def bench_rows(pytestconfig) -> int:
+    """Number of rows seeded for benchmarks"""
+    return pytestconfig.getoption("--bench-rows")
+
+
 @pytest.fixture(scope="module")
 def celery_app():
     app.conf.update(CELERY_ALWAYS_EAGER=True)
@@ -292,26 +387,12 @@ def celery_app():
 
 @pytest.fixture
 def mock_download_file_task(mocker: "MockerFixture") -> MagicMock:
-    """Mock download_file task properties like cgi, Session or shutil"""
-    session_mock = mocker.MagicMock()
-    mocker.patch("requests.Session", return_value=session_mock)
-    mocker.patch(
-        "shutil.copyfileobj", autospec=True, side_effect=lambda fsrc, fdst: None
-    )
-
-    response_mock = mocker.MagicMock()
-    response_mock.headers = {"content-disposition": 'attachment; filename="file.zip"'}
-    response_mock.raw = mocker.MagicMock()
+    """Mock DownloadEngine used by download_file task"""
+    engine_mock = mocker.MagicMock()
+    engine_mock.download = mocker.AsyncMock(return_value=Path("/path/to/save/file.zip"))
+    engine_mock.progress = {}
 
-    parse_header_mock = mocker.patch("cgi.parse_header", autospec=True)
-    parse_header_mock.return_value = ("attachment", {"filename": "file.zip"})
-
-    mocker.patch("builtins.open", mocker.MagicMock())
-    mocker.patch("pathlib.Path.mkdir", mocker.MagicMock())
-
-    session_mock.get.return_value = response_mock
-
-    return session_mock
+    return engine_mock
 
 
 @pytest.fixture
@@ -321,3 +402,49 @@ def use_case() -> ForClubUseCase:
         download_repo=DownloadLinksRepo,
         repo_scrapper=ForClubbersScrapper,
     )
+
+
+FILE_CONTENT: bytes = b"0123456789" * 1000
+
+
+async def file_handler(request: web.Request) -> web.Response:
+    headers: Dict[str, str] = {"content-disposition": 'attachment; filename="file.zip"'}
+    range_header: Optional[str] = request.headers.get("Range")
+
+    if range_header and request.query.get("ranges") != "no":
+        first, last = range_header.split("=")[1].split("-")
+        start: int = int(first)
+        end: int = int(last) if last else len(FILE_CONTENT) - 1
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(FILE_CONTENT)}"
+        return web.Response(
+            status=206, body=FILE_CONTENT[start : end + 1], headers=headers
+        )
+
+    return web.Response(body=FILE_CONTENT, headers=headers)
+
+
+@asynccontextmanager
+async def serve_file() -> AsyncIterator[TestServer]:
+    app: web.Application = web.Application()
+    app.router.add_get("/file/{name}", file_handler)
+    server: TestServer = TestServer(app)
+    await server.start_server()
+    try:
+        yield server
+    finally:
+        await server.close()
+
+
+@pytest.fixture
+def file_content() -> bytes:
+    """Content of file served by file_server"""
+    return FILE_CONTENT
+
+
+@pytest.fixture
+def file_server() -> Callable[[], AsyncContextManager[TestServer]]:
+    """
+    Local HTTP server serving file_content under /file/{name}, with Range
+    support unless ?ranges=no is given. Used as `async with file_server() as server`
+    """
+    return serve_file
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+import pytest
+
+from bench.fake_server import FakeServerConfig
+from bench.runner import BenchResult, BenchRunner, QueryCounter, percentiles
+
+DB_LOGGER: logging.Logger = logging.getLogger(QueryCounter.logger_name)
+
+
+def test_percentiles() -> None:
+    """Nearest-rank percentiles should be picked from sorted values"""
+
+    values = [float(value) for value in range(100, 0, -1)]
+
+    assert percentiles(values) == {"p50": 50.0, "p90": 90.0, "p99": 99.0, "max": 100.0}
+    assert percentiles([3.0]) == {"p50": 3.0, "p90": 3.0, "p99": 3.0, "max": 3.0}
+    assert percentiles([]) == {}
+
+
+@pytest.mark.asyncio
+async def test_query_counter_phases() -> None:
+    """Queries should be counted per phase, also in tasks started in phase"""
+
+    async def query() -> None:
+        DB_LOGGER.debug("%s: %s", "SELECT 1", [])
+
+    with QueryCounter() as counter:
+        with counter.phase("crawl"):
+            await asyncio.gather(query(), query())
+        with counter.phase("resolve"):
+            await query()
+        await query()
+        DB_LOGGER.debug("Created connection pool %s with params: %s", None, {})
+
+    await query()
+
+    assert counter.counts == {"crawl": 2, "resolve": 1, "other": 1}
+    assert DB_LOGGER.propagate
+
+
+@pytest.mark.asyncio
+async def test_bench_runner() -> None:
+    """Whole pipeline should run against fake server and report its numbers"""
+
+    runner: BenchRunner = BenchRunner(
+        FakeServerConfig(
+            categories=("trance",),
+            pages=2,
+            threads_per_page=3,
+            links_per_thread=2,
+            file_size=64 * 1024,
+        )
+    )
+    result: BenchResult = await runner.run()
+
+    assert result.threads == 6
+    assert result.links == 12
+    assert result.resolved == 12
+    assert result.downloaded == 12
+    assert result.bytes_written == 12 * 64 * 1024
+    assert result.queries["crawl"] > 0
+    assert result.queries_per_thread > 0
+    assert result.resolve_latency_ms["max"] > 0
+    assert result.peak_rss_mb > 0
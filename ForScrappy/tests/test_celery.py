@@ -1,17 +1,36 @@
+import hashlib
+from copy import deepcopy
 from pathlib import Path
-from typing import Dict, Awaitable, Optional
+from typing import Dict, Awaitable, List, Optional
 from unittest.mock import MagicMock
 
+import aiohttp
 import pytest
 from celery import Celery
+from pytest_mock import MockerFixture
 
 from models.entities import (
     DownloadLinkPydantic,
     LinkModelPydantic,
 )
 
-from repos.db_repo import LinkModelRepo, DownloadLinksRepo
-from tasks.tasks import update_thread_name_task, download_file_task
+from repos.db_repo import DownloadManifestRepo, LinkModelRepo, DownloadLinksRepo
+from repos.redis_repo import InFlightRegistry
+from settings import settings
+from tasks.celery import app
+from tasks.storage import BlobStore
+from tasks.tasks import (
+    download_file,
+    download_files,
+    find_on_disk,
+    save_failure,
+    update_thread_name_task,
+    download_file_task,
+    download_files_task,
+    make_download_batches,
+)
+from tasks.downloader import DownloadJob
+from tasks.resolve import resolve_links_task
 from utils.utils import DBConnectionHandler
 
 
@@ -83,14 +102,14 @@ async def test_download_file_no_obj(
         "object pk": 1,
         "model": "DownloadLinks",
     }
-    session_mock: MagicMock = mock_download_file_task
+    engine_mock: MagicMock = mock_download_file_task
 
     res: Optional[Dict] = await download_file_task(
         object_id=1,
         dl_link="https://example.com/file.zip",
         headers={},
         file_path=Path("/path/to/save"),
-        session=session_mock,
+        engine=engine_mock,
     )
     assert res == expected_response
 
@@ -103,7 +122,7 @@ async def test_download_file(
 ) -> None:
     """Test celery task download_file. Object exists case"""
 
-    session_mock: MagicMock = mock_download_file_task
+    engine_mock: MagicMock = mock_download_file_task
     download_link: DownloadLinkPydantic = await download_link_model
     repo: DownloadLinksRepo = DownloadLinksRepo()
 
@@ -120,6 +139,213 @@ async def test_download_file(
         dl_link="https://example.com/file.zip",
         headers={},
         file_path=Path("/path/to/save"),
-        session=session_mock,
+        engine=engine_mock,
     )
     assert res == expected_response
+
+
+def test_make_download_batches() -> None:
+    """Jobs should be chunked and share one headers dict per payload"""
+
+    headers: Dict[str, str] = {"cache-control": "no-cache"}
+    jobs: List[Dict] = [
+        {
+            "object_id": pk,
+            "dl_link": f"https://example.com/{pk}.zip",
+            "headers": dict(headers),
+            "file_path": "2023/4/",
+        }
+        for pk in range(1, 6)
+    ]
+
+    batches: List[Dict] = make_download_batches(jobs, chunk_size=2)
+
+    assert [len(batch["jobs"]) for batch in batches] == [2, 2, 1]
+    assert batches[0]["headers"] == {"0": headers}
+    assert {job["headers"] for job in batches[0]["jobs"]} == {"0"}
+    assert batches[2]["jobs"][0]["object_id"] == 5
+
+
+@pytest.mark.asyncio
+async def test_download_files(
+    celery_app: Celery,
+    mock_download_file_task: MagicMock,
+    download_link_model: Awaitable,
+) -> None:
+    """Test celery task download_files. Missing objects are counted as failed"""
+
+    engine_mock: MagicMock = mock_download_file_task
+    download_link: DownloadLinkPydantic = await download_link_model
+
+    async with DBConnectionHandler():
+        res_object: DownloadLinkPydantic = await DownloadLinksRepo().create(
+            download_link
+        )
+
+    batch: Dict = make_download_batches(
+        [
+            {
+                "object_id": pk,
+                "dl_link": "https://example.com/file.zip",
+                "headers": {},
+                "file_path": "2023/4/",
+            }
+            for pk in (res_object.pk, 0)
+        ],
+        chunk_size=2,
+    )[0]
+
+    async with InFlightRegistry() as registry:
+        await registry.mark([res_object.pk, 0])  # type: ignore
+
+    res: Dict = await download_files_task(batch, engine=engine_mock)
+
+    assert res == {"success": 1, "failed": 1}
+    assert engine_mock.download.call_count == 2
+
+    async with InFlightRegistry() as registry:
+        assert not await registry.in_flight([res_object.pk, 0])  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_download_file_clears_marker_after_downloaded(
+    celery_app: Celery, mock_download_file_task: MagicMock, mocker: "MockerFixture"
+) -> None:
+    """Object should stay in flight until it is marked downloaded"""
+
+    in_flight: List[bool] = []
+
+    async def set_downloaded(object_id: int, **kwargs) -> Dict:
+        async with InFlightRegistry() as registry:
+            in_flight.append(object_id in await registry.in_flight([object_id]))
+        return {"status": "success"}
+
+    mocker.patch("tasks.tasks.set_downloaded", side_effect=set_downloaded)
+    async with InFlightRegistry() as registry:
+        await registry.mark([1])
+
+    await download_file_task(
+        object_id=1,
+        dl_link="https://example.com/file.zip",
+        headers={},
+        file_path=Path("2023/4/"),
+        engine=mock_download_file_task,
+    )
+
+    assert in_flight == [True]
+    async with InFlightRegistry() as registry:
+        assert not await registry.in_flight([1])
+
+
+@pytest.mark.asyncio
+async def test_resolve_links(
+    celery_app: Celery, download_link_model: Awaitable, mocker: "MockerFixture"
+) -> None:
+    """Test celery task resolve_links. Resolved jobs are packed into download_files payload"""
+
+    download_link: DownloadLinkPydantic = await download_link_model
+
+    async with DBConnectionHandler():
+        res_object: DownloadLinkPydantic = await DownloadLinksRepo().create(
+            download_link
+        )
+
+    job: Dict = {
+        "dl_link": "https://example.com/file.zip",
+        "headers": {"cache-control": "no-cache"},
+        "file_path": "2023/4/",
+        "object_id": res_object.pk,
+    }
+    mocker.patch("use_case.use_case.ForClubUseCase.resolve_link", return_value=job)
+
+    res: Dict = await resolve_links_task([res_object.pk])  # type: ignore
+
+    assert res == {
+        "headers": {"0": {"cache-control": "no-cache"}},
+        "jobs": [{**job, "headers": "0"}],
+    }
+
+
+@pytest.mark.asyncio
+async def test_save_failure_drops_rejected_link(
+    download_link_model: Awaitable, mocker: "MockerFixture"
+) -> None:
+    """Cached direct link rejected with 403 should be removed, offset saved"""
+
+    download_link: DownloadLinkPydantic = await download_link_model
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+    engine_mock: MagicMock = mocker.MagicMock()
+    engine_mock.get_part_size = mocker.AsyncMock(return_value=100)
+    error: aiohttp.ClientResponseError = aiohttp.ClientResponseError(
+        mocker.MagicMock(), (), status=403
+    )
+
+    async with DBConnectionHandler():
+        res_object: DownloadLinkPydantic = await repo.create(download_link)
+        job: DownloadJob = DownloadJob(
+            object_id=res_object.pk, dl_link="link", file_path="4/"  # type: ignore
+        )
+
+        await save_failure(job, engine_mock, error)
+
+        obj: DownloadLinkPydantic = (await repo.filter(pk=res_object.pk)).__root__[0]  # type: ignore
+        assert obj.download_link is None
+        assert obj.download_offset == 100
+
+
+@pytest.mark.asyncio
+async def test_find_on_disk_links_stored_duplicate(
+    download_link_model: Awaitable, tmp_path: Path, monkeypatch
+) -> None:
+    """File of same name and size stored for another link should be linked"""
+
+    monkeypatch.setattr(settings, "download_path", str(tmp_path))
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+    content: bytes = b"track"
+    content_hash: str = hashlib.sha256(content).hexdigest()
+    stored: Path = tmp_path / "2023/3/track.zip"
+    stored.parent.mkdir(parents=True)
+    stored.write_bytes(content)
+    await BlobStore().store(stored, content_hash)
+
+    async with DBConnectionHandler():
+        download_link: DownloadLinkPydantic = await download_link_model
+        download_link.downloaded = True
+        download_link.content_hash = content_hash
+        download_link.content_size = len(content)
+        download_link.stored_path = "2023/3/track.zip"
+        await repo.create(download_link)
+
+        second_link: DownloadLinkPydantic = deepcopy(download_link)
+        second_link.link = "https://krakenfiles.com/view/abc/file.html"
+        second_link.downloaded = False
+        second_link.content_hash = second_link.stored_path = None
+        obj: DownloadLinkPydantic = await repo.create(second_link)
+        job: DownloadJob = DownloadJob(
+            object_id=obj.pk, dl_link="link", file_path="2023/4/"  # type: ignore
+        )
+        target: Path = tmp_path / "2023/4/track.zip"
+
+        assert not await find_on_disk(job, target, len(content) + 1)
+        assert not target.exists()
+
+        assert await find_on_disk(job, target, len(content))
+        assert target.samefile(stored)
+
+        obj = (await repo.filter(pk=obj.pk)).__root__[0]  # type: ignore
+        assert obj.content_hash == content_hash
+        assert obj.stored_path == "2023/4/track.zip"
+        assert await DownloadManifestRepo().is_present(obj.stored_path, len(content))
+
+
+def test_download_tasks_end_before_redelivery() -> None:
+    """Running download shouldn't be redelivered to another worker"""
+
+    visibility_timeout: int = app.conf.get("broker_transport_options")[
+        "visibility_timeout"
+    ]
+
+    assert app.conf.worker_prefetch_multiplier == 1
+    for task in (download_file, download_files):
+        assert task.acks_late  # type: ignore
+        assert task.time_limit < visibility_timeout  # type: ignore
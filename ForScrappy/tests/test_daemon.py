@@ -0,0 +1,148 @@
+import asyncio
+from typing import Any, Dict, List
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from requests import HTTPError
+
+from use_case.daemon import CrawlDaemon
+from use_case.pipeline import CrawlPipeline, Stage
+from utils.server import HealthServer
+
+
+def use_case_factory(crawl_many: AsyncMock) -> MagicMock:
+    """Login mock returning use case with given crawl_many"""
+    use_case: MagicMock = MagicMock()
+    use_case.crawl_many = crawl_many
+    return MagicMock(return_value=use_case)
+
+
+@pytest.mark.asyncio
+async def test_crawl_daemon_recrawls_on_intervals() -> None:
+    """Categories should be crawled on their own intervals with one login"""
+
+    crawled: List[List[str]] = []
+
+    async def crawl_many(links: Dict[str, List[str]]) -> Dict[str, Any]:
+        crawled.append(sorted(links))
+        return {}
+
+    login: MagicMock = use_case_factory(AsyncMock(side_effect=crawl_many))
+    daemon: CrawlDaemon = CrawlDaemon(
+        login=login,
+        links={"trance": ["t/"], "house": ["h/"]},
+        interval=60,
+        intervals={"trance": 0},
+    )
+    run: asyncio.Task = asyncio.create_task(daemon.run())
+    await asyncio.sleep(0.05)
+    daemon.stop()
+    await asyncio.wait_for(run, 1)
+
+    assert crawled[0] == ["house", "trance"]
+    assert len(crawled) > 2
+    assert all(categories == ["trance"] for categories in crawled[1:])
+    assert login.call_count == 1
+    assert set(daemon.last_crawl) == {"trance", "house"}
+
+
+@pytest.mark.asyncio
+async def test_crawl_daemon_stop_cancels_slow_crawl() -> None:
+    """Crawl still running after stop_timeout should be cancelled"""
+
+    async def crawl_many(links: Dict[str, List[str]]) -> None:
+        await asyncio.sleep(10)
+
+    daemon: CrawlDaemon = CrawlDaemon(
+        login=use_case_factory(AsyncMock(side_effect=crawl_many)),
+        links={"trance": ["t/"]},
+        stop_timeout=0.01,
+    )
+    run: asyncio.Task = asyncio.create_task(daemon.run())
+    await asyncio.sleep(0.01)
+    assert daemon.running == ["trance"]
+
+    daemon.stop()
+    await asyncio.wait_for(run, 1)
+    assert daemon.running == []
+    assert not daemon.health()["healthy"]
+
+
+@pytest.mark.asyncio
+async def test_crawl_daemon_reports_isolated_failures() -> None:
+    """Few failed items shouldn't fail crawl, they are listed in health report"""
+
+    stats: Dict[str, Any] = {
+        "trance": {
+            "listing": {"processed": 1, "failed": 0},
+            "fetch": {"processed": 9, "failed": 1},
+        }
+    }
+    daemon: CrawlDaemon = CrawlDaemon(
+        login=use_case_factory(AsyncMock(return_value=stats)),
+        links={"trance": ["t/"]},
+    )
+
+    await daemon.crawl(["trance"])
+
+    health: Dict[str, Any] = daemon.health()
+    assert health["healthy"]
+    assert health["last_failures"] == {"trance": {"fetch": 1}}
+    assert "trance" in daemon.last_crawl
+
+    stats["trance"]["fetch"] = {"processed": 4, "failed": 6}
+    await daemon.crawl(["trance"])
+    assert not daemon.health()["healthy"]
+    assert "fetch" in daemon.last_error  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_health_server() -> None:
+    """Health endpoint should follow daemon state"""
+
+    login: MagicMock = use_case_factory(AsyncMock(side_effect=ValueError("down")))
+    daemon: CrawlDaemon = CrawlDaemon(login=login, links={"trance": ["t/"]})
+    server: HealthServer = HealthServer(daemon.health)
+
+    async with TestClient(TestServer(server.app)) as client:
+        assert (await client.get("/health")).status == 200
+
+        await daemon.crawl(["trance"])
+        response = await client.get("/health")
+        assert response.status == 503
+        assert (await response.json())["last_error"] == "ValueError: down"
+
+    await daemon.crawl(["trance"])
+    assert login.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_crawl_daemon_detects_failed_stages() -> None:
+    """Fetch errors counted by pipeline should fail crawl and renew session"""
+
+    async def listing(pages: List[str]) -> List[str]:
+        return [f"{page}thread" for page in pages]
+
+    async def fetch(threads: List[str]) -> List[str]:
+        raise HTTPError("403 Client Error: Forbidden")
+
+    async def crawl_many(links: Dict[str, List[str]]) -> Dict[str, Any]:
+        return {
+            category: await CrawlPipeline(
+                [Stage("listing", listing), Stage("fetch", fetch)], report_interval=0
+            ).run(pages)
+            for category, pages in links.items()
+        }
+
+    login: MagicMock = use_case_factory(AsyncMock(side_effect=crawl_many))
+    daemon: CrawlDaemon = CrawlDaemon(login=login, links={"trance": ["t/"]})
+
+    await daemon.crawl(["trance"])
+
+    assert not daemon.health()["healthy"]
+    assert "fetch" in daemon.last_error  # type: ignore
+    assert daemon.last_crawl == {}
+
+    await daemon.crawl(["trance"])
+    assert login.call_count == 2
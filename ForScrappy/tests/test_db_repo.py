@@ -1,7 +1,17 @@
+import os
+from datetime import datetime
+from pathlib import Path
+
 import pytest
 
 from models import DownloadLinkPydantic, LinkModelPydantic
-from repos.db_repo import LinkModelRepo, DownloadLinksRepo
+from models.migrations import apply_migrations
+from repos.db_repo import (
+    CrawlCheckpointRepo,
+    LinkModelRepo,
+    DownloadLinksRepo,
+    DownloadManifestRepo,
+)
 from settings import settings
 from utils.utils import DBConnectionHandler
 from models.types import MyTortoise
@@ -97,3 +107,232 @@ async def test_download_links_create_method(
         assert (
             res.link_model.for_clubbers_url == download_link.link_model.for_clubbers_url
         )
+
+
+@pytest.mark.asyncio
+async def test_download_links_values_list(download_link_model, clean_database) -> None:
+    """values_list should stream only selected columns of filtered rows"""
+
+    download_link = await download_link_model
+    download_link.error = True
+    download_link.error_message = "error"
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+
+    async with DBConnectionHandler():
+        await repo.create(download_link)
+
+        rows = [
+            row
+            async for row in repo.values_list(
+                "link", "error_message", batch_size=1, error=True
+            )
+        ]
+        assert rows == [(download_link.link, "error")]
+
+        records = [row async for row in repo.values("link", error=False)]
+        assert records == []
+
+
+@pytest.mark.asyncio
+async def test_download_links_stats_tracking(
+    download_link_model, clean_database
+) -> None:
+    """Stats counters should follow create and update_fields write paths"""
+
+    download_link = await download_link_model
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+
+    async with DBConnectionHandler():
+        obj: DownloadLinkPydantic = await repo.create(download_link)
+        await repo.update_fields(obj, downloaded=True)
+
+        stats = await repo.stats_repo.summary()
+        assert stats["total"] == {
+            "total": 1,
+            "downloaded": 1,
+            "error": 0,
+            "not_exists": 0,
+        }
+        assert stats["category"][download_link.category]["downloaded"] == 1
+
+        await repo.stats_repo.rebuild()
+        assert await repo.stats_repo.summary() == stats
+
+
+@pytest.mark.asyncio
+async def test_download_links_claim(download_link_model, clean_database) -> None:
+    """Claimed links should not be claimed again until lease expires"""
+
+    download_link = await download_link_model
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+
+    async with DBConnectionHandler():
+        await repo.create(download_link)
+
+        claimed = await repo.claim(owner="runner-1", limit=10, lease_seconds=60)  # type: ignore
+        assert claimed
+        assert [obj.link for obj in claimed.__root__] == [download_link.link]
+
+        assert await repo.claim(owner="runner-2", limit=10, lease_seconds=60) is None
+
+        await repo.model.all().update(lease_expires=datetime(2000, 1, 1))
+        reclaimed = await repo.claim(owner="runner-2", limit=10, lease_seconds=60)  # type: ignore
+        assert reclaimed
+        assert len(reclaimed.__root__) == 1
+
+        # run which already handled the link doesn't claim it back
+        await repo.model.all().update(lease_expires=datetime(2000, 1, 1))
+        pk: int = reclaimed.__root__[0].pk
+        assert (
+            await repo.claim(owner="runner-2", limit=10, lease_seconds=60, after=pk)
+            is None
+        )
+
+
+@pytest.mark.asyncio
+async def test_download_manifest_scan(tmp_path: Path, clean_database) -> None:
+    """Scan should index files incrementally, skipping blobs and part files"""
+
+    (tmp_path / "2023/4").mkdir(parents=True)
+    (tmp_path / ".blobs/ab").mkdir(parents=True)
+    (tmp_path / "2023/4/a.zip").write_bytes(b"a" * 10)
+    (tmp_path / "2023/4/b.zip").write_bytes(b"b" * 20)
+    (tmp_path / "2023/4/1.part").write_bytes(b"c")
+    (tmp_path / ".blobs/ab/abc").write_bytes(b"a" * 10)
+    repo: DownloadManifestRepo = DownloadManifestRepo()
+
+    async with DBConnectionHandler():
+        assert await repo.scan(tmp_path) == {"total": 2, "changed": 2, "removed": 0}
+        assert await repo.scan(tmp_path) == {"total": 2, "changed": 0, "removed": 0}
+        assert await repo.is_present("2023/4/a.zip", 10)
+        assert not await repo.is_present("2023/4/a.zip", 11)
+        assert not await repo.is_present("2023/4/1.part")
+
+        (tmp_path / "2023/4/a.zip").write_bytes(b"a" * 15)
+        os.utime(tmp_path / "2023/4/a.zip", (1, 1))
+        (tmp_path / "2023/4/b.zip").unlink()
+
+        assert await repo.scan(tmp_path, with_hash=True) == {
+            "total": 1,
+            "changed": 1,
+            "removed": 1,
+        }
+        assert await repo.is_present("2023/4/a.zip", 15)
+        assert not await repo.is_present("2023/4/b.zip")
+        assert (await repo.model.get(path="2023/4/a.zip")).content_hash
+
+
+@pytest.mark.asyncio
+async def test_download_links_mark_present_downloaded(
+    download_link_model, clean_database
+) -> None:
+    """Links with file listed in manifest should be marked as downloaded in bulk"""
+
+    download_link = await download_link_model
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+
+    async with DBConnectionHandler():
+        download_link.stored_path = "2023/4/a.zip"
+        download_link.content_size = 10
+        obj: DownloadLinkPydantic = await repo.create(download_link)
+        await DownloadManifestRepo().add("2023/4/a.zip", 11, 1.0)
+
+        assert await repo.mark_present_downloaded() == 0
+
+        await DownloadManifestRepo().add("2023/4/a.zip", 10, 1.0)
+        assert await repo.mark_present_downloaded() == 1
+
+        obj = (await repo.filter(pk=obj.pk)).__root__[0]  # type: ignore
+        assert obj.downloaded
+        assert (await repo.stats_repo.summary())["total"]["downloaded"] == 1
+
+
+@pytest.mark.asyncio
+async def test_download_links_mark_present_downloaded_without_stored_path(
+    download_link_model, clean_database
+) -> None:
+    """Links saved before stored_path existed should match date folder and name"""
+
+    download_link = await download_link_model
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+
+    async with DBConnectionHandler():
+        download_link.published_date = datetime(2023, 4, 4, 12)
+        download_link.name = "b.zip"
+        obj: DownloadLinkPydantic = await repo.create(download_link)
+        await DownloadManifestRepo().add("2023/4/b.zip", 10, 1.0)
+
+        assert await repo.mark_present_downloaded() == 1
+
+        obj = (await repo.filter(pk=obj.pk)).__root__[0]  # type: ignore
+        assert obj.downloaded
+        assert obj.stored_path == "2023/4/b.zip"
+
+
+@pytest.mark.asyncio
+async def test_crawl_checkpoint_frontier(clean_database) -> None:
+    """Done threads shouldn't become pending again, categories are separate"""
+
+    repo: CrawlCheckpointRepo = CrawlCheckpointRepo()
+
+    async with DBConnectionHandler():
+        await repo.add_threads("trance", ["t1", "t2", "t3"])
+        await repo.mark_done("trance", repo.PAGE, ["p1"])
+        await repo.mark_done("trance", repo.THREAD, ["t1"])
+        await repo.add_threads("trance", ["t1", "t4"])
+        await repo.add_threads("house", ["h1"])
+
+        pages_done, threads_pending = await repo.get_frontier("trance")
+        assert pages_done == {"p1"}
+        assert sorted(threads_pending) == ["t2", "t3", "t4"]
+
+        await repo.clear("trance")
+        assert await repo.get_frontier("trance") == (set(), [])
+        assert await repo.get_frontier("house") == (set(), ["h1"])
+
+
+@pytest.mark.asyncio
+async def test_migrations_add_columns_to_existing_table(clean_database) -> None:
+    """Missing migration should add columns of table created by older release"""
+
+    async with DBConnectionHandler():
+        connection = MyTortoise.get_connection("default")
+        await connection.execute_script(
+            'ALTER TABLE "download_links" DROP COLUMN "lease_owner";'
+            'DELETE FROM "schema_migrations" WHERE "version" = 1;'
+        )
+
+        assert await apply_migrations(connection) == [1]
+        assert await apply_migrations(connection) == []
+
+        rows = await connection.execute_query_dict(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_name = 'download_links' AND column_name = 'lease_owner'"
+        )
+        assert rows == [{"column_name": "lease_owner"}]
+
+
+@pytest.mark.asyncio
+async def test_migrations_seed_stats_of_existing_links(
+    download_link_model, clean_database
+) -> None:
+    """Links saved before counters existed should be counted on upgrade"""
+
+    download_link = await download_link_model
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+
+    async with DBConnectionHandler():
+        await repo.create(download_link)
+        connection = MyTortoise.get_connection("default")
+        # database of a release without counters
+        await connection.execute_script(
+            'UPDATE "download_links" SET "downloaded" = TRUE;'
+            'DELETE FROM "download_links_stats";'
+            'DELETE FROM "schema_migrations" WHERE "version" = 5;'
+        )
+
+        assert await apply_migrations(connection) == [5]
+
+        stats = await repo.stats_repo.summary()
+        assert stats["total"]["total"] == 1
+        assert stats["total"]["downloaded"] == 1
@@ -0,0 +1,195 @@
+import time
+from datetime import datetime
+from logging import Logger
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+import pytest
+
+from bench.runner import QueryCounter
+from logger import get_module_logger
+from models import DownloadLinkPydantic, LinkModelPydantic
+from models.models import DownloadLinks, LinkModel
+from repos.db_repo import DownloadLinksRepo, DownloadLinksStatsRepo, LinkModelRepo
+from utils.utils import CATEGORIES, DBConnectionHandler
+
+pytestmark = pytest.mark.benchmark
+
+logger: Logger = get_module_logger("benchmark")
+
+FORUM_URL: str = "https://forum.example/trance/thread-{}.html"
+FILE_URL: str = "https://krakenfiles.example/view/{}/file.html"
+SEED_BATCH: int = 5000
+REPEAT: int = 20
+
+# max queries issued by one call, independent of number of rows
+QUERY_BUDGETS: Dict[str, int] = {
+    "LinkModelRepo.get_or_create": 2,
+    "LinkModelRepo.filter": 1,
+    "LinkModelRepo.all": 1,
+    "LinkModelRepo.save": 1,
+    "LinkModelRepo.update_fields": 2,
+    "LinkModelRepo.create": 1,
+    "DownloadLinksRepo.get_or_create": 7,
+    "DownloadLinksRepo.filter": 2,
+    "DownloadLinksRepo.all": 2,
+    "DownloadLinksRepo.save": 4,
+    "DownloadLinksRepo.update_fields": 3,
+    "DownloadLinksRepo.create": 5,
+}
+
+Operation = Callable[[int], Awaitable[object]]
+
+
+async def seed(rows: int) -> None:
+    """Insert rows of LinkModel, each with one DownloadLinks row, and their stats"""
+    for start in range(0, rows, SEED_BATCH):
+        await LinkModel.bulk_create(
+            [
+                LinkModel(
+                    name=f"Thread {index}", for_clubbers_url=FORUM_URL.format(index)
+                )
+                for index in range(start, min(start + SEED_BATCH, rows))
+            ]
+        )
+
+    link_model_ids: List[int] = [
+        pk for pk, in await LinkModel.all().order_by("id").values_list("id")
+    ]
+    for start in range(0, rows, SEED_BATCH):
+        await DownloadLinks.bulk_create(
+            [
+                DownloadLinks(
+                    name=f"Track {index}",
+                    link=FILE_URL.format(index),
+                    link_model_id=link_model_ids[index],
+                    category=CATEGORIES[index % len(CATEGORIES)],
+                    published_date=datetime(2023, index % 12 + 1, 1),
+                    downloaded=index % 2 == 0,
+                )
+                for index in range(start, min(start + SEED_BATCH, rows))
+            ]
+        )
+    await DownloadLinksStatsRepo().rebuild()
+
+
+async def measure(operations: Dict[str, Operation]) -> Dict[str, Tuple[int, float]]:
+    """
+    Call every operation REPEAT times
+    :return: max number of queries of one call and mean time in ms per operation
+    """
+    results: Dict[str, Tuple[int, float]] = {}
+    for name, operation in operations.items():
+        queries: int = 0
+        elapsed: float = 0.0
+        for call in range(REPEAT):
+            with QueryCounter() as counter:
+                started: float = time.perf_counter()
+                await operation(call)
+                elapsed += time.perf_counter() - started
+            queries = max(queries, sum(counter.counts.values()))
+
+        results[name] = (queries, elapsed / REPEAT * 1000)
+        logger.info(f"{name}: {queries} queries, {results[name][1]:.2f} ms")
+    return results
+
+
+def over_budget(results: Dict[str, Tuple[int, float]]) -> Dict[str, str]:
+    return {
+        name: f"{queries} queries, budget {QUERY_BUDGETS[name]}"
+        for name, (queries, _) in results.items()
+        if queries > QUERY_BUDGETS[name]
+    }
+
+
+def spread(rows: int, call: int) -> int:
+    """Index of a seeded row, different for every call"""
+    return call * 7919 % rows
+
+
+@pytest.mark.asyncio
+async def test_link_model_repo_benchmark(bench_rows: int) -> None:
+    """LinkModelRepo operations should stay within query budgets on large table"""
+
+    repo: LinkModelRepo = LinkModelRepo()
+
+    def new(call: int, kind: str) -> LinkModelPydantic:
+        return LinkModelPydantic(for_clubbers_url=FORUM_URL.format(f"{kind}-{call}"))
+
+    def existing(call: int) -> LinkModelPydantic:
+        return LinkModelPydantic(
+            for_clubbers_url=FORUM_URL.format(spread(bench_rows, call))
+        )
+
+    async with DBConnectionHandler():
+        await seed(bench_rows)
+        first_pk: int = (await LinkModel.all().order_by("id").first()).pk  # type: ignore
+
+        def pk(call: int) -> int:
+            return first_pk + spread(bench_rows, call)
+
+        results: Dict[str, Tuple[int, float]] = await measure(
+            {
+                "LinkModelRepo.get_or_create": lambda call: repo.get_or_create(
+                    new(call, "get") if call % 2 else existing(call)
+                ),
+                "LinkModelRepo.filter": lambda call: repo.filter(pk=pk(call)),
+                "LinkModelRepo.all": lambda call: repo.all(),
+                "LinkModelRepo.save": lambda call: repo.save(new(call, "save")),
+                "LinkModelRepo.update_fields": lambda call: repo.update_fields(
+                    LinkModelPydantic(pk=pk(call), for_clubbers_url=""),
+                    name=f"Renamed {call}",
+                ),
+                "LinkModelRepo.create": lambda call: repo.create(new(call, "create")),
+            }
+        )
+
+    assert not over_budget(results)
+
+
+@pytest.mark.asyncio
+async def test_download_links_repo_benchmark(bench_rows: int) -> None:
+    """DownloadLinksRepo operations should stay within query budgets on large table"""
+
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+
+    async with DBConnectionHandler():
+        await seed(bench_rows)
+        first_pk: int = (await DownloadLinks.all().order_by("id").first()).pk  # type: ignore
+        pks: List[int] = [first_pk + spread(bench_rows, call) for call in range(REPEAT)]
+        objects: List[DownloadLinkPydantic] = (
+            await repo.filter(id__in=pks)  # type: ignore
+        ).__root__
+
+        def new(call: int, kind: str) -> DownloadLinkPydantic:
+            return DownloadLinkPydantic(
+                link=FILE_URL.format(f"{kind}-{call}"),
+                link_model=objects[call].link_model,
+                category=CATEGORIES[0],
+                # stats bucket of seeded rows, so counters are only updated
+                published_date=datetime(2023, 1, 1),
+            )
+
+        def renamed(call: int) -> DownloadLinkPydantic:
+            return objects[call].copy(update={"name": f"Renamed {call}"})
+
+        results: Dict[str, Tuple[int, float]] = await measure(
+            {
+                "DownloadLinksRepo.get_or_create": lambda call: repo.get_or_create(
+                    new(call, "get") if call % 2 else objects[call]
+                ),
+                "DownloadLinksRepo.filter": lambda call: repo.filter(
+                    category=CATEGORIES[call % len(CATEGORIES)],
+                    published_date=datetime(2023, call % 12 + 1, 1),
+                ),
+                "DownloadLinksRepo.all": lambda call: repo.all(),
+                "DownloadLinksRepo.save": lambda call: repo.save(renamed(call)),
+                "DownloadLinksRepo.update_fields": lambda call: repo.update_fields(
+                    objects[call], downloaded=not objects[call].downloaded
+                ),
+                "DownloadLinksRepo.create": lambda call: repo.create(
+                    new(call, "create")
+                ),
+            }
+        )
+
+    assert not over_budget(results)
@@ -0,0 +1,217 @@
+import asyncio
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from settings import settings
+from tasks.downloader import DownloadEngine, DownloadJob, DownloadProgress
+from tasks.writer import FileWriter
+
+
+@pytest.mark.asyncio
+async def test_download_engine_many(
+    tmp_path: Path, monkeypatch, file_server: Callable, file_content: bytes
+) -> None:
+    """Engine should download all jobs concurrently and report progress"""
+
+    monkeypatch.setattr(settings, "download_path", str(tmp_path))
+    reported: List[DownloadProgress] = []
+
+    async with file_server() as server:
+        jobs: List[DownloadJob] = [
+            DownloadJob(
+                object_id=pk,
+                dl_link=str(server.make_url(f"/file/{pk}")),
+                file_path=f"2023/{pk}/",
+            )
+            for pk in (1, 2, 3)
+        ]
+
+        async with DownloadEngine(
+            concurrency=2, chunk_size=1024, on_progress=reported.append
+        ) as engine:
+            results = await engine.download_many(jobs)
+
+    assert results == [tmp_path / f"2023/{pk}/file.zip" for pk in (1, 2, 3)]
+    assert all(path.read_bytes() == file_content for path in results)  # type: ignore
+    assert engine.progress[1].percent == 100.0
+    assert reported
+
+
+@pytest.mark.parametrize("query", ["", "?ranges=no"])
+@pytest.mark.asyncio
+async def test_download_engine_resume(
+    tmp_path: Path, monkeypatch, file_server: Callable, file_content: bytes, query: str
+) -> None:
+    """Engine should resume .part file with Range request or restart without range support"""
+
+    monkeypatch.setattr(settings, "download_path", str(tmp_path))
+
+    async with file_server() as server:
+        job: DownloadJob = DownloadJob(
+            object_id=1,
+            dl_link=str(server.make_url(f"/file/1{query}")),
+            file_path="2023/4/",
+        )
+        part_path: Path = DownloadEngine.get_part_path(job)
+        part_path.parent.mkdir(parents=True)
+        part_path.write_bytes(file_content[:1234])
+
+        async with DownloadEngine() as engine:
+            assert await engine.get_offset(job) == 1234
+            result: Path = await engine.download(job)
+
+    assert result == tmp_path / "2023/4/file.zip"
+    assert result.read_bytes() == file_content
+    assert not part_path.exists()
+
+
+@pytest.mark.parametrize("query", ["", "?ranges=no"])
+@pytest.mark.asyncio
+async def test_download_engine_segmented(
+    tmp_path: Path, monkeypatch, file_server: Callable, file_content: bytes, query: str
+) -> None:
+    """Engine should download big files in segments or fall back to single stream"""
+
+    monkeypatch.setattr(settings, "download_path", str(tmp_path))
+
+    async with file_server() as server:
+        job: DownloadJob = DownloadJob(
+            object_id=1,
+            dl_link=str(server.make_url(f"/file/1{query}")),
+            file_path="2023/4/",
+        )
+        async with DownloadEngine(
+            chunk_size=1000, segments=3, segment_threshold=1000
+        ) as engine:
+            result: Path = await engine.download(job)
+
+    assert result.read_bytes() == file_content
+    assert engine.progress[1].downloaded == len(file_content)
+
+
+@pytest.mark.asyncio
+async def test_download_engine_segment_failure_cancels_others(
+    tmp_path: Path, monkeypatch, file_content: bytes
+) -> None:
+    """Failed segment should cancel the others before the file is closed"""
+
+    monkeypatch.setattr(settings, "download_path", str(tmp_path))
+    events: List[str] = []
+
+    async def handler(request: web.Request) -> web.StreamResponse:
+        first, last = request.headers["Range"].split("=")[1].split("-")
+        if first == "0" and last != "0":
+            raise web.HTTPInternalServerError()
+        response: web.StreamResponse = web.StreamResponse(
+            status=206,
+            headers={
+                "content-disposition": 'attachment; filename="file.zip"',
+                "Content-Range": f"bytes {first}-{last}/{len(file_content)}",
+            },
+        )
+        await response.prepare(request)
+        await response.write(file_content[int(first) : int(first) + 10])
+        await asyncio.sleep(10)
+        return response
+
+    download_segment = DownloadEngine._download_segment
+
+    async def segment(*args, **kwargs) -> None:
+        try:
+            await download_segment(*args, **kwargs)
+        except asyncio.CancelledError:
+            events.append("cancelled")
+            raise
+
+    close = FileWriter.close
+
+    async def close_writer(self: FileWriter, failed: bool = False) -> None:
+        events.append("closed")
+        await close(self, failed)
+
+    monkeypatch.setattr(DownloadEngine, "_download_segment", segment)
+    monkeypatch.setattr(FileWriter, "close", close_writer)
+    app: web.Application = web.Application()
+    app.router.add_get("/file", handler)
+
+    async with TestServer(app) as server:
+        job: DownloadJob = DownloadJob(
+            object_id=1, dl_link=str(server.make_url("/file")), file_path="2023/4/"
+        )
+        async with DownloadEngine(
+            chunk_size=10, segments=3, segment_threshold=1000
+        ) as engine:
+            with pytest.raises(aiohttp.ClientResponseError):
+                await engine.download(job)
+
+    assert events == ["cancelled", "cancelled", "closed"]
+    assert not DownloadEngine.get_part_path(job).exists()
+
+
+@pytest.mark.asyncio
+async def test_download_engine_resume_from_checkpoint(
+    tmp_path: Path, monkeypatch, file_server: Callable, file_content: bytes
+) -> None:
+    """Data written after last checkpoint shouldn't be trusted on resume"""
+
+    monkeypatch.setattr(settings, "download_path", str(tmp_path))
+    checkpoints: List[int] = []
+
+    async def on_checkpoint(job: DownloadJob, offset: int) -> None:
+        checkpoints.append(offset)
+
+    async with file_server() as server:
+        job: DownloadJob = DownloadJob(
+            object_id=1,
+            dl_link=str(server.make_url("/file/1")),
+            file_path="2023/4/",
+            offset=1000,
+        )
+        part_path: Path = DownloadEngine.get_part_path(job)
+        part_path.parent.mkdir(parents=True)
+        part_path.write_bytes(file_content[:1000] + b"\0" * 5000)
+
+        async with DownloadEngine(on_checkpoint=on_checkpoint) as engine:
+            assert await engine.get_offset(job) == 1000
+            result: Path = await engine.download(job)
+
+    assert result.read_bytes() == file_content
+    assert checkpoints == [len(file_content)]
+
+
+@pytest.mark.parametrize("segments", [1, 2])
+@pytest.mark.asyncio
+async def test_download_engine_skips_present_file(
+    tmp_path: Path,
+    monkeypatch,
+    file_server: Callable,
+    file_content: bytes,
+    segments: int,
+) -> None:
+    """Body shouldn't be downloaded if is_present callback finds target file"""
+
+    monkeypatch.setattr(settings, "download_path", str(tmp_path))
+    checked: List[Tuple[Path, Optional[int]]] = []
+
+    async def is_present(job: DownloadJob, path: Path, size: Optional[int]) -> bool:
+        checked.append((path, size))
+        return True
+
+    async with file_server() as server:
+        job: DownloadJob = DownloadJob(
+            object_id=1, dl_link=str(server.make_url("/file/1")), file_path="2023/5/"
+        )
+        async with DownloadEngine(
+            segments=segments, segment_threshold=0, is_present=is_present
+        ) as engine:
+            result: Path = await engine.download(job)
+
+    assert result == tmp_path / "2023/5/file.zip"
+    assert checked == [(result, len(file_content))]
+    assert not result.exists()
+    assert not DownloadEngine.get_part_path(job).exists()
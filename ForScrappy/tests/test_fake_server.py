@@ -0,0 +1,97 @@
+import asyncio
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+import requests
+
+from bench.fake_server import FakeServer, FakeServerConfig, file_block
+from models.entities import LinksModelPydantic
+from repos.parser_repo import ForClubbersParser, KrakenParser
+from settings import settings
+from tasks.downloader import DownloadEngine, DownloadJob
+
+CONFIG: FakeServerConfig = FakeServerConfig(
+    pages=2, threads_per_page=5, links_per_thread=2, file_size=300 * 1024
+)
+
+
+@pytest.mark.asyncio
+async def test_fake_server_listing_and_thread() -> None:
+    """Listing and thread pages should be parsed like the real forum"""
+
+    async with FakeServer(CONFIG, port=0) as server:
+        listing: requests.Response = await asyncio.to_thread(
+            requests.get, f"{server.url}/trance/1"
+        )
+        links: LinksModelPydantic = await ForClubbersParser.parse_forum(
+            listing, "trance"
+        )
+        empty: requests.Response = await asyncio.to_thread(
+            requests.get, f"{server.url}/trance/2"
+        )
+        thread: requests.Response = await asyncio.to_thread(
+            requests.get, links.__root__[0].for_clubbers_url
+        )
+
+    urls: List[str] = [link.for_clubbers_url for link in links.__root__]
+    assert len(urls) == 5
+    assert urls[0] == f"{server.url}/trance/thread-1-0.html"
+    assert not (await ForClubbersParser.parse_forum(empty, "trance")).__root__
+    assert thread.text.count("krakenfiles/view/") == 2
+
+
+@pytest.mark.asyncio
+async def test_fake_server_kraken_download(tmp_path: Path, monkeypatch) -> None:
+    """Kraken page, token POST and file body should work with parser and engine"""
+
+    monkeypatch.setattr(settings, "download_path", str(tmp_path))
+
+    async with FakeServer(CONFIG, port=0) as server:
+        monkeypatch.setattr(settings, "kraken_base_url", server.url)
+        parser: KrakenParser = KrakenParser(session=requests.Session())
+        # parser blocks on requests, so it runs outside of server event loop
+        result: Dict = await asyncio.to_thread(
+            lambda: asyncio.run(
+                parser.get_download_link(
+                    f"{server.url}/krakenfiles/view/abc123/file.html"
+                )
+            )
+        )
+
+        job: DownloadJob = DownloadJob(
+            object_id=1, dl_link=result["dl_link"], file_path="2023/1/"
+        )
+        async with DownloadEngine(segments=3, segment_threshold=0) as engine:
+            path: Path = await engine.download(job)
+
+    assert result["source_hash"] == "abc123"
+    assert result["published_date"].year == 2023
+    assert path.name == "abc123.mp3"
+    content: bytes = path.read_bytes()
+    block: bytes = file_block("abc123")
+    assert len(content) == CONFIG.file_size
+    assert content[: len(block)] == block
+    assert content[len(block) : 2 * len(block)] == block
+
+
+@pytest.mark.asyncio
+async def test_fake_server_errors_and_throttling() -> None:
+    """Configured error rate and rate limit should be applied to every route"""
+
+    async with FakeServer(
+        FakeServerConfig(error_rate=1.0), port=0
+    ) as failing, FakeServer(FakeServerConfig(rate_limit=1), port=0) as throttled:
+        error: requests.Response = await asyncio.to_thread(
+            requests.get, f"{failing.url}/trance/"
+        )
+        statuses: List[int] = [
+            (
+                await asyncio.to_thread(requests.get, f"{throttled.url}/trance/")
+            ).status_code
+            for _ in range(2)
+        ]
+
+    assert error.status_code == 500
+    assert statuses == [200, 429]
+    assert throttled.stats.throttled == 1
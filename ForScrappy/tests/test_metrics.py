@@ -0,0 +1,67 @@
+import logging
+from typing import Optional
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from prometheus_client import REGISTRY
+
+from utils.metrics import (
+    BACKLOG,
+    cache_lookup,
+    instrument_repo,
+    metrics_route,
+    track_db_queries,
+)
+
+
+def sample(name: str, **labels: str) -> float:
+    value: Optional[float] = REGISTRY.get_sample_value(name, labels)
+    return value or 0.0
+
+
+@instrument_repo
+class FakeRepo:
+    async def get(self, pk: int) -> int:
+        # tortoise client logs every query this way
+        logging.getLogger("tortoise.db_client").debug("%s: %s", "SELECT 1", [pk])
+        logging.getLogger("tortoise.db_client").debug("Created connection pool")
+        return pk
+
+
+@pytest.mark.asyncio
+async def test_instrument_repo_counts_queries_per_method() -> None:
+    """Only query records should be counted, for the repo method issuing them"""
+
+    track_db_queries()
+    track_db_queries()
+    queries: float = sample("forscrappy_db_queries_total", method="FakeRepo.get")
+    calls: float = sample("forscrappy_repo_seconds_count", method="FakeRepo.get")
+
+    assert await FakeRepo().get(1) == 1
+    assert await FakeRepo().get(2) == 2
+
+    assert sample("forscrappy_db_queries_total", method="FakeRepo.get") == queries + 2
+    assert sample("forscrappy_repo_seconds_count", method="FakeRepo.get") == calls + 2
+    assert logging.getLogger("tortoise.db_client").propagate
+
+
+@pytest.mark.asyncio
+async def test_metrics_route() -> None:
+    """Gauges should be refreshed before metrics are served in text format"""
+
+    async def refresh() -> None:
+        BACKLOG.labels(queue="links").set(7)
+
+    cache_lookup("test", True)
+    app: web.Application = web.Application()
+    app.router.add_get("/metrics", metrics_route(refresh=refresh))
+
+    async with TestClient(TestServer(app)) as client:
+        response = await client.get("/metrics")
+        body: str = await response.text()
+
+    assert response.status == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    assert 'forscrappy_backlog{queue="links"} 7.0' in body
+    assert 'forscrappy_cache_requests_total{cache="test",result="hit"}' in body
@@ -0,0 +1,73 @@
+import asyncio
+from typing import AsyncIterator, List
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from pytest_mock import MockerFixture
+
+from models import DownloadLinkPydantic
+from repos.db_repo import DownloadLinksRepo
+from repos.notify_repo import DownloadLinksListener
+from utils.utils import DBConnectionHandler
+
+
+@pytest.mark.asyncio
+async def test_listener_batches_burst() -> None:
+    """Notifications arriving within batch window should be yielded as one batch"""
+
+    listener: DownloadLinksListener = DownloadLinksListener(
+        batch_size=3, batch_window=0.1
+    )
+    for pk in range(1, 5):
+        listener.queue.put_nowait(pk)
+
+    batches: AsyncIterator[List[int]] = listener.batches()
+
+    assert await batches.__anext__() == [1, 2, 3]
+    assert await batches.__anext__() == [4]
+
+
+@pytest.mark.asyncio
+async def test_listener_receives_created_links(
+    download_link_model, clean_database
+) -> None:
+    """Creating DownloadLinks should notify listener with object id"""
+
+    download_link: DownloadLinkPydantic = await download_link_model
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+
+    async with DBConnectionHandler():
+        async with DownloadLinksListener(batch_window=0.1) as listener:
+            obj: DownloadLinkPydantic = await repo.create(download_link)
+            batch: List[int] = await asyncio.wait_for(
+                listener.batches().__anext__(), timeout=5
+            )
+
+    assert batch == [obj.pk]
+
+
+@pytest.mark.asyncio
+async def test_listener_reconnects_with_backoff(mocker: MockerFixture) -> None:
+    """Lost connection should be replaced, waiting longer after every failed try"""
+
+    connection: MagicMock = MagicMock(add_listener=AsyncMock())
+    connect: AsyncMock = mocker.patch(
+        "repos.notify_repo.asyncpg.connect",
+        side_effect=[OSError("refused"), OSError("refused"), connection],
+    )
+    sleep: AsyncMock = mocker.patch("repos.notify_repo.asyncio.sleep")
+    lost: MagicMock = MagicMock()
+
+    listener: DownloadLinksListener = DownloadLinksListener(
+        reconnect_delay=1, reconnect_max_delay=1.5
+    )
+    listener.connection = lost
+    await listener.reconnect()
+
+    lost.terminate.assert_called_once()
+    assert connect.call_count == 3
+    assert [call.args[0] for call in sleep.call_args_list] == [1, 1.5]
+    assert listener.connection is connection
+    connection.add_listener.assert_awaited_once_with(
+        listener.channel, listener._on_notification
+    )
@@ -0,0 +1,96 @@
+import asyncio
+from typing import Any, List
+
+import pytest
+
+from use_case.pipeline import CrawlPipeline, Stage, fair_share
+
+
+@pytest.mark.asyncio
+async def test_crawl_pipeline_runs_all_stages() -> None:
+    """Every item should pass all stages, failures are counted, not raised"""
+
+    persisted: List[int] = []
+
+    async def expand(items: List[int]) -> List[int]:
+        return [item * 10 + i for item in items for i in range(3)]
+
+    async def double(items: List[int]) -> List[int]:
+        if 11 in items:
+            raise ValueError("broken item")
+        return [item * 2 for item in items]
+
+    async def persist(items: List[int]) -> List[Any]:
+        persisted.extend(items)
+        return []
+
+    pipeline: CrawlPipeline = CrawlPipeline(
+        [
+            Stage("expand", expand),
+            Stage("double", double, workers=3, queue_size=2),
+            Stage("persist", persist, batch_size=4),
+        ],
+        report_interval=0,
+    )
+    stats = await pipeline.run([1, 2])
+
+    assert sorted(persisted) == [20, 24, 40, 42, 44]
+    assert stats["expand"]["emitted"] == 6
+    assert stats["double"]["failed"] == 1
+    assert stats["persist"]["processed"] == 5
+    assert all(stage["depth"] == 0 for stage in stats.values())
+
+
+@pytest.mark.asyncio
+async def test_crawl_pipeline_backpressure() -> None:
+    """Slow stage should block previous stage once its queue is full"""
+
+    release: asyncio.Event = asyncio.Event()
+
+    async def produce(items: List[int]) -> List[int]:
+        return list(range(100))
+
+    async def slow(items: List[int]) -> List[Any]:
+        await release.wait()
+        return []
+
+    producer: Stage = Stage("produce", produce)
+    consumer: Stage = Stage("slow", slow, queue_size=5)
+    run: asyncio.Task = asyncio.create_task(
+        CrawlPipeline([producer, consumer], report_interval=0).run([0])
+    )
+    await asyncio.sleep(0.05)
+
+    assert consumer.depth == 5
+    assert producer.stats.emitted == 6
+
+    release.set()
+    stats = await run
+    assert stats["slow"]["processed"] == 100
+
+
+@pytest.mark.asyncio
+async def test_crawl_pipeline_start_items() -> None:
+    """Start items should go straight to queue of named stage"""
+
+    seen: List[str] = []
+
+    async def listing(items: List[str]) -> List[str]:
+        return [f"{item}/thread" for item in items]
+
+    async def fetch(items: List[str]) -> List[Any]:
+        seen.extend(items)
+        return []
+
+    await CrawlPipeline(
+        [Stage("listing", listing), Stage("fetch", fetch)], report_interval=0
+    ).run(["page"], start={"fetch": ["pending"]})
+
+    assert sorted(seen) == ["page/thread", "pending"]
+
+
+def test_fair_share() -> None:
+    """Workers should be split evenly, every part gets at least one"""
+
+    assert [fair_share(8, 3, index) for index in range(3)] == [3, 3, 2]
+    assert [fair_share(2, 3, index) for index in range(3)] == [1, 1, 1]
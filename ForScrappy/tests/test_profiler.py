@@ -0,0 +1,54 @@
+import time
+from pathlib import Path
+from typing import Dict
+
+from bs4 import BeautifulSoup
+
+from settings import ROOT_PATH
+from utils.profiler import Profiler, classify
+
+SITE_PACKAGES: str = "/usr/lib/python3/site-packages"
+
+
+def test_classify() -> None:
+    """Stage should come from innermost library frame, caller from app code"""
+
+    frames = [
+        ("/usr/lib/python3/socket.py", 700, "readinto"),
+        (f"{SITE_PACKAGES}/urllib3/response.py", 500, "read"),
+        (f"{SITE_PACKAGES}/requests/sessions.py", 600, "get"),
+        (f"{ROOT_PATH}/repos/request_repo.py", 44, "fetch"),
+        (f"{ROOT_PATH}/cli.py", 10, "main"),
+    ]
+
+    assert classify(frames) == ("http", "repos/request_repo.py:44 fetch")
+    assert classify(frames[3:]) == ("app", "repos/request_repo.py:44 fetch")
+    assert classify([("/usr/lib/python3/json/decoder.py", 1, "decode")]) == (
+        "other",
+        None,
+    )
+
+
+def test_profiler_writes_folded_stacks_and_summary(tmp_path: Path) -> None:
+    """Samples of parsing should be attributed to parse stage and app caller"""
+
+    html: str = "<div>" + "<a href='#'>link</a>" * 2000 + "</div>"
+
+    profiler: Profiler = Profiler(
+        "test", directory=str(tmp_path), interval=0.001, memory_frames=5
+    )
+    profiler.start()
+    deadline: float = time.monotonic() + 0.5
+    while time.monotonic() < deadline:
+        BeautifulSoup(html, "html.parser").find_all("a")
+    paths: Dict[str, Path] = profiler.stop()
+
+    folded: str = paths["folded"].read_text()
+    summary: str = paths["summary"].read_text()
+
+    assert profiler.stages["parse"] > 0
+    assert any("test_profiler.py" in caller for caller in profiler.callers["parse"])
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in folded.splitlines())
+    assert "bs4/" in folded
+    assert "parse:" in summary
+    assert "memory peak" in summary
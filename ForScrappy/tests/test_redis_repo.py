@@ -0,0 +1,137 @@
+import asyncio
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Callable, Optional
+
+import pytest
+from redis.asyncio import Redis
+
+from repos.redis_repo import DownloadBudget, InFlightRegistry, RedisSemaphore
+from settings import settings
+from tasks.downloader import DownloadEngine, DownloadJob
+
+
+@asynccontextmanager
+async def download_budget(
+    redis_url: str, transfers_per_host: int = 2, bandwidth: int = 0
+) -> AsyncIterator[DownloadBudget]:
+    """DownloadBudget on empty test redis database"""
+    redis: Redis = Redis.from_url(redis_url)
+    await redis.flushdb()
+    budget: DownloadBudget = DownloadBudget(
+        redis=redis,
+        key_prefix="test",
+        transfers_per_host=transfers_per_host,
+        bandwidth=bandwidth,
+    )
+    try:
+        yield budget
+    finally:
+        await budget.close()
+
+
+@pytest.mark.asyncio
+async def test_semaphore_limits_transfers_per_host(redis_url: str) -> None:
+    """Only transfers_per_host slots of a host can be taken at once"""
+
+    async with download_budget(redis_url) as budget:
+        semaphore: RedisSemaphore = budget.semaphore("krakenfiles.com")
+
+        first: Optional[str] = await semaphore.try_acquire()
+        assert first
+        assert await semaphore.try_acquire()
+        assert await semaphore.try_acquire() is None
+        assert await budget.semaphore("other.com").try_acquire()
+
+        await semaphore.release(first)
+        assert await semaphore.try_acquire()
+
+
+@pytest.mark.asyncio
+async def test_semaphore_frees_expired_slots(redis_url: str) -> None:
+    """Slots not refreshed within ttl should be taken over"""
+
+    async with download_budget(redis_url, transfers_per_host=1) as budget:
+        semaphore: RedisSemaphore = budget.semaphore("krakenfiles.com")
+        semaphore.ttl = 1
+
+        token: Optional[str] = await semaphore.try_acquire()
+        assert token
+        assert await semaphore.try_acquire() is None
+
+        await asyncio.sleep(1.1)
+        assert not await semaphore.refresh(token)
+        assert await semaphore.try_acquire()
+
+
+@pytest.mark.asyncio
+async def test_limits_changed_at_runtime(redis_url: str) -> None:
+    """Limits set in redis should be used instead of defaults until reset"""
+
+    async with download_budget(redis_url, transfers_per_host=1) as budget:
+        semaphore: RedisSemaphore = budget.semaphore("krakenfiles.com")
+        assert await semaphore.try_acquire()
+        assert await semaphore.try_acquire() is None
+
+        limits = await budget.set_limits(transfers_per_host=2, bandwidth=None)
+        assert limits == {"transfers_per_host": 2, "bandwidth": 0}
+        assert await semaphore.try_acquire()
+
+        assert await budget.reset_limits() == {
+            "transfers_per_host": 1,
+            "bandwidth": 0,
+        }
+        assert await budget.get_limits() == {"transfers_per_host": 1, "bandwidth": 0}
+
+        with pytest.raises(ValueError):
+            await budget.set_limits(speed=1)
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_wait(redis_url: str) -> None:
+    """Taking more than bandwidth allows should return time to wait"""
+
+    async with download_budget(redis_url, bandwidth=1000) as budget:
+        assert await budget.bucket.take(1000) == 0
+        assert 0.4 < await budget.bucket.take(500) <= 0.5
+
+        await budget.set_limits(bandwidth=0)
+        assert await budget.bucket.take(10**9) == 0
+
+
+@pytest.mark.asyncio
+async def test_download_engine_with_budget(
+    redis_url: str,
+    tmp_path: Path,
+    monkeypatch,
+    file_server: Callable,
+    file_content: bytes,
+) -> None:
+    """Engine with budget should download file and free its transfer slot"""
+
+    monkeypatch.setattr(settings, "download_path", str(tmp_path))
+
+    async with download_budget(redis_url, transfers_per_host=1) as budget:
+        async with file_server() as server:
+            job: DownloadJob = DownloadJob(
+                object_id=1, dl_link=str(server.make_url("/file/1")), file_path="1/"
+            )
+            async with DownloadEngine(chunk_size=1024, budget=budget) as engine:
+                path: Path = await engine.download(job)
+
+            assert path.read_bytes() == file_content
+            assert await budget.redis.zcard(f"test:transfers:{server.host}") == 0
+
+
+@pytest.mark.asyncio
+async def test_in_flight_registry(redis_url: str) -> None:
+    """Objects can be marked once until their markers are cleared"""
+
+    async with InFlightRegistry(redis=Redis.from_url(redis_url)) as registry:
+        assert await registry.mark([1, 2]) == [1, 2]
+        assert await registry.mark([2, 3]) == [3]
+        assert await registry.in_flight([1, 4]) == {1}
+
+        await registry.clear([1, 2])
+        assert await registry.in_flight([1, 2, 3]) == {3}
+        assert await registry.mark([1]) == [1]
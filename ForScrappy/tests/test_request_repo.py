@@ -1,7 +1,13 @@
+import threading
+from typing import List, Set
+
 import pytest
+from pytest_mock import MockerFixture
 import requests_mock
-from requests import Response
+from requests import Response, Session
+from requests.cookies import RequestsCookieJar
 
+from models.types import SessionObject
 from repos.request_repo import ForClubbersScrapper
 
 
@@ -16,3 +22,97 @@ async def test__fetch_data_get() -> None:
 
     assert response.json() == content
     assert isinstance(response, Response)
+
+
+@pytest.mark.asyncio
+async def test_fetch_threads_use_own_sessions() -> None:
+    """Every fetch thread should get its own session with login cookies"""
+
+    login_session: Session = Session()
+    login_session.cookies.set("bbsessionhash", "logged-in")
+    scrapper: ForClubbersScrapper = ForClubbersScrapper(
+        SessionObject(session=login_session, cookie=RequestsCookieJar(), headers={})
+    )
+    sessions: Set[int] = set()
+
+    def fetch() -> None:
+        session: Session = scrapper._thread_session()
+        assert session is scrapper._thread_session()
+        assert session.cookies.get("bbsessionhash") == "logged-in"
+        sessions.add(id(session))
+
+    threads: List[threading.Thread] = [threading.Thread(target=fetch) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(sessions) == 3
+    assert id(login_session) not in sessions
+
+
+@pytest.mark.asyncio
+async def test_download_files_dispatches_chunks(mocker: "MockerFixture") -> None:
+    """Jobs should be sent as one group with chunk_size jobs per task"""
+
+    group_mock = mocker.patch("repos.request_repo.group")
+    jobs: list = [
+        {"object_id": pk, "dl_link": "link", "headers": {}, "file_path": "2023/4/"}
+        for pk in (1, 2, 3, None)
+    ]
+
+    await ForClubbersScrapper.download_files(jobs, chunk_size=2)
+
+    signatures: list = list(group_mock.call_args.args[0])
+    assert len(signatures) == 2
+    assert [job["object_id"] for job in signatures[0].args[0]["jobs"]] == [1, 2]
+    group_mock.return_value.apply_async.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_enqueue_downloads_chains(mocker: "MockerFixture") -> None:
+    """Every chunk of ids should get its own resolve -> download chain"""
+
+    group_mock = mocker.patch("repos.request_repo.group")
+
+    await ForClubbersScrapper.enqueue_downloads([1, 2, 3], chunk_size=2)
+
+    chains: list = list(group_mock.call_args.args[0])
+    assert [task.args for task in chains[0].tasks] == [([1, 2],), ()]
+    assert chains[1].tasks[0].args == ([3],)
+    assert chains[0].tasks[0].task == "tasks.resolve.resolve_links"
+    group_mock.return_value.apply_async.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_download_files_skips_in_flight(mocker: "MockerFixture") -> None:
+    """Jobs dispatched before and not finished yet shouldn't be sent again"""
+
+    group_mock = mocker.patch("repos.request_repo.group")
+    jobs: list = [
+        {"object_id": pk, "dl_link": "link", "headers": {}, "file_path": "2023/4/"}
+        for pk in (1, 2)
+    ]
+
+    await ForClubbersScrapper.download_files(jobs[:1])
+    await ForClubbersScrapper.download_files(jobs)
+
+    signatures: list = list(group_mock.call_args.args[0])
+    assert [job["object_id"] for job in signatures[0].args[0]["jobs"]] == [2]
+
+    group_mock.reset_mock()
+    await ForClubbersScrapper.download_files(jobs)
+    group_mock.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_download_file_skips_in_flight(mocker: "MockerFixture") -> None:
+    """Second dispatch of the same object should be skipped"""
+
+    task_mock = mocker.patch("repos.request_repo.download_file")
+    job: dict = {"object_id": 1, "dl_link": "link", "headers": {}, "file_path": "4/"}
+
+    await ForClubbersScrapper.download_file(**job)
+    await ForClubbersScrapper.download_file(**job)
+
+    task_mock.delay.assert_called_once()
@@ -0,0 +1,48 @@
+import hashlib
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from tasks.storage import BlobStore
+
+CONTENT: bytes = b"track" * 100
+CONTENT_HASH: str = hashlib.sha256(CONTENT).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_blob_store_deduplicates(tmp_path: Path) -> None:
+    """Files with the same content should share one blob"""
+
+    store: BlobStore = BlobStore(tmp_path / ".blobs")
+    first: Path = tmp_path / "2023/4/first.zip"
+    second: Path = tmp_path / "2023/5/second.zip"
+    for path in (first, second):
+        path.parent.mkdir(parents=True)
+        path.write_bytes(CONTENT)
+
+    await store.store(first, CONTENT_HASH)
+    await store.store(second, CONTENT_HASH)
+
+    blob: Path = store.blob_path(CONTENT_HASH)
+    assert blob.stat().st_nlink == 3
+    assert first.samefile(blob) and second.samefile(blob)
+    assert second.read_bytes() == CONTENT
+
+
+@pytest.mark.asyncio
+async def test_blob_store_link(tmp_path: Path) -> None:
+    """Link should be created only for stored blobs"""
+
+    store: BlobStore = BlobStore(tmp_path / ".blobs")
+    source: Path = tmp_path / "2023/4/file.zip"
+    source.parent.mkdir(parents=True)
+    source.write_bytes(CONTENT)
+    await store.store(source, CONTENT_HASH)
+
+    target: Path = tmp_path / "2023/6/file.zip"
+    result: Optional[Path] = await store.link(CONTENT_HASH, target)
+
+    assert result == target
+    assert target.samefile(source)
+    assert await store.link("0" * 64, tmp_path / "missing.zip") is None
@@ -1,11 +1,14 @@
 from copy import deepcopy
+from datetime import datetime, timedelta
+from pathlib import Path
 import random
-from typing import Type, Awaitable, List, Callable, Optional
-from unittest.mock import MagicMock
+from typing import AsyncIterator, Type, Awaitable, List, Callable, Optional
+from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 from pytest_mock import MockerFixture
 from requests import Response
+from tortoise import timezone
 
 from models import DownloadLinkPydantic
 from models.entities import DownloadLinksPydantic, LinksModelPydantic, LinkModelPydantic
@@ -16,6 +19,7 @@ from repos.parser_repo import (
     ZippyshareParser,
     ForClubbersParser,
 )
+from settings import settings
 from use_case.use_case import ForClubUseCase
 from utils.utils import DBConnectionHandler
 
@@ -131,7 +135,11 @@ async def test_get_files_link_from_forum(
             "repos.request_repo.ForClubbersScrapper.get_forum_urls", return_value=result
         )
         mocker.patch(
-            "repos.request_repo.ForClubbersScrapper.get_download_links",
+            "repos.request_repo.ForClubbersScrapper.fetch_thread",
+            return_value=thread_response,
+        )
+        mocker.patch(
+            "repos.request_repo.ForClubbersScrapper.parse_thread",
             return_value=download_link_res,
         )
 
@@ -143,3 +151,169 @@ async def test_get_files_link_from_forum(
         assert len(data := link_models_filtered.__root__) == 1
         assert len(download_link_filtered.__root__) == len(download_link_res.__root__)
         assert data[0].for_clubbers_url == result.__root__[0].for_clubbers_url
+
+
+@pytest.mark.asyncio
+async def test_crawl_resume(
+    clean_database: Callable, mocker: "MockerFixture", use_case: ForClubUseCase
+) -> None:
+    """Resumed crawl should skip pages done, fetch pending threads and drop checkpoint"""
+
+    async with DBConnectionHandler():
+        await use_case.checkpoint_repo.mark_done(
+            "trance", use_case.checkpoint_repo.PAGE, ["page1"]
+        )
+        await use_case.checkpoint_repo.mark_done(
+            "trance", use_case.checkpoint_repo.THREAD, ["thread1"]
+        )
+        await use_case.checkpoint_repo.add_threads("trance", ["thread2"])
+
+        forum_mock: MagicMock = mocker.patch(
+            "repos.request_repo.ForClubbersScrapper.get_forum_urls",
+            return_value=LinksModelPydantic(__root__=[]),
+        )
+        fetch_mock: MagicMock = mocker.patch(
+            "repos.request_repo.ForClubbersScrapper.fetch_thread",
+            return_value=Response(),
+        )
+        mocker.patch(
+            "repos.request_repo.ForClubbersScrapper.parse_thread",
+            return_value=DownloadLinksPydantic(__root__=[]),
+        )
+
+        await use_case.crawl("trance", ["page1", "page2"], resume=True)
+
+        forum_mock.assert_called_once_with(link="page2", category="trance")
+        fetch_mock.assert_called_once_with("thread2")
+        assert await use_case.checkpoint_repo.get_frontier("trance") == (set(), [])
+
+
+@pytest.mark.asyncio
+async def test_stream_links_with_errors(
+    use_case: ForClubUseCase, download_link_model: Awaitable, clean_database: Callable
+) -> None:
+    """Test stream_links_with_errors method. Only (link, error_message) of links with errors are streamed"""
+
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+    async with DBConnectionHandler():
+        download_link: DownloadLinkPydantic = await download_link_model
+        download_link.error = True
+        download_link.error_message = "error"
+
+        second_link: DownloadLinkPydantic = deepcopy(download_link)
+        second_link.link = "https://example2.com"
+        second_link.error = False
+
+        await repo.create(download_link)
+        await repo.create(second_link)
+
+        res = [row async for row in use_case.stream_links_with_errors()]
+
+        assert res == [(download_link.link, "error")]
+
+
+@pytest.mark.asyncio
+async def test_resolve_link_reuses_cached_link(
+    use_case: ForClubUseCase,
+    download_link_model: Awaitable,
+    clean_database: Callable,
+    mocker: "MockerFixture",
+) -> None:
+    """Direct link should be acquired again only after it expires"""
+
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+    parse_mock: MagicMock = mocker.patch(
+        "repos.request_repo.ForClubbersScrapper.parse_download_link",
+        return_value={
+            "dl_link": "https://krakenfiles.com/direct/file.zip",
+            "headers": KrakenParser.get_download_headers(),
+            "published_date": datetime(2023, 4, 4),
+            "name": "Name",
+        },
+    )
+
+    async with DBConnectionHandler():
+        download_link: DownloadLinkPydantic = await download_link_model
+        download_link.link = "https://krakenfiles.com/view/abc/file.html"
+        obj: DownloadLinkPydantic = await repo.create(download_link)
+
+        first: Optional[dict] = await use_case.resolve_link(obj)
+        obj = (await repo.filter(pk=obj.pk)).__root__[0]  # type: ignore
+        second: Optional[dict] = await use_case.resolve_link(obj)
+
+        assert first == second
+        assert second and second["dl_link"] == "https://krakenfiles.com/direct/file.zip"
+        assert obj.download_link == "https://krakenfiles.com/direct/file.zip"
+        assert parse_mock.call_count == 1
+
+        await repo.update_by_pk(
+            obj.pk, download_link_expires=timezone.now() - timedelta(seconds=1)  # type: ignore
+        )
+        obj = (await repo.filter(pk=obj.pk)).__root__[0]  # type: ignore
+        await use_case.resolve_link(obj)
+
+        assert parse_mock.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_download_notified_catches_up_after_reconnect(
+    mocker: MockerFixture, use_case: ForClubUseCase
+) -> None:
+    """Links saved while listener was disconnected should be claimed after reconnect"""
+
+    class Stop(Exception):
+        pass
+
+    class Listener:
+        connected: bool = False
+
+        async def batches(self) -> AsyncIterator[List[int]]:
+            if not self.connected:
+                raise ConnectionError("Listener connection is closed")
+            yield [1]
+            raise Stop
+
+        async def reconnect(self) -> None:
+            self.connected = True
+
+    enqueue: AsyncMock = mocker.patch.object(use_case, "enqueue_claimed")
+
+    with pytest.raises(Stop):
+        await use_case.download_notified(owner="runner", listener=Listener())  # type: ignore
+
+    assert enqueue.call_args_list == [
+        mocker.call(owner="runner"),
+        mocker.call(owner="runner"),
+        mocker.call(owner="runner", pks=[1]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_mark_on_disk_checks_file(
+    use_case: ForClubUseCase,
+    download_link_model: Awaitable,
+    clean_database: Callable,
+    tmp_path: Path,
+    monkeypatch,
+) -> None:
+    """Link should be marked only if file listed in manifest is still on disk"""
+
+    monkeypatch.setattr(settings, "download_path", str(tmp_path))
+    repo: DownloadLinksRepo = DownloadLinksRepo()
+
+    async with DBConnectionHandler():
+        download_link: DownloadLinkPydantic = await download_link_model
+        download_link.published_date = datetime(2023, 4, 4, 12)
+        download_link.name = "a.zip"
+        obj: DownloadLinkPydantic = await repo.create(download_link)
+        await use_case.manifest_repo.add("2023/4/a.zip", 5, 1.0)
+
+        assert not await use_case.mark_on_disk(obj)
+
+        (tmp_path / "2023/4").mkdir(parents=True)
+        (tmp_path / "2023/4/a.zip").write_bytes(b"track")
+        assert await use_case.mark_on_disk(obj)
+
+        obj = (await repo.filter(pk=obj.pk)).__root__[0]  # type: ignore
+        assert obj.downloaded
+        assert obj.stored_path == "2023/4/a.zip"
@@ -0,0 +1,103 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from tasks.writer import FileWriter, ensure_directory, _created_directories
+
+
+@pytest.mark.asyncio
+async def test_file_writer_commit(tmp_path: Path) -> None:
+    """Buffered data should be written in order and file renamed on commit"""
+
+    part_path: Path = tmp_path / "1.part"
+    async with FileWriter(part_path, size=30, buffer_size=8) as writer:
+        for _ in range(3):
+            await writer.write(b"0123456789")
+        assert writer.preallocated
+        result: Path = await writer.commit(tmp_path / "file.zip")
+
+    assert result.read_bytes() == b"0123456789" * 3
+    assert writer.content_hash == hashlib.sha256(b"0123456789" * 3).hexdigest()
+    assert not part_path.exists()
+
+
+@pytest.mark.asyncio
+async def test_file_writer_failure_releases_preallocation(tmp_path: Path) -> None:
+    """After failure file should contain only written bytes"""
+
+    part_path: Path = tmp_path / "1.part"
+    with pytest.raises(ValueError):
+        async with FileWriter(part_path, size=1000) as writer:
+            await writer.write(b"x" * 100)
+            raise ValueError
+
+    assert part_path.stat().st_size == 100
+
+
+@pytest.mark.asyncio
+async def test_file_writer_resume_and_checkpoints(tmp_path: Path) -> None:
+    """Data after offset should be dropped and synced offsets reported"""
+
+    part_path: Path = tmp_path / "1.part"
+    part_path.write_bytes(b"a" * 10 + b"\0" * 90)
+    checkpoints: List[int] = []
+
+    async def on_checkpoint(offset: int) -> None:
+        checkpoints.append(offset)
+
+    async with FileWriter(
+        part_path,
+        offset=10,
+        buffer_size=10,
+        fsync="interval",
+        fsync_interval=20,
+        on_checkpoint=on_checkpoint,
+    ) as writer:
+        for _ in range(5):
+            await writer.write(b"b" * 10)
+        await writer.commit(tmp_path / "file.zip")
+
+    assert (tmp_path / "file.zip").read_bytes() == b"a" * 10 + b"b" * 50
+    assert writer.content_hash == hashlib.sha256(b"a" * 10 + b"b" * 50).hexdigest()
+    assert checkpoints == [30, 50, 60]
+
+
+@pytest.mark.asyncio
+async def test_file_writer_segments(tmp_path: Path) -> None:
+    """Segments should be written at their own positions"""
+
+    part_path: Path = tmp_path / "1.part"
+    async with FileWriter(part_path, size=20, buffer_size=4) as writer:
+        second = writer.segment(10)
+        first = writer.segment(0)
+        await second.write(b"B" * 10)
+        await first.write(b"A" * 10)
+        await second.flush()
+        await first.flush()
+        await writer.commit(tmp_path / "file.zip")
+
+    assert (tmp_path / "file.zip").read_bytes() == b"A" * 10 + b"B" * 10
+    assert writer.content_hash == hashlib.sha256(b"A" * 10 + b"B" * 10).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_ensure_directory_cache(tmp_path: Path) -> None:
+    """Directory should be created once and again if it's removed later"""
+
+    path: Path = tmp_path / "2023" / "4"
+    await ensure_directory(path)
+    assert path in _created_directories
+
+    os.rmdir(path)
+    await ensure_directory(path)
+    assert not path.exists()
+
+    async with FileWriter(path / "file.zip.part") as writer:
+        await writer.write(b"data")
+        await writer.commit(path / "file.zip")
+
+    assert (path / "file.zip").read_bytes() == b"data"
+    assert path in _created_directories
@@ -0,0 +1,197 @@
+import asyncio
+import signal
+import time
+from datetime import datetime
+from logging import Logger
+from typing import Any, Callable, Dict, List, Optional
+
+from logger import get_module_logger
+from settings import settings
+from use_case.use_case import ForClubUseCase
+from utils.exceptions import CrawlFailed
+
+logger: Logger = get_module_logger("daemon")
+
+# logs in and returns use case with fresh session, runs in a thread
+UseCaseFactory = Callable[[], ForClubUseCase]
+# stats of every pipeline stage per category, returned by crawl_many
+CrawlStats = Dict[str, Dict[str, Dict[str, Any]]]
+
+
+def crawl_failures(stats: CrawlStats) -> Dict[str, Dict[str, int]]:
+    """Failed items per stage of categories where any item failed"""
+    failures: Dict[str, Dict[str, int]] = {}
+    for category, stages in stats.items():
+        failed: Dict[str, int] = {
+            name: stage["failed"] for name, stage in stages.items() if stage["failed"]
+        }
+        if failed:
+            failures[category] = failed
+    return failures
+
+
+def crawl_errors(
+    stats: CrawlStats, max_failure_ratio: float = settings.daemon.max_failure_ratio
+) -> List[str]:
+    """
+    Pipeline stages count failed items instead of raising, so systemic failures,
+    e.g. expired session where nothing is fetched, are found in stats.
+    Isolated item failures, like one broken thread, don't fail the crawl
+    :return: description of systemic failures per category
+    """
+    errors: List[str] = []
+    for category, stages in stats.items():
+        if not stages.get("fetch", {}).get("processed"):
+            errors.append(f"{category}: nothing fetched")
+            continue
+        ratios: Dict[str, float] = {
+            name: round(stage["failed"] / (stage["processed"] + stage["failed"]), 2)
+            for name, stage in stages.items()
+            if stage["failed"]
+        }
+        if over := {
+            name: ratio for name, ratio in ratios.items() if ratio > max_failure_ratio
+        }:
+            errors.append(f"{category}: failure ratio per stage {over}")
+    return errors
+
+
+class CrawlDaemon:
+    """
+    Re-crawls forum categories on intervals in one long running process.
+    DB pool and login session are created once and reused by every crawl,
+    session is renewed every relogin_interval seconds or after failed crawl
+    """
+
+    def __init__(
+        self,
+        login: UseCaseFactory,
+        links: Dict[str, List[str]],
+        interval: int = settings.daemon.interval,
+        intervals: Optional[Dict[str, int]] = None,
+        relogin_interval: int = settings.daemon.relogin_interval,
+        stop_timeout: float = settings.daemon.stop_timeout,
+    ) -> None:
+        """
+        :param login: factory of logged in use case
+        :param links: urls of forum pages per category name
+        :param interval: default seconds between crawls of a category
+        :param intervals: per category overrides of interval
+        """
+        intervals = settings.daemon.intervals if intervals is None else intervals
+        self.login: UseCaseFactory = login
+        self.links: Dict[str, List[str]] = links
+        self.intervals: Dict[str, int] = {
+            category: intervals.get(category, interval) for category in links
+        }
+        self.relogin_interval: int = relogin_interval
+        self.stop_timeout: float = stop_timeout
+        # monotonic time of next crawl per category, all are due at start
+        self.next_run: Dict[str, float] = {category: 0.0 for category in links}
+        self.last_crawl: Dict[str, str] = {}
+        self.last_error: Optional[str] = None
+        # failed items per stage of last crawl of categories, crawl didn't fail
+        self.last_failures: Dict[str, Dict[str, int]] = {}
+        self.running: List[str] = []
+        self.stopping: asyncio.Event = asyncio.Event()
+        self._use_case: Optional[ForClubUseCase] = None
+        self._logged_in: float = 0.0
+
+    def stop(self) -> None:
+        """Stop after running crawl finishes"""
+        if not self.stopping.is_set():
+            logger.info("Stopping crawl daemon")
+            self.stopping.set()
+
+    def install_signal_handlers(self) -> None:
+        """Stop gracefully on SIGTERM and SIGINT"""
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop)
+
+    def health(self) -> Dict[str, Any]:
+        """Health report for HealthServer"""
+        return {
+            "healthy": not self.stopping.is_set() and self.last_error is None,
+            "running": self.running,
+            "last_crawl": self.last_crawl,
+            "last_error": self.last_error,
+            "last_failures": self.last_failures,
+        }
+
+    def due(self) -> List[str]:
+        """Categories which should be crawled now"""
+        now: float = time.monotonic()
+        return [category for category, at in self.next_run.items() if at <= now]
+
+    async def get_use_case(self) -> ForClubUseCase:
+        """Use case with warm session, logging in again when it's too old"""
+        if (
+            not self._use_case
+            or time.monotonic() - self._logged_in > self.relogin_interval
+        ):
+            self._use_case = await asyncio.to_thread(self.login)
+            self._logged_in = time.monotonic()
+        return self._use_case
+
+    async def crawl(self, categories: List[str]) -> None:
+        """Crawl given categories together and schedule their next crawl"""
+        self.running = categories
+        try:
+            use_case: ForClubUseCase = await self.get_use_case()
+            stats: CrawlStats = await use_case.crawl_many(
+                {category: self.links[category] for category in categories}
+            )
+            if errors := crawl_errors(stats):
+                raise CrawlFailed("; ".join(errors))
+            self.last_error = None
+            failures: Dict[str, Dict[str, int]] = crawl_failures(stats)
+            for category in categories:
+                self.last_failures.pop(category, None)
+                if category in failures:
+                    self.last_failures[category] = failures[category]
+                    logger.warning(f"{category}: failed items {failures[category]}")
+            finished: str = datetime.now().isoformat()
+            for category in categories:
+                self.last_crawl[category] = finished
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            logger.error(f"Crawl of {categories} failed: {e}")
+            self._use_case = None
+        finally:
+            now: float = time.monotonic()
+            for category in categories:
+                self.next_run[category] = now + self.intervals[category]
+            self.running = []
+
+    async def _crawl_until_stopped(self, categories: List[str]) -> None:
+        """Run crawl. If daemon is stopped, crawl has stop_timeout seconds to finish"""
+        crawl: asyncio.Task = asyncio.create_task(self.crawl(categories))
+        stopped: asyncio.Task = asyncio.create_task(self.stopping.wait())
+        await asyncio.wait({crawl, stopped}, return_when=asyncio.FIRST_COMPLETED)
+        stopped.cancel()
+        if crawl.done():
+            return
+
+        done, _ = await asyncio.wait({crawl}, timeout=self.stop_timeout)
+        if not done:
+            logger.warning(f"Crawl of {categories} didn't finish in time, cancelling")
+            crawl.cancel()
+            await asyncio.gather(crawl, return_exceptions=True)
+
+    async def run(self) -> None:
+        """Crawl due categories until stopped"""
+        logger.info(f"Crawl daemon started: {self.intervals}")
+
+        while not self.stopping.is_set():
+            if categories := self.due():
+                await self._crawl_until_stopped(categories)
+                continue
+            try:
+                await asyncio.wait_for(
+                    self.stopping.wait(), min(self.next_run.values()) - time.monotonic()
+                )
+            except asyncio.TimeoutError:
+                pass
+
+        logger.info("Crawl daemon stopped")
@@ -0,0 +1,187 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from logging import Logger
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from prometheus_client import Gauge
+
+from logger import get_module_logger
+from settings import settings
+from utils.metrics import BACKLOG
+
+logger: Logger = get_module_logger("pipeline")
+
+# takes a batch of stage input items, returns items for the next stage
+StageHandler = Callable[[List[Any]], Awaitable[List[Any]]]
+
+
+def fair_share(total: int, parts: int, index: int) -> int:
+    """
+    Split total workers between parts, so they differ by one at most.
+    Every part gets at least one worker
+    :param index: which part, from 0
+    """
+    share: int = total // parts + (1 if index < total % parts else 0)
+    return max(share, 1)
+
+
+@dataclass
+class StageStats:
+    processed: int = 0
+    failed: int = 0
+    emitted: int = 0
+    busy: float = 0.0  # seconds spent in handler
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def throughput(self) -> float:
+        """Processed items per second since stage started"""
+        elapsed: float = time.monotonic() - self.started
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+
+class Stage:
+    """
+    One step of CrawlPipeline: workers take items from a bounded input queue,
+    pass them to handler and put handler results to the next stage queue.
+    Workers take up to batch_size items which are already queued at once
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: StageHandler,
+        workers: int = 1,
+        queue_size: int = settings.crawl.queue_size,
+        batch_size: int = 1,
+    ) -> None:
+        self.name: str = name
+        self.handler: StageHandler = handler
+        self.workers: int = max(workers, 1)
+        self.batch_size: int = max(batch_size, 1)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.stats: StageStats = StageStats()
+        self.backlog: Gauge = BACKLOG.labels(queue=f"crawl:{name}")
+
+    @property
+    def depth(self) -> int:
+        """Number of items waiting in input queue"""
+        return self.queue.qsize()
+
+    async def put(self, item: Any) -> None:
+        """Queue item for stage workers, blocks while queue is full"""
+        await self.queue.put(item)
+        self.backlog.inc()
+
+    async def _take(self) -> List[Any]:
+        batch: List[Any] = [await self.queue.get()]
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        self.backlog.dec(len(batch))
+        return batch
+
+    async def work(self, output: Optional["Stage"]) -> None:
+        """Worker loop, runs until cancelled"""
+        while True:
+            batch: List[Any] = await self._take()
+            started: float = time.monotonic()
+            try:
+                results: List[Any] = await self.handler(batch)
+                self.stats.processed += len(batch)
+                if output:
+                    for result in results:
+                        # blocks while next stage is full
+                        await output.put(result)
+                        self.stats.emitted += 1
+            except Exception as e:
+                self.stats.failed += len(batch)
+                logger.error(f"Stage {self.name} failed on {batch}: {e}")
+            finally:
+                self.stats.busy += time.monotonic() - started
+                for _ in batch:
+                    self.queue.task_done()
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "depth": self.depth,
+            "processed": self.stats.processed,
+            "failed": self.stats.failed,
+            "emitted": self.stats.emitted,
+            "busy": round(self.stats.busy, 2),
+            "throughput": round(self.stats.throughput, 2),
+        }
+
+
+class CrawlPipeline:
+    """
+    Stages connected by bounded queues. A full queue blocks workers of
+    previous stage, so a slow stage throttles the ones before it instead of
+    piling up items in memory
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        report_interval: float = settings.crawl.report_interval,
+    ) -> None:
+        if not stages:
+            raise ValueError("CrawlPipeline needs at least one stage")
+        self.stages: List[Stage] = stages
+        self.report_interval: float = report_interval
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Queue depth, counters and throughput of every stage"""
+        return {stage.name: stage.summary() for stage in self.stages}
+
+    def log_summary(self) -> None:
+        for name, stats in self.summary().items():
+            logger.info(f"Stage {name}: {stats}")
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.log_summary()
+
+    async def run(
+        self,
+        items: Iterable[Any],
+        start: Optional[Dict[str, Iterable[Any]]] = None,
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Feed items to the first stage and wait until every stage is drained
+        :param items: input of the first stage
+        :param start: items put straight into queues of stages with given names,
+            e.g. work left by interrupted run
+        :return: stats of every stage
+        """
+        stages: Dict[str, Stage] = {stage.name: stage for stage in self.stages}
+        outputs: List[Optional[Stage]] = [*self.stages[1:], None]
+        tasks: List[asyncio.Task] = [
+            asyncio.create_task(stage.work(output))
+            for stage, output in zip(self.stages, outputs)
+            for _ in range(stage.workers)
+        ]
+        if self.report_interval > 0:
+            tasks.append(asyncio.create_task(self._report()))
+
+        try:
+            for item in items:
+                await self.stages[0].put(item)
+            for name, stage_items in (start or {}).items():
+                for item in stage_items:
+                    await stages[name].put(item)
+            # a stage is drained only after its results are queued to the next one
+            for stage in self.stages:
+                await stage.queue.join()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # items left by failed run are not waiting anymore
+            for stage in self.stages:
+                stage.backlog.dec(stage.depth)
+
+        self.log_summary()
+        return self.summary()
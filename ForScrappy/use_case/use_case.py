@@ -1,5 +1,14 @@
-from typing import Type, Optional, Dict
+import asyncio
+from datetime import timedelta
+from functools import partial
+from logging import Logger
+from pathlib import Path
+from typing import Any, AsyncIterator, Type, Optional, Dict, List, Set, Tuple
 
+from requests import Response
+from tortoise import timezone
+
+from logger import get_module_logger
 from models.entities import (
     DownloadLinksPydantic,
     LinksModelPydantic,
@@ -9,10 +18,22 @@ from models.entities import (
 from models.types import SessionObject
 from repos.parser_repo import KrakenParser, ParserType, ZippyshareParser
 from repos.request_repo import ForClubbersScrapper
-from repos.db_repo import LinkModelRepo, DownloadLinksRepo
+from repos.db_repo import (
+    CrawlCheckpointRepo,
+    LinkModelRepo,
+    DownloadLinksRepo,
+    DownloadManifestRepo,
+)
+from repos.notify_repo import DownloadLinksListener
+from repos.redis_repo import InFlightRegistry, queue_lengths
+from settings import settings
+from use_case.pipeline import CrawlPipeline, Stage, fair_share
 from utils.exceptions import LinkPostFailure, HashNotFoundException
+from utils.metrics import BACKLOG, cache_lookup
 from utils.utils import get_folder_name_from_date
 
+logger: Logger = get_module_logger("use_case")
+
 
 class ForClubUseCase:
     def __init__(
@@ -25,6 +46,8 @@ class ForClubUseCase:
         self.link_model_repo: LinkModelRepo = link_repo()
         self.download_links_repo: DownloadLinksRepo = download_repo()
         self.scrapper_repo: ForClubbersScrapper = repo_scrapper(session_obj)
+        self.manifest_repo: DownloadManifestRepo = DownloadManifestRepo()
+        self.checkpoint_repo: CrawlCheckpointRepo = CrawlCheckpointRepo()
 
     @staticmethod
     async def choose_download_manager(url: str) -> Type[ParserType]:
@@ -43,19 +66,113 @@ class ForClubUseCase:
                     ...
         raise ValueError(f"Manager not found for {url}")
 
-    async def download_file(self, link_obj: DownloadLinkPydantic) -> None:
+    @staticmethod
+    def get_cached_link(
+        link_obj: DownloadLinkPydantic, parser: Type[ParserType]
+    ) -> Optional[Dict]:
         """
-        Download file from link. This method as an argument takes existing
-        DownloadLinks object, that's why there is no need to check if object is in db
+        Return download job built from direct download link saved by previous
+        resolve_link call, if the link is not expired yet
+        """
+
+        if not (
+            link_obj.download_link
+            and link_obj.download_link_expires
+            and link_obj.published_date
+            and link_obj.download_link_expires > timezone.now()
+        ):
+            return None
+
+        return {
+            "dl_link": link_obj.download_link,
+            "headers": parser.get_download_headers(),
+            "file_path": get_folder_name_from_date(link_obj.published_date),
+            "object_id": link_obj.pk,
+            "download_offset": link_obj.download_offset,
+        }
+
+    @staticmethod
+    def get_stored_path(link_obj: DownloadLinkPydantic) -> Optional[str]:
+        """
+        Path of link file relative to download directory, saved when download
+        started. Links saved before are expected in date folder under their name
+        """
+        if link_obj.stored_path:
+            return link_obj.stored_path
+        if link_obj.published_date and link_obj.name:
+            return (
+                f"{get_folder_name_from_date(link_obj.published_date)}{link_obj.name}"
+            )
+        return None
+
+    async def mark_on_disk(self, link_obj: DownloadLinkPydantic) -> bool:
+        """
+        Mark link as downloaded if its file is listed in download manifest and
+        is still on disk, as manifest may be older than download directory
+        :return: True if link was marked as downloaded
+        """
+
+        stored_path: Optional[str] = self.get_stored_path(link_obj)
+        if not stored_path or not await self.manifest_repo.is_present(
+            stored_path, link_obj.content_size
+        ):
+            return False
+
+        path: Path = Path(settings.custom_download_path) / stored_path
+        try:
+            size: int = (await asyncio.to_thread(path.stat)).st_size
+        except OSError:
+            logger.info(f"{stored_path} is in manifest, but not on disk")
+            return False
+        if link_obj.content_size is not None and size != link_obj.content_size:
+            return False
+
+        await self.download_links_repo.update_fields(
+            obj=link_obj,
+            downloaded=True,
+            downloaded_date=timezone.now(),
+            download_offset=0,
+            stored_path=stored_path,
+        )
+        return True
+
+    async def reconcile_downloads(
+        self, scan: bool = True, with_hash: bool = False
+    ) -> Dict[str, int]:
+        """
+        Update download manifest and mark all links with files on disk as downloaded
+        :param scan: scan download directory first
+        :param with_hash: calculate hashes of new and changed files
+        :return: scan counters and number of marked links
+        """
+
+        result: Dict[str, int] = {}
+        if scan:
+            result = await self.manifest_repo.scan(
+                Path(settings.custom_download_path), with_hash=with_hash
+            )
+        result["marked"] = await self.download_links_repo.mark_present_downloaded()
+        return result
+
+    async def resolve_link(self, link_obj: DownloadLinkPydantic) -> Optional[Dict]:
+        """
+        Get direct download link for DownloadLinks object and update object in db.
+        Direct link is saved with its expiry date and reused until it expires.
+        Links of files already on disk are not downloaded again
         :param link_obj: DownloadLinkPydantic: pydantic representation of DownloadLinks model
-        :return: None : This method ends with saving file to disk as a celery task
+        :return: download job dict with dl_link, headers, file_path, object_id
+            and download_offset or None if download link couldn't be acquired
         """
 
         url: str = link_obj.link
         parser: Type[ParserType] = await self.choose_download_manager(url)
 
-        dl_link: str
-        headers: Dict[str, str]
+        if await self.mark_on_disk(link_obj):
+            return None
+
+        cached: Optional[Dict] = self.get_cached_link(link_obj, parser)
+        if cache_lookup("direct_link", cached is not None):
+            return cached
 
         try:
             response: Dict = await self.scrapper_repo.parse_download_link(
@@ -63,29 +180,69 @@ class ForClubUseCase:
             )
             await self.download_links_repo.update_fields(
                 obj=link_obj,
-                download_link=url,
+                download_link=response["dl_link"],
+                download_link_expires=timezone.now()
+                + timedelta(seconds=settings.kraken_link_ttl),
                 published_date=response.get("published_date"),
                 name=response.get("name"),
+                source_hash=response.get("source_hash"),
             )
         except (LinkPostFailure, HashNotFoundException) as e:
             await self.download_links_repo.update_fields(
                 obj=link_obj,
-                download_link=url,
+                download_link=None,
+                download_link_expires=None,
                 error=True,
                 error_message=f"{link_obj.error_message}; {str(e)}",
             )
-            return
+            return None
 
-        dl_link = response["dl_link"]
-        headers = response["headers"]
-        file_path = get_folder_name_from_date(response["published_date"])
+        return {
+            "dl_link": response["dl_link"],
+            "headers": response["headers"],
+            "file_path": get_folder_name_from_date(response["published_date"]),
+            "object_id": link_obj.pk,
+            "download_offset": link_obj.download_offset,
+        }
 
-        await self.scrapper_repo.download_file(
-            dl_link=dl_link,
-            headers=headers,
-            file_path=file_path,
-            object_id=link_obj.pk,
-        )
+    async def download_file(self, link_obj: DownloadLinkPydantic) -> None:
+        """
+        Download file from link. This method as an argument takes existing
+        DownloadLinks object, that's why there is no need to check if object is in db.
+        Objects already in flight are skipped without acquiring download link
+        :param link_obj: DownloadLinkPydantic: pydantic representation of DownloadLinks model
+        :return: None : This method ends with saving file to disk as a celery task
+        """
+
+        async with InFlightRegistry() as registry:
+            if link_obj.pk and await registry.in_flight([link_obj.pk]):
+                return
+
+        job: Optional[Dict] = await self.resolve_link(link_obj)
+        if job:
+            await self.scrapper_repo.download_file(**job)
+
+    async def download_files(self, links: DownloadLinksPydantic) -> None:
+        """
+        Resolve given links and dispatch their downloads in chunked celery tasks.
+        Links already in flight are skipped without acquiring download link
+        :param links: DownloadLinksPydantic: links to download
+        :return: None
+        """
+
+        async with InFlightRegistry() as registry:
+            in_flight: Set[int] = await registry.in_flight(
+                link_obj.pk for link_obj in links.__root__ if link_obj.pk
+            )
+
+        jobs: List[Dict] = []
+        for link_obj in links.__root__:
+            if link_obj.pk in in_flight:
+                continue
+            if job := await self.resolve_link(link_obj):
+                jobs.append(job)
+
+        await self.scrapper_repo.download_files(jobs)
 
     async def get_links_with_errors(self) -> Optional[DownloadLinksPydantic]:
         """Return links with errors"""
@@ -96,6 +253,31 @@ class ForClubUseCase:
             return None
         return res
 
+    async def stream_links_with_errors(
+        self,
+    ) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        """Stream (link, error_message) pairs of links with errors, without hydrating objects"""
+        async for row in self.download_links_repo.values_list(
+            "link", "error_message", error=True
+        ):
+            yield row  # type: ignore
+
+    async def get_stats(self, rebuild: bool = False) -> Dict[str, Any]:
+        """Return DownloadLinks counters. Rebuild them from scratch if requested"""
+        if rebuild:
+            await self.download_links_repo.stats_repo.rebuild()
+        return await self.download_links_repo.stats_repo.summary()
+
+    async def update_backlog(self) -> None:
+        """Set backlog metrics: links not downloaded yet and celery queue lengths"""
+        stats: Dict[str, Any] = await self.get_stats()
+        BACKLOG.labels(queue="links").set(
+            stats["total"]["total"] - stats["total"]["downloaded"]
+        )
+        lengths: Dict[str, int] = await queue_lengths(settings.metrics.queues)
+        for name, length in lengths.items():
+            BACKLOG.labels(queue=f"celery:{name}").set(length)
+
     async def get_links(self) -> Optional[DownloadLinksPydantic]:
         """Return links from DB which are not downloaded yet"""
         res: Optional[DownloadLinksPydantic] = await self.download_links_repo.filter(  # type: ignore
@@ -105,26 +287,270 @@ class ForClubUseCase:
             return None
         return res
 
-    async def get_files_link_from_forum(self, category: str, link: str) -> None:
-        """Walk through forum, and get the links"""
-
-        forum_links: LinksModelPydantic = await self.scrapper_repo.get_forum_urls(
-            link=link, category=category
+    async def claim_links(
+        self, owner: str, pks: Optional[List[int]] = None, after: int = 0
+    ) -> Optional[DownloadLinksPydantic]:
+        """Lease a batch of not downloaded links, so concurrent runners don't share work"""
+        res: Optional[DownloadLinksPydantic] = await self.download_links_repo.claim(  # type: ignore
+            owner=owner,
+            limit=settings.download_queue.batch_size,
+            lease_seconds=settings.download_queue.lease_seconds,
+            pks=pks,
+            after=after,
         )
+        if not res or not res.__root__:
+            return None
+        return res
+
+    async def iter_claimed(
+        self, owner: str, pks: Optional[List[int]] = None
+    ) -> AsyncIterator[DownloadLinksPydantic]:
+        """
+        Claim not downloaded links batch by batch. Every link is claimed once
+        per run, so links which failed in this run aren't retried by it when
+        their lease expires
+        """
+        after: int = 0
+        while res := await self.claim_links(owner=owner, pks=pks, after=after):
+            after = max(link_obj.pk or 0 for link_obj in res.__root__)
+            yield res
+
+    async def download_claimed(
+        self, owner: str, pks: Optional[List[int]] = None
+    ) -> None:
+        """Claim not downloaded links batch by batch and download them"""
+        async for res in self.iter_claimed(owner=owner, pks=pks):
+            await self.download_files(res)
+
+    async def enqueue_claimed(
+        self, owner: str, pks: Optional[List[int]] = None
+    ) -> None:
+        """Claim not downloaded links batch by batch and enqueue their resolution and download"""
+        async for res in self.iter_claimed(owner=owner, pks=pks):
+            await self.scrapper_repo.enqueue_downloads(
+                [link_obj.pk for link_obj in res.__root__ if link_obj.pk]
+            )
+
+    async def download_notified(
+        self, owner: str, listener: DownloadLinksListener
+    ) -> None:
+        """
+        Enqueue links announced by listener, as soon as they are created. Links
+        saved while listener isn't connected are not notified, so they are
+        claimed before listening starts and again after every reconnect
+        """
+        while True:
+            await self.enqueue_claimed(owner=owner)
+            try:
+                async for pks in listener.batches():
+                    await self.enqueue_claimed(owner=owner, pks=pks)
+            except ConnectionError as e:
+                logger.error(f"Listener connection lost: {e}")
+                await listener.reconnect()
+
+    async def _fetch_listings(self, category: str, links: List[str]) -> List[str]:
+        """Listing stage: fetch forum pages and save their threads to checkpoint"""
+        urls: List[str] = []
+        for link in links:
+            forum_links: LinksModelPydantic = await self.scrapper_repo.get_forum_urls(
+                link=link, category=category
+            )
+            page_urls: List[str] = []
+            for element in forum_links.__root__:
+                obj, _ = await self.link_model_repo.get_or_create(element)
+                assert isinstance(obj, LinkModelPydantic)
+                page_urls.append(obj.for_clubbers_url)
 
-        for element in forum_links.__root__:
-            obj, _ = await self.link_model_repo.get_or_create(element)
+            await self.checkpoint_repo.add_threads(category, page_urls)
+            await self.checkpoint_repo.mark_done(
+                category, CrawlCheckpointRepo.PAGE, [link]
+            )
+            urls.extend(page_urls)
+        return urls
 
-            assert isinstance(obj, LinkModelPydantic)
+    async def _fetch_threads(self, urls: List[str]) -> List[Tuple[str, Response]]:
+        """Fetch stage: get html of forum threads"""
+        return [(url, await self.scrapper_repo.fetch_thread(url)) for url in urls]
 
+    async def _parse_threads(
+        self, category: str, pages: List[Tuple[str, Response]]
+    ) -> List[Tuple[str, List[DownloadLinkPydantic]]]:
+        """Parse stage: get download links of every thread from its html"""
+        threads: List[Tuple[str, List[DownloadLinkPydantic]]] = []
+        for url, response in pages:
             download_links: DownloadLinksPydantic = (
-                await self.scrapper_repo.get_download_links(
-                    link=obj.for_clubbers_url, category=category
+                await self.scrapper_repo.parse_thread(response, url, category)
+            )
+            threads.append(
+                (url, download_links.__root__ if download_links else [])  # type: ignore
+            )
+        return threads
+
+    async def _persist_links(
+        self, category: str, threads: List[Tuple[str, List[DownloadLinkPydantic]]]
+    ) -> List[int]:
+        """
+        Persist stage: save download links and mark their threads done in checkpoint
+        :return: ids of new links
+        """
+        created_pks: List[int] = []
+        for _, links in threads:
+            for download_link_obj in links:
+                obj, created = await self.download_links_repo.get_or_create(
+                    download_link_obj
+                )
+                if created and isinstance(obj, DownloadLinkPydantic) and obj.pk:
+                    created_pks.append(obj.pk)
+
+        await self.checkpoint_repo.mark_done(
+            category, CrawlCheckpointRepo.THREAD, [url for url, _ in threads]
+        )
+        return created_pks
+
+    async def _enqueue_links(self, pks: List[int]) -> List[Any]:
+        """Enqueue stage: dispatch resolution and download of new links"""
+        await self.scrapper_repo.enqueue_downloads(pks)
+        return []
+
+    def crawl_pipeline(
+        self,
+        category: str,
+        enqueue: bool = settings.crawl.enqueue,
+        index: int = 0,
+        parts: int = 1,
+    ) -> CrawlPipeline:
+        """
+        Build crawl pipeline: listing fetch -> thread fetch -> parse -> persist
+        and, if enqueue is set, -> enqueue of new links downloads.
+        When `parts` pipelines run together, pipeline `index` gets its fair share
+        of workers configured for each stage
+        """
+
+        def workers(total: int) -> int:
+            return fair_share(total, parts, index)
+
+        stages: List[Stage] = [
+            Stage(
+                "listing",
+                partial(self._fetch_listings, category),
+                workers=workers(settings.crawl.listing_workers),
+            ),
+            Stage(
+                "fetch",
+                self._fetch_threads,
+                workers=workers(settings.crawl.fetch_workers),
+            ),
+            Stage(
+                "parse",
+                partial(self._parse_threads, category),
+                workers=workers(settings.crawl.parse_workers),
+            ),
+            Stage(
+                "persist",
+                partial(self._persist_links, category),
+                workers=workers(settings.crawl.persist_workers),
+            ),
+        ]
+        if enqueue:
+            stages.append(
+                Stage(
+                    "enqueue",
+                    self._enqueue_links,
+                    batch_size=settings.celery.dispatch_chunk_size,
                 )
             )
+        return CrawlPipeline(stages)
+
+    async def _crawl_category(
+        self,
+        category: str,
+        links: List[str],
+        enqueue: bool = settings.crawl.enqueue,
+        resume: bool = False,
+        index: int = 0,
+        parts: int = 1,
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Crawl one category, recording its frontier in checkpoint. Checkpoint is
+        discarded when crawl completes without failures
+        """
+
+        pages_done: Set[str] = set()
+        threads_pending: List[str] = []
+        if resume:
+            pages_done, threads_pending = await self.checkpoint_repo.get_frontier(
+                category
+            )
+            logger.info(
+                f"Resuming crawl of {category}: {len(pages_done)} pages done, "
+                f"{len(threads_pending)} threads pending"
+            )
+        else:
+            await self.checkpoint_repo.clear(category)
+
+        stats: Dict[str, Dict[str, Any]] = await self.crawl_pipeline(
+            category, enqueue=enqueue, index=index, parts=parts
+        ).run(
+            [link for link in links if link not in pages_done],
+            start={"fetch": threads_pending},
+        )
+
+        if any(stage["failed"] for stage in stats.values()):
+            logger.warning(f"Crawl of {category} failed partially, use --resume")
+        else:
+            await self.checkpoint_repo.clear(category)
+        return stats
+
+    async def crawl(
+        self,
+        category: str,
+        links: List[str],
+        enqueue: bool = settings.crawl.enqueue,
+        resume: bool = False,
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Walk through forum pages and save download links of their threads
+        :param category: str: category name
+        :param links: urls of forum pages
+        :param enqueue: dispatch downloads of new links while crawling
+        :param resume: continue from checkpoint of interrupted crawl
+        :return: stats of every pipeline stage
+        """
+        return await self._crawl_category(
+            category, links, enqueue=enqueue, resume=resume
+        )
+
+    async def crawl_many(
+        self,
+        links: Dict[str, List[str]],
+        enqueue: bool = settings.crawl.enqueue,
+        resume: bool = False,
+    ) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """
+        Crawl several categories concurrently with one session and DB pool.
+        Workers of every stage are split fairly between categories
+        :param links: urls of forum pages per category name
+        :param enqueue: dispatch downloads of new links while crawling
+        :param resume: continue from checkpoints of interrupted crawls
+        :return: stats of every pipeline stage per category
+        """
+        categories: List[str] = list(links)
+        results: List[Dict[str, Dict[str, Any]]] = await asyncio.gather(
+            *(
+                self._crawl_category(
+                    category,
+                    links[category],
+                    enqueue=enqueue,
+                    resume=resume,
+                    index=index,
+                    parts=len(categories),
+                )
+                for index, category in enumerate(categories)
+            )
+        )
+        return dict(zip(categories, results))
+
+    async def get_files_link_from_forum(self, category: str, link: str) -> None:
+        """Walk through forum, and get the links"""
 
-            if download_links and (
-                download_links_list := download_links.__root__  # noqa: E999
-            ):
-                for download_link_obj in download_links_list:
-                    await self.download_links_repo.get_or_create(download_link_obj)
+        await self.crawl(category=category, links=[link])
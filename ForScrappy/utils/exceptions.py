@@ -53,3 +53,11 @@ class TokenNotFoundException(CustomBaseException):
 
 class TokenIsNotStrException(CustomBaseException):
     custom_message = "Token is not a valid string"
+
+
+class IncompleteDownloadError(CustomBaseException):
+    pass
+
+
+class CrawlFailed(CustomBaseException):
+    pass
@@ -0,0 +1,240 @@
+"""
+Prometheus metrics of crawler, repos and celery workers. Crawl daemon serves
+them on its health server, workers on settings.metrics.worker_port.
+Prefork workers need PROMETHEUS_MULTIPROC_DIR, so metrics of all pool
+processes are collected by the one serving them
+"""
+import functools
+import glob
+import inspect
+import logging
+import os
+import time
+from contextvars import ContextVar
+from logging import Logger
+from typing import Any, Awaitable, Callable, Dict, Optional, Type, TypeVar
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from aiohttp import web
+from celery.signals import (
+    task_postrun,
+    task_prerun,
+    worker_init,
+    worker_process_shutdown,
+)
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+
+from logger import get_module_logger
+from settings import settings
+
+logger: Logger = get_module_logger("metrics")
+
+MULTIPROC_DIR: Optional[str] = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+HTTP_REQUEST_SECONDS: Histogram = Histogram(
+    "forscrappy_http_request_seconds",
+    "Time to response headers of HTTP requests",
+    ["host", "client"],
+)
+PARSE_SECONDS: Histogram = Histogram(
+    "forscrappy_parse_seconds", "Time of parsing fetched page", ["page"]
+)
+REPO_SECONDS: Histogram = Histogram(
+    "forscrappy_repo_seconds", "Duration of repo method calls", ["method"]
+)
+DB_QUERIES: Counter = Counter(
+    "forscrappy_db_queries", "SQL queries issued by repo method", ["method"]
+)
+TASK_SECONDS: Histogram = Histogram(
+    "forscrappy_task_seconds",
+    "Duration of celery tasks",
+    ["task", "state"],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, float("inf")),
+)
+DOWNLOADED_BYTES: Counter = Counter(
+    "forscrappy_downloaded_bytes", "Bytes of downloaded files", ["host"]
+)
+BACKLOG: Gauge = Gauge(
+    "forscrappy_backlog",
+    "Items waiting: links not downloaded, celery and crawl stage queues",
+    ["queue"],
+    multiprocess_mode="livesum",
+)
+CACHE_REQUESTS: Counter = Counter(
+    "forscrappy_cache_requests", "Cache lookups by result", ["cache", "result"]
+)
+
+# repo method running in current task, SQL queries are counted for it
+_repo_method: ContextVar[str] = ContextVar("repo_method", default="-")
+
+Handler = Callable[[web.Request], Awaitable[web.Response]]
+RepoType = TypeVar("RepoType", bound=Type[Any])
+
+
+def cache_lookup(cache: str, hit: bool) -> bool:
+    """Count cache lookup, hit ratio is hits / all lookups"""
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+    return hit
+
+
+def _observe_response(response: requests.Response, *args: Any, **kwargs: Any) -> None:
+    HTTP_REQUEST_SECONDS.labels(
+        host=urlsplit(response.url).hostname or "", client="requests"
+    ).observe(response.elapsed.total_seconds())
+
+
+def observe_session(session: requests.Session) -> requests.Session:
+    """Observe latency of every request made with requests session"""
+    if _observe_response not in session.hooks["response"]:
+        session.hooks["response"].append(_observe_response)
+    return session
+
+
+def http_trace_config() -> aiohttp.TraceConfig:
+    """aiohttp trace config observing latency of every request of session"""
+
+    async def on_start(
+        session: aiohttp.ClientSession, context: Any, params: Any
+    ) -> None:
+        context.started = time.perf_counter()
+
+    async def on_end(session: aiohttp.ClientSession, context: Any, params: Any) -> None:
+        HTTP_REQUEST_SECONDS.labels(
+            host=params.url.host or "", client="aiohttp"
+        ).observe(time.perf_counter() - context.started)
+
+    config: aiohttp.TraceConfig = aiohttp.TraceConfig()
+    config.on_request_start.append(on_start)  # type: ignore
+    config.on_request_end.append(on_end)  # type: ignore
+    return config
+
+
+class _QueryHandler(logging.Handler):
+    """Count SQL queries logged by tortoise client per running repo method"""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # pool and schema messages have other formats
+        if record.msg == "%s: %s":
+            DB_QUERIES.labels(method=_repo_method.get()).inc()
+
+
+_query_handler: _QueryHandler = _QueryHandler(logging.DEBUG)
+
+
+def track_db_queries() -> None:
+    """
+    Count SQL queries of repo methods. Safe to call more than once.
+    Tortoise logs queries on debug level, so the level of its logger is lowered
+    and handlers accepting debug records get the queries too
+    """
+    db_logger: logging.Logger = logging.getLogger("tortoise.db_client")
+    if _query_handler in db_logger.handlers:
+        return
+    if db_logger.getEffectiveLevel() > logging.DEBUG:
+        db_logger.setLevel(logging.DEBUG)
+    db_logger.addHandler(_query_handler)
+
+
+def instrument_repo(cls: RepoType) -> RepoType:
+    """Observe duration and SQL queries of every public coroutine method of repo"""
+
+    def timed(label: str, method: Callable[..., Awaitable[Any]]) -> Callable:
+        @functools.wraps(method)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            token = _repo_method.set(label)
+            started: float = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                REPO_SECONDS.labels(method=label).observe(time.perf_counter() - started)
+                _repo_method.reset(token)
+
+        return wrapper
+
+    for name in dir(cls):
+        # static and class methods are left as they are
+        member: Any = inspect.getattr_static(cls, name)
+        if not name.startswith("_") and inspect.iscoroutinefunction(member):
+            setattr(cls, name, timed(f"{cls.__name__}.{name}", member))
+    return cls
+
+
+def get_registry() -> CollectorRegistry:
+    """Registry of this process or, in multiprocess mode, of all processes"""
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    registry: CollectorRegistry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)  # type: ignore
+    return registry
+
+
+def metrics_route(refresh: Optional[Callable[[], Awaitable[None]]] = None) -> Handler:
+    """
+    aiohttp handler of metrics in Prometheus text format
+    :param refresh: updates gauges before they are served, e.g. backlog sizes
+    """
+
+    async def metrics(request: web.Request) -> web.Response:
+        if refresh:
+            try:
+                await refresh()
+            except Exception as e:
+                logger.error(f"Cannot refresh metrics: {e}")
+        return web.Response(
+            body=generate_latest(get_registry()),
+            headers={"Content-Type": CONTENT_TYPE_LATEST},
+        )
+
+    return metrics
+
+
+# start time of running celery tasks by task id
+_task_started: Dict[str, float] = {}
+
+
+def _task_start(task_id: str, **kwargs: Any) -> None:
+    _task_started[task_id] = time.perf_counter()
+
+
+def _task_end(task_id: str, task: Any, state: Optional[str] = None, **kwargs) -> None:
+    started: Optional[float] = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_SECONDS.labels(task=task.name, state=state or "UNKNOWN").observe(
+            time.perf_counter() - started
+        )
+
+
+def _serve_worker_metrics(**kwargs: Any) -> None:
+    """Serve metrics of worker, files of previous run are removed first"""
+    if MULTIPROC_DIR:
+        os.makedirs(MULTIPROC_DIR, exist_ok=True)
+        for path in glob.glob(os.path.join(MULTIPROC_DIR, "*.db")):
+            os.remove(path)
+    start_http_server(settings.metrics.worker_port, registry=get_registry())
+    logger.info(f"Worker metrics served on port {settings.metrics.worker_port}")
+
+
+def _pool_process_shutdown(pid: Optional[int] = None, **kwargs: Any) -> None:
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+def track_tasks() -> None:
+    """Observe durations of celery tasks and serve metrics from worker"""
+    task_prerun.connect(_task_start, weak=False)
+    task_postrun.connect(_task_end, weak=False)
+    if settings.metrics.worker_port:
+        worker_init.connect(_serve_worker_metrics, weak=False)
+        worker_process_shutdown.connect(_pool_process_shutdown, weak=False)
@@ -0,0 +1,270 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from logging import Logger
+from pathlib import Path
+from types import FrameType
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from celery.signals import task_postrun, task_prerun
+
+from logger import get_module_logger
+from settings import ROOT_PATH, settings
+
+logger: Logger = get_module_logger("profiler")
+
+# sample belongs to stage of its innermost frame from one of these paths
+STAGES: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    (
+        "http",
+        (
+            "/requests/",
+            "/urllib3/",
+            "/aiohttp/",
+            "/http/client.py",
+            "/socket.py",
+            "/ssl.py",
+        ),
+    ),
+    ("parse", ("/bs4/", "/lxml/", "/soupsieve/")),
+    ("pydantic", ("/pydantic/",)),
+    ("db", ("/tortoise/", "/asyncpg/", "/pypika/")),
+    ("redis", ("/redis/",)),
+    # event loop waiting for events and idle thread pool workers
+    ("idle", ("/selectors.py", "/threading.py", "/queue.py")),
+)
+
+# filename, line number and function name, innermost frame first
+FrameInfo = Tuple[str, int, str]
+
+
+def is_app_file(filename: str) -> bool:
+    return filename.startswith(ROOT_PATH) and "-packages" not in filename
+
+
+def short_path(filename: str) -> str:
+    """Path relative to project or to installed packages directory"""
+    if filename.startswith(ROOT_PATH):
+        return os.path.relpath(filename, ROOT_PATH)
+    for marker in ("site-packages/", "dist-packages/"):
+        if marker in filename:
+            return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
+
+
+def classify(frames: Sequence[FrameInfo]) -> Tuple[str, Optional[str]]:
+    """
+    :param frames: stack, innermost frame first
+    :return: stage and innermost app code location of the stack, so it's known
+        which call of ours led to time spent or memory allocated in a library
+    """
+    stage: Optional[str] = None
+    caller: Optional[str] = None
+    for filename, lineno, name in frames:
+        path: str = filename.replace(os.sep, "/")
+        if stage is None:
+            stage = next(
+                (
+                    stage_name
+                    for stage_name, paths in STAGES
+                    if any(fragment in path for fragment in paths)
+                ),
+                None,
+            )
+        if caller is None and is_app_file(filename):
+            caller = f"{short_path(filename)}:{lineno} {name}".rstrip()
+        if stage and caller:
+            break
+
+    if stage is None:
+        stage = "app" if frames and is_app_file(frames[0][0]) else "other"
+    return stage, caller
+
+
+def walk(frame: Optional[FrameType]) -> List[FrameInfo]:
+    frames: List[FrameInfo] = []
+    while frame is not None:
+        frames.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+        frame = frame.f_back
+    return frames
+
+
+class Profiler:
+    """
+    Sampling profiler: a thread records stacks of all other threads every
+    `interval` seconds, so profiled code runs at full speed between samples.
+    Samples are written as folded stacks, accepted by flamegraph.pl and
+    speedscope, next to a summary of time per stage (http, parse, pydantic,
+    db, ...) with top app code locations of every stage. With memory_frames
+    set, tracemalloc snapshot taken on stop is summarized per stage too
+    """
+
+    def __init__(
+        self,
+        name: str,
+        directory: str = settings.profiler.directory,
+        interval: float = settings.profiler.interval,
+        top: int = settings.profiler.top,
+        memory_frames: int = settings.profiler.memory_frames,
+    ) -> None:
+        self.name: str = name
+        self.directory: Path = Path(ROOT_PATH) / directory
+        self.interval: float = interval
+        self.top: int = top
+        self.memory_frames: int = memory_frames
+        self.stacks: Counter = Counter()
+        self.stages: Counter = Counter()
+        self.callers: Dict[str, Counter] = {}
+        self.memory: Dict[str, Counter] = {}
+        self.memory_peak: int = 0
+        self.started: float = 0.0
+        self.elapsed: float = 0.0
+        self._stop: threading.Event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._tracing: bool = False
+
+    def start(self) -> None:
+        if self.memory_frames and not tracemalloc.is_tracing():
+            tracemalloc.start(self.memory_frames)
+            self._tracing = True
+        self.started = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._run, name=f"profiler-{self.name}", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self) -> None:
+        """Record stack of every thread except the sampling one"""
+        names: Dict[Optional[int], str] = {
+            thread.ident: thread.name for thread in threading.enumerate()
+        }
+        current: int = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident != current:
+                self.record(names.get(ident, str(ident)), walk(frame))
+
+    def record(self, thread: str, frames: List[FrameInfo]) -> None:
+        stage, caller = classify(frames)
+        self.stages[stage] += 1
+        if caller:
+            self.callers.setdefault(stage, Counter())[caller] += 1
+        folded: str = ";".join(
+            [thread]
+            + [f"{name} ({short_path(filename)})" for filename, _, name in frames[::-1]]
+        )
+        self.stacks[folded] += 1
+
+    def _snapshot_memory(self) -> None:
+        if not tracemalloc.is_tracing():
+            return
+        _, self.memory_peak = tracemalloc.get_traced_memory()
+        snapshot: tracemalloc.Snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ]
+        )
+        for statistic in snapshot.statistics("traceback"):
+            frames: List[FrameInfo] = [
+                (frame.filename, frame.lineno, "")
+                for frame in reversed(statistic.traceback)
+            ]
+            stage, caller = classify(frames)
+            self.memory.setdefault(stage, Counter())[caller or "-"] += statistic.size
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def stop(self) -> Dict[str, Path]:
+        """
+        Stop sampling and write profile files
+        :return: paths of written files
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.elapsed = time.monotonic() - self.started
+        self._snapshot_memory()
+        return self.write()
+
+    def summary(self) -> str:
+        total: int = sum(self.stages.values()) or 1
+        lines: List[str] = [
+            f"{self.name}: {self.elapsed:.2f}s, {total} samples of all threads"
+        ]
+        for stage, count in self.stages.most_common():
+            lines.append(f"{stage}: {count / total:.1%}")
+            for caller, caller_count in self.callers.get(stage, Counter()).most_common(
+                self.top
+            ):
+                lines.append(f"    {caller_count / total:6.1%}  {caller}")
+
+        if self.memory:
+            lines.append(
+                f"memory peak {self.memory_peak / 1024 / 1024:.1f} MiB, "
+                "allocated and not freed per stage:"
+            )
+        for stage, sizes in sorted(
+            self.memory.items(), key=lambda item: -sum(item[1].values())
+        ):
+            lines.append(f"{stage}: {sum(sizes.values()) / 1024:.1f} KiB")
+            for caller, size in sizes.most_common(self.top):
+                lines.append(f"    {size / 1024:10.1f} KiB  {caller}")
+        return "\n".join(lines)
+
+    def write(self) -> Dict[str, Path]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        prefix: str = f"{self.name}-{datetime.now():%Y%m%d-%H%M%S}"
+        paths: Dict[str, Path] = {
+            "folded": self.directory / f"{prefix}.folded",
+            "summary": self.directory / f"{prefix}.txt",
+        }
+        paths["folded"].write_text(
+            "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+        )
+        summary: str = self.summary()
+        paths["summary"].write_text(f"{summary}\n")
+        logger.info(f"Profile of {self.name}:\n{summary}")
+        logger.info(f"Profile files: {', '.join(str(p) for p in paths.values())}")
+        return paths
+
+    def __enter__(self) -> "Profiler":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+
+# profilers of running celery tasks by task id
+_task_profilers: Dict[str, Profiler] = {}
+
+
+def _start_task_profiler(task_id: str, task: Any, **kwargs: Any) -> None:
+    if task.name in settings.profiler.tasks:
+        profiler: Profiler = Profiler(f"{task.name}-{task_id}")
+        _task_profilers[task_id] = profiler
+        profiler.start()
+
+
+def _stop_task_profiler(task_id: str, **kwargs: Any) -> None:
+    profiler: Optional[Profiler] = _task_profilers.pop(task_id, None)
+    if profiler:
+        profiler.stop()
+
+
+def profile_tasks() -> None:
+    """
+    Profile every run of celery tasks listed in settings.profiler.tasks,
+    e.g. tasks.tasks.download_file. Profile files are written by worker
+    """
+    task_prerun.connect(_start_task_profiler, weak=False)
+    task_postrun.connect(_stop_task_profiler, weak=False)
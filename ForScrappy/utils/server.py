@@ -0,0 +1,60 @@
+from logging import Logger
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiohttp import web
+
+from logger import get_module_logger
+from settings import settings
+
+logger: Logger = get_module_logger("server")
+
+# returns health report, process is healthy if report["healthy"] is true
+HealthCheck = Callable[[], Dict[str, Any]]
+
+
+class HealthServer:
+    """
+    Small HTTP server of a long running process. GET /health answers 200
+    while health check reports the process is healthy and 503 otherwise
+    """
+
+    def __init__(
+        self,
+        check: HealthCheck,
+        host: str = settings.daemon.host,
+        port: int = settings.daemon.port,
+    ) -> None:
+        self.check: HealthCheck = check
+        self.host: str = host
+        self.port: int = port
+        self.app: web.Application = web.Application()
+        self.app.router.add_get("/health", self.health)
+        self._runner: Optional[web.AppRunner] = None
+
+    def add_route(
+        self, path: str, handler: Callable[[web.Request], Awaitable[web.Response]]
+    ) -> None:
+        """Serve another GET endpoint. Routes have to be added before start"""
+        self.app.router.add_get(path, handler)
+
+    async def health(self, request: web.Request) -> web.Response:
+        report: Dict[str, Any] = self.check()
+        return web.json_response(report, status=200 if report.get("healthy") else 503)
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Health server listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+        self._runner = None
+
+    async def __aenter__(self) -> "HealthServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.stop()
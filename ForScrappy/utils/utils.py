@@ -1,8 +1,10 @@
+import os
 import re
+import socket
 from datetime import datetime
 from logging import Logger
 from time import sleep
-from typing import Dict
+from typing import Dict, Tuple
 
 from asyncpg import CannotConnectNowError
 
@@ -10,13 +12,17 @@ from asyncpg import CannotConnectNowError
 import validators
 
 from logger import get_module_logger
+from models.migrations import apply_migrations
 from models.types import MyTortoise
 from settings import DB_CONFIG, settings
 from utils.exceptions import DBConnectionError, URLNotValidFormat
+from utils.metrics import track_db_queries
 from utils.schemas import DB_CONFIG_SCHEMA
 
 logger: Logger = get_module_logger("utils")
 
+CATEGORIES: Tuple[str, ...] = ("trance", "house", "techno")
+
 
 def get_db_connections():
     return DB_CONFIG
@@ -37,6 +43,9 @@ class DBConnectionHandler:
 
         config: Dict = get_db_connections()
 
+        if settings.metrics.db_queries:
+            track_db_queries()
+
         await MyTortoise.init(config=config)
 
         retry: int = 0
@@ -45,6 +54,8 @@ class DBConnectionHandler:
             try:
                 validate_credentials(DB_CONFIG)
                 await MyTortoise.generate_schemas()
+                # generate_schemas doesn't add new columns to existing tables
+                await apply_migrations(MyTortoise.get_connection("default"))
                 # setattr(Tortoise, "is_connected", True)
                 MyTortoise.is_connected = True
                 break
@@ -99,11 +110,16 @@ def validate_category(link: str) -> str:
     except IndexError:
         raise ValueError("Category not in link")
 
-    if category not in ("trance", "house", "techno"):
+    if category not in CATEGORIES:
         raise ValueError(f"Category `{category}` is not valid")
     return category
 
 
+def get_runner_id() -> str:
+    """Get identifier of this process, unique across hosts"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
 def get_folder_name_from_date(date: datetime) -> str:
     """Get folder name from date"""
     return f"{date.year}/{date.month}/"
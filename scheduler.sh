@@ -5,9 +5,11 @@ source .env
 
 pipenv shell
 
-python python cli.py get-forum-links -link "${LOCAL__BASE_URL}trance/" -p 5
+python cli.py crawl-all -p 5
 
 
+# Prefer long running `python cli.py daemon` (crawler service in docker-compose),
+# which re-crawls on DAEMON__INTERVAL without paying startup and login every run.
 # 1. chmod +x scheduler.sh
 # 2. cron: sudo crontab -e
 # 3. 0 1 * * * /path/to/scheduler.sh
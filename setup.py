@@ -6,12 +6,14 @@ here = path.abspath(path.dirname(__file__))
 
 setup(
     name="for_scrappy",
-    version="2.0.0",
+    version="2.1.0",
     author="l.remkowicz",
     author_email="l.remkowicz@gmail.com",
     setup_requires=["setuptools>=38.6.0", "pytest"],
     install_requires=[
         "aerich==0.7.1",
+        "aiohttp==3.8.4",
+        "aiosignal==1.3.1; python_version >= '3.7'",
         "aiosqlite==0.17.0; python_version >= '3.6'",
         "amqp==5.1.1; python_version >= '3.6'",
         "async-timeout==4.0.2; python_full_version <= '3.11.2'",
@@ -29,6 +31,7 @@ setup(
         "decorator==5.1.1; python_version >= '3.5'",
         "dictdiffer==0.9.0",
         "flower==2.0.0",
+        "frozenlist==1.3.3; python_version >= '3.7'",
         "greenlet==2.0.2; platform_machine == 'aarch64' or (platform_machine == 'ppc64le' "
         "or (platform_machine == 'x86_64' or (platform_machine == 'amd64' "
         "or (platform_machine == 'AMD64' or (platform_machine == 'win32' or platform_machine == 'WIN32')))))",
@@ -37,6 +40,7 @@ setup(
         "iso8601==2.0.0; python_version < '4.0' and python_full_version >= '3.6.2'",
         "kombu==5.2.4; python_version >= '3.7'",
         "lxml==4.9.2",
+        "multidict==6.0.4; python_version >= '3.7'",
         "prometheus-client==0.16.0; python_version >= '3.6'",
         "prompt-toolkit==3.0.38; python_version >= '3.7'",
         "psycopg2==2.9.6",
@@ -59,5 +63,6 @@ setup(
         "validators==0.20.0",
         "vine==5.0.0; python_version >= '3.6'",
         "wcwidth==0.2.6",
+        "yarl==1.8.2; python_version >= '3.7'",
     ],
 )